@@ -0,0 +1,164 @@
+"""
+In-process index of doctor -> patient relationships for authorization checks.
+
+Every worker keeps its own copy, loaded on first use and kept current by the
+DoctorPatientRelationship and Doctor signals in ``api.signals``.  Each write
+also bumps a generation counter in the default cache; every worker that sees
+a generation other than the one it loaded reloads, so all workers converge.
+That only works if the cache is shared by the workers, which the ``api.W001``
+check makes sure of.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .models import Doctor, DoctorPatientRelationship
+
+GENERATION_KEY = 'api:access-index:generation'
+
+
+def generations_shared():
+    """Whether other processes see the generation counters."""
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+def current_generation(key=GENERATION_KEY):
+    return cache.get(key, 0)
+
+
+def bump_generation(key=GENERATION_KEY):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Missing or evicted.  Start from a random value, so a worker that
+        # loaded before the key went missing never sees its old number again.
+        start = random.getrandbits(48)
+        if cache.add(key, start, timeout=None):
+            return start
+        return cache.incr(key)
+
+
+class AccessIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._patients = None           # doctor id -> set of patient user ids
+        self._doctor_by_user = {}       # user id -> doctor id
+        self._user_by_doctor = {}       # doctor id -> user id
+        self._department_by_doctor = {}  # doctor id -> department id
+        self._generation = None
+        self._checked_at = 0.0
+
+    def load(self):
+        from .shards import all_aliases
+
+        generation = current_generation()
+        patients = {}
+        for alias in all_aliases():
+            relationships = DoctorPatientRelationship.objects.using(alias).values_list('doctor_id', 'patient_id')
+            for doctor_id, patient_id in relationships.iterator():
+                patients.setdefault(doctor_id, set()).add(patient_id)
+        doctors = list(Doctor.objects.values_list('id', 'user_id', 'department_id'))
+        user_by_doctor = {doctor_id: user_id for doctor_id, user_id, _ in doctors}
+
+        with self._lock:
+            self._patients = patients
+            self._user_by_doctor = user_by_doctor
+            self._doctor_by_user = {user_id: doctor_id for doctor_id, user_id in user_by_doctor.items()}
+            self._department_by_doctor = {doctor_id: department_id for doctor_id, _, department_id in doctors}
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        return patients
+
+    def _fresh(self):
+        """Reload if another worker has written since we loaded; returns the patient map."""
+        patients = self._patients
+        now = time.monotonic()
+        if patients is not None and now - self._checked_at < settings.ACCESS_INDEX_CHECK_INTERVAL:
+            return patients
+        if patients is None or current_generation() != self._generation:
+            patients = self.load()
+        else:
+            self._checked_at = now
+        return patients
+
+    # Lookups
+
+    def doctor_id_for_user(self, user_id):
+        self._fresh()
+        return self._doctor_by_user.get(user_id)
+
+    def user_id_for_doctor(self, doctor_id):
+        self._fresh()
+        return self._user_by_doctor.get(doctor_id)
+
+    def department_for_doctor(self, doctor_id):
+        self._fresh()
+        return self._department_by_doctor.get(doctor_id)
+
+    def doctor_has_patient(self, doctor_id, patient_id):
+        return patient_id in self._fresh().get(doctor_id, ())
+
+    def patient_ids(self):
+        """Every user who is some doctor's patient."""
+        return set().union(*self._fresh().values())
+
+    def can_access_patient(self, user_id, patient_id):
+        """The patient themselves, or a doctor with a relationship to them."""
+        if user_id == patient_id:
+            return True
+        doctor_id = self.doctor_id_for_user(user_id)
+        return doctor_id is not None and self.doctor_has_patient(doctor_id, patient_id)
+
+    # Updates, called from signals
+
+    def _updated(self):
+        # This worker reloads on its next check too: incr isn't atomic on
+        # every backend (the file cache reads and writes), so the new
+        # generation may also stand for another worker's write.
+        bump_generation()
+
+    def add_relationship(self, doctor_id, patient_id):
+        with self._lock:
+            if self._patients is not None:
+                self._patients.setdefault(doctor_id, set()).add(patient_id)
+        self._updated()
+
+    def remove_relationship(self, doctor_id, patient_id):
+        from .shards import for_doctor
+
+        still_related = for_doctor(DoctorPatientRelationship, doctor_id).filter(
+            doctor_id=doctor_id, patient_id=patient_id).exists()
+        with self._lock:
+            if self._patients is not None and not still_related:
+                self._patients.get(doctor_id, set()).discard(patient_id)
+        self._updated()
+
+    def set_doctor(self, doctor_id, user_id, department_id):
+        with self._lock:
+            self._user_by_doctor[doctor_id] = user_id
+            self._doctor_by_user[user_id] = doctor_id
+            self._department_by_doctor[doctor_id] = department_id
+        self._updated()
+
+    def remove_doctor(self, doctor_id):
+        with self._lock:
+            user_id = self._user_by_doctor.pop(doctor_id, None)
+            self._doctor_by_user.pop(user_id, None)
+            self._department_by_doctor.pop(doctor_id, None)
+            if self._patients is not None:
+                self._patients.pop(doctor_id, None)
+        self._updated()
+
+    def invalidate(self):
+        """Drop the local copy and tell other workers to reload theirs."""
+        with self._lock:
+            self._patients = None
+        bump_generation()
+
+
+access_index = AccessIndex()
@@ -1,3 +1,200 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Max
+from django.utils.functional import cached_property
 
-# Register your models here.
+from .models import Department, Doctor, DoctorPatientRelationship, PatientRecordNew, PurgeRequest, RecordAccessEvent
+from .record_cache import record_cache
+from .shards import rehome
+
+
+def estimate_row_count(model, using):
+    """
+    Cheap estimate of the number of rows in ``model``'s table, or None if the
+    backend can't give one.  Postgres and MySQL read their planner statistics;
+    elsewhere the highest primary key is used, which is an index lookup but
+    overshoots once rows have been archived or deleted.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s',
+                [table],
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+    if model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField', 'IntegerField'):
+        return model._default_manager.using(using).aggregate(count=Max('pk'))['count'] or 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that skips COUNT(*) on unfiltered changelists of big tables.
+    Filtered changelists are usually narrow, so they still get an exact count.
+
+    A page that comes back short shows the estimate ran past the last row.
+    The count is then corrected, from the page or with COUNT(*) if it is
+    empty, and a page past the real last one is clamped to it.
+    """
+    estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None:
+                self.estimated = True
+                return estimate
+        return super().count
+
+    def page(self, number):
+        page = super().page(number)
+        if not self.estimated or len(page) >= self.per_page:
+            return page
+        self.estimated = False
+        rows = len(page)
+        self.count = (page.number - 1) * self.per_page + rows if rows else self.object_list.count()
+        self.__dict__.pop('num_pages', None)
+        if rows:
+            return page
+        return super().page(min(page.number, self.num_pages))
+
+
+class EstimatedCountChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # The paginator may have corrected its estimate and clamped the page
+        self.result_count = self.paginator.count
+        self.multi_page = self.result_count > self.list_per_page
+        self.page_num = min(self.page_num, self.paginator.num_pages)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+
+@admin.register(Department)
+class DepartmentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'location', 'specialization')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+
+@admin.register(Doctor)
+class DoctorAdmin(LargeTableAdmin):
+    list_display = ('id', 'username', 'department')
+    list_select_related = ('user', 'department')
+    list_filter = ('department',)
+    search_fields = ('user__username',)
+    autocomplete_fields = ('user',)
+    ordering = ('-id',)
+    actions = ('deactivate_accounts', 'activate_accounts')
+
+    @admin.display(ordering='user__username')
+    def username(self, obj):
+        return obj.user.username
+
+    @admin.action(description='Deactivate the selected doctors’ accounts')
+    def deactivate_accounts(self, request, queryset):
+        updated = User.objects.filter(doctor_profile__in=queryset).update(is_active=False)
+        self.message_user(request, f'{updated} accounts deactivated.')
+
+    @admin.action(description='Activate the selected doctors’ accounts')
+    def activate_accounts(self, request, queryset):
+        updated = User.objects.filter(doctor_profile__in=queryset).update(is_active=True)
+        self.message_user(request, f'{updated} accounts activated.')
+
+
+@admin.register(PatientRecordNew)
+class PatientRecordNewAdmin(LargeTableAdmin):
+    list_display = ('record_id', 'patient', 'doctor', 'department', 'created_date')
+    list_select_related = ('patient', 'doctor__user', 'doctor__department', 'department')
+    list_filter = ('department', 'created_date')
+    raw_id_fields = ('patient', 'doctor')
+    ordering = ('-record_id',)
+    actions = ('sync_department_with_doctor',)
+
+    @admin.action(description='Set department to the doctor’s current department')
+    def sync_department_with_doctor(self, request, queryset):
+        records = dict(queryset.values_list('pk', 'doctor_id'))
+        record_ids = list(records)
+        # Doctors live in the default database and records maybe on a shard,
+        # so no subquery: one update per department instead
+        departments = dict(Doctor.objects.filter(pk__in=set(records.values())).values_list('pk', 'department_id'))
+        by_department = {}
+        for record_id, doctor_id in records.items():
+            if doctor_id in departments:
+                by_department.setdefault(departments[doctor_id], []).append(record_id)
+        updated = sum(
+            queryset.filter(pk__in=ids).update(department=department_id, version=F('version') + 1)
+            for department_id, ids in by_department.items()
+        )
+        # update() skips the post_save signal that normally drops cached renderings
+        versions = PatientRecordNew.objects.using(queryset.db).filter(pk__in=record_ids).values_list('pk', 'version')
+        for record_id, version in versions:
+            record_cache.invalidate(record_id, version)
+        # Records whose new department is on another shard move there
+        rehome(PatientRecordNew, queryset.db, record_ids)
+        self.message_user(request, f'{updated} records updated.')
+
+
+@admin.register(DoctorPatientRelationship)
+class DoctorPatientRelationshipAdmin(LargeTableAdmin):
+    list_display = ('id', 'doctor', 'patient')
+    list_select_related = ('doctor__user', 'doctor__department', 'patient')
+    list_filter = ('doctor__department',)
+    raw_id_fields = ('doctor', 'patient')
+    ordering = ('-id',)
+    actions = ('deactivate_patient_accounts',)
+
+    @admin.action(description='Deactivate the selected patients’ accounts')
+    def deactivate_patient_accounts(self, request, queryset):
+        updated = User.objects.filter(doctor_patient_relationships__in=queryset).update(is_active=False)
+        self.message_user(request, f'{updated} accounts deactivated.')
+
+
+@admin.register(RecordAccessEvent)
+class RecordAccessEventAdmin(LargeTableAdmin):
+    list_display = ('timestamp', 'action', 'record_id', 'user_id', 'route')
+    list_filter = ('action', 'route')
+    search_fields = ('=record_id', '=user_id')
+    ordering = ('-timestamp',)
+
+    # The audit trail is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PurgeRequest)
+class PurgeRequestAdmin(admin.ModelAdmin):
+    list_display = ('user_id', 'requested_at', 'started_at', 'finished_at', 'deleted_rows')
+    list_filter = ('finished_at',)
+    ordering = ('-requested_at',)
+    readonly_fields = ('user', 'requested_by_id', 'requested_at', 'started_at', 'finished_at', 'claimed_at',
+                       'deleted_rows')
+
+    def has_add_permission(self, request):
+        return False
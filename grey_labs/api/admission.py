@@ -0,0 +1,122 @@
+"""
+Admission control: per route class concurrency limits with bounded queues.
+
+Each request is put in a route class by URL name and method.  A class runs
+at most ``CONCURRENCY`` requests at once and lets at most ``QUEUE`` more
+wait, each for up to ``TIMEOUT`` seconds.  Anything beyond that is turned
+away at once with a 503 and Retry-After.  Heavy classes are kept well below
+the worker's thread count, so cheap routes always have threads to run on.
+
+This only isolates the classes from one another.  Nothing is prioritized:
+requests are classed by route, not by how long they will run, and within a
+class waiting requests get a slot in no particular order, so a short
+request queued behind long ones in its class waits as long as they do.
+"""
+import threading
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+
+
+class RouteClass:
+    def __init__(self, name, concurrency, queue, timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not acquired:
+                with self._lock:
+                    self.rejected += 1
+                    self.timed_out += 1
+                return False
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'queue': self.queue,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+class AdmissionController:
+    def __init__(self, config):
+        self.classes = {
+            name: RouteClass(name, options['CONCURRENCY'], options['QUEUE'], options['TIMEOUT'])
+            for name, options in config['CLASSES'].items()
+        }
+        self.routes = config['ROUTES']
+        self.default = self.classes[config['DEFAULT_CLASS']]
+        self.retry_after = config['RETRY_AFTER']
+
+    def classify(self, request):
+        try:
+            name = resolve(request.path_info).url_name
+        except Resolver404:
+            return self.default
+        route_class = self.routes.get(f'{name}:{request.method}') or self.routes.get(name)
+        return self.classes[route_class] if route_class else self.default
+
+    def stats(self):
+        return {name: route_class.stats() for name, route_class in self.classes.items()}
+
+
+_controller = None
+
+
+def get_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(settings.ADMISSION_CONTROL)
+    return _controller
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.controller = get_controller()
+
+    def __call__(self, request):
+        route_class = self.controller.classify(request)
+        if not route_class.acquire():
+            response = JsonResponse({'detail': 'Server is busy, please retry later.'}, status=503)
+            response['Retry-After'] = str(self.controller.retry_after)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            route_class.release()
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+
+        if settings.STATEMENT_BUDGETS['ENABLED']:
+            from . import statements
+            statements.install()
+
+        if settings.TRACING['ENABLED']:
+            from . import tracing
+            tracing.install()
@@ -0,0 +1,117 @@
+"""
+Archive tier for patient records.
+
+Records older than ``PATIENT_RECORD_RETENTION_DAYS`` are moved out of the
+hot ``PatientRecordNew`` table into ``PatientRecordArchive`` so the
+department list queries only ever scan the retention window.  Reads by
+primary key go through ``get_record`` which falls back to the archive.
+
+The archive is always on 'default'; hot records are archived from every
+shard.
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import shards
+from .models import PatientRecordNew, PatientRecordArchive
+
+ARCHIVED_FIELDS = ('diagnostics', 'observations', 'treatments', 'misc')
+
+
+def retention_cutoff(days=None):
+    if days is None:
+        days = settings.PATIENT_RECORD_RETENTION_DAYS
+    return timezone.now() - timedelta(days=days)
+
+
+def pack(record):
+    data = {name: getattr(record, name) for name in ARCHIVED_FIELDS}
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+
+def unpack(archived):
+    """
+    Rebuild an unsaved PatientRecordNew from an archive row.  It is marked
+    with ``is_archived`` so callers can refuse to write through it.
+    """
+    record = PatientRecordNew(
+        record_id=archived.record_id,
+        patient_id=archived.patient_id,
+        doctor_id=archived.doctor_id,
+        department_id=archived.department_id,
+        created_date=archived.created_date,
+        **json.loads(zlib.decompress(archived.payload)),
+    )
+    record.is_archived = True
+    return record
+
+
+def archive_batch(cutoff, batch_size, using=shards.DEFAULT):
+    """
+    Move up to ``batch_size`` records created before ``cutoff`` on ``using``
+    into the archive in a single transaction.  Returns the number of records
+    moved.
+    """
+    with transaction.atomic(), transaction.atomic(using=using):
+        records = list(
+            PatientRecordNew.objects.using(using).filter(created_date__lt=cutoff)
+            .order_by('created_date')[:batch_size]
+        )
+        if not records:
+            return 0
+        PatientRecordArchive.objects.bulk_create(
+            [
+                PatientRecordArchive(
+                    record_id=record.record_id,
+                    patient_id=record.patient_id,
+                    doctor_id=record.doctor_id,
+                    department_id=record.department_id,
+                    created_date=record.created_date,
+                    payload=pack(record),
+                )
+                for record in records
+            ],
+            ignore_conflicts=True,
+        )
+        PatientRecordNew.objects.using(using).filter(pk__in=[record.pk for record in records]).delete()
+    return len(records)
+
+
+def archive_records(cutoff=None, batch_size=None):
+    """
+    Archive every record older than ``cutoff``, one batch at a time.  Yields
+    the running total after each batch so callers can report progress.
+    """
+    if cutoff is None:
+        cutoff = retention_cutoff()
+    if batch_size is None:
+        batch_size = settings.PATIENT_RECORD_ARCHIVE_BATCH_SIZE
+
+    total = 0
+    for alias in shards.all_aliases():
+        while True:
+            moved = archive_batch(cutoff, batch_size, alias)
+            if not moved:
+                break
+            total += moved
+            yield total
+
+
+def get_record(pk):
+    """
+    Return the record with primary key ``pk`` from the hot table, or from
+    the archive if it has been moved there.
+    """
+    try:
+        return shards.get(PatientRecordNew, pk=pk)
+    except PatientRecordNew.DoesNotExist:
+        pass
+    try:
+        return unpack(PatientRecordArchive.objects.get(pk=pk))
+    except PatientRecordArchive.DoesNotExist:
+        raise PatientRecordNew.DoesNotExist(f'Record {pk} not found') from None
@@ -0,0 +1,192 @@
+"""
+Audit log of patient record reads and writes.
+
+Views hand events to ``audit_log.record()``, which only appends them to an
+in-memory buffer.  A background thread writes the buffer out when it holds
+``BATCH_SIZE`` events or every ``FLUSH_INTERVAL`` seconds, whichever comes
+first, and once more when the process exits.  A batch the sink fails to
+write goes back to the front of the buffer.  At most ``MAX_BUFFER`` events
+are held; past that new events, and requeued ones that no longer fit, are
+dropped and counted in ``dropped``.
+
+``AUDIT_LOG['BACKEND']`` picks the sink: ``'db'`` bulk-inserts
+RecordAccessEvent rows, ``'file'`` appends JSON lines to segment files in
+``DIRECTORY`` and starts a new segment after ``SEGMENT_BYTES``.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import RecordAccessEvent
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('record_id', 'user_id', 'action', 'route', 'timestamp')
+
+
+class DatabaseSink:
+    def write(self, events):
+        # Runs on the flush thread, which has its own connection
+        close_old_connections()
+        RecordAccessEvent.objects.bulk_create(
+            [RecordAccessEvent(**dict(zip(FIELDS, event))) for event in events],
+            batch_size=1000,
+        )
+
+    def close(self):
+        close_old_connections()
+
+
+class FileSink:
+    """
+    Appends one JSON object per event to ``audit-<pid>-<started>-<n>.jsonl``.
+    Segments are never rewritten, a full one is closed and the next opened.
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._file = None
+        self._sequence = 0
+        self._started = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%S')
+
+    def _segment(self):
+        if self._file is not None and self._file.tell() < self.segment_bytes:
+            return self._file
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._sequence += 1
+        name = f'audit-{os.getpid()}-{self._started}-{self._sequence:06d}.jsonl'
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        return self._file
+
+    def write(self, events):
+        lines = b''.join(
+            json.dumps(dict(zip(FIELDS, event[:4]), timestamp=event[4].isoformat())).encode() + b'\n'
+            for event in events
+        )
+        segment = self._segment()
+        segment.write(lines)
+        segment.flush()
+        os.fsync(segment.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class AuditLog:
+    def __init__(self, sink, batch_size, flush_interval, max_buffer):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+    def record(self, action, record_ids, user_id, route):
+        """Queue one event per record id. Never touches the sink."""
+        now = timezone.now()
+        events = [(record_id, user_id, action, route, now) for record_id in record_ids]
+        if not events:
+            return
+        with self._condition:
+            self._ensure_thread()
+            room = self.max_buffer - len(self._buffer)
+            if room < len(events):
+                # The sink is down or can't keep up, keep memory bounded
+                self.dropped += len(events) - max(room, 0)
+                events = events[:max(room, 0)]
+            self._buffer.extend(events)
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def _ensure_thread(self):
+        # Also restarts the thread in a worker forked after it was started
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='audit-log-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopping and len(self._buffer) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def flush(self):
+        with self._write_lock:
+            with self._condition:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return 0
+            try:
+                self.sink.write(events)
+            except Exception:
+                logger.exception('Writing %d audit events failed, requeueing them', len(events))
+                with self._condition:
+                    # Events recorded meanwhile may have taken the room
+                    room = max(self.max_buffer - len(self._buffer), 0)
+                    self.dropped += max(len(events) - room, 0)
+                    self._buffer[:0] = events[:room]
+                return 0
+            return len(events)
+
+    def close(self):
+        """Stop the flush thread and write out whatever is buffered."""
+        with self._condition:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._stopping = True
+            self._condition.notify()
+        if thread is not None:
+            thread.join(self.flush_interval + 5)
+        self.flush()
+        self.sink.close()
+
+    def stats(self):
+        with self._condition:
+            return {'buffered': len(self._buffer), 'dropped': self.dropped}
+
+
+def get_sink(config):
+    if config['BACKEND'] == 'file':
+        return FileSink(config['DIRECTORY'], config['SEGMENT_BYTES'])
+    return DatabaseSink()
+
+
+def log_access(request, response, action, record_ids, route=None):
+    """
+    Record ``action`` on ``record_ids`` by the request's user, and note it on
+    the response so coalesced copies of it are recorded for their own users.
+    """
+    record_ids = list(record_ids)
+    if route is None:
+        route = request.resolver_match.url_name if request.resolver_match else ''
+    audit_log.record(action, record_ids, request.user.id, route)
+    response.audit_access = (action, record_ids)
+    return response
+
+
+_config = settings.AUDIT_LOG
+audit_log = AuditLog(get_sink(_config), _config['BATCH_SIZE'], _config['FLUSH_INTERVAL'], _config['MAX_BUFFER'])
+atexit.register(audit_log.close)
@@ -0,0 +1,15 @@
+from django.core.checks import Tags, Warning, register
+
+from .access import generations_shared
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    if generations_shared():
+        return []
+    return [Warning(
+        'The default cache is local to each process, so workers never see each other\'s writes to the '
+        'access index, shard map, in-memory tables or record cache.',
+        hint='Use a cache that all workers share, e.g. the file, database, Redis or Memcached backend.',
+        id='api.W001',
+    )]
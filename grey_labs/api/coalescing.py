@@ -0,0 +1,175 @@
+"""
+Single-flight coalescing of identical concurrent GET requests.
+
+When several requests for the same route, query string and authorization
+scope arrive together, the first one runs the view and the rest wait for
+it and get a copy of its rendered response.  A follower that waits longer
+than ``WAIT_TIMEOUT`` seconds, or whose leader didn't produce a 200, runs
+the view itself.
+
+A replayed response is audited for the follower's own user, with the record
+ids the leader's view noted on its response.
+
+The scope of a route says whose data its response depends on, e.g. every
+doctor in a department sees the same department_doctors response, so they
+can share it.  Routes not listed in ``REQUEST_COALESCING['ROUTES']`` are
+never coalesced.
+"""
+import asyncio
+import threading
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .access import access_index
+from .audit import audit_log
+
+
+def department_scope(user):
+    doctor_id = access_index.doctor_id_for_user(user.id)
+    if doctor_id is None:
+        return None
+    return ('department', access_index.department_for_doctor(doctor_id))
+
+
+def doctor_scope(user):
+    doctor_id = access_index.doctor_id_for_user(user.id)
+    if doctor_id is None:
+        return None
+    return ('doctor', doctor_id)
+
+
+SCOPES = {
+    'department': department_scope,
+    'doctor': doctor_scope,
+}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class RequestCoalescingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = settings.REQUEST_COALESCING
+        self.routes = config['ROUTES']
+        self.timeout = config['WAIT_TIMEOUT']
+        self.authenticator = JWTAuthentication()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def key_for(self, request):
+        """
+        Return the coalescing key for ``request``, or None if it must run on
+        its own.  Credentials are fully checked here, since a follower never
+        reaches the view's own authentication, and the view reuses the result.
+        """
+        if request.method != 'GET':
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        scope_name = self.routes.get(match.url_name)
+        if scope_name is None:
+            return None
+        try:
+            authenticated = self.authenticator.authenticate(request)
+        except APIException:
+            return None
+        if authenticated is None:
+            return None
+        # Followers are never authenticated by DRF, the replay audits this user
+        request.user = authenticated[0]
+        # DRF's Request takes these instead of decoding the token and loading
+        # the user again
+        request._force_auth_user, request._force_auth_token = authenticated
+        scope = SCOPES[scope_name](authenticated[0])
+        if scope is None:
+            return None
+        return (match.url_name, request.path, request.META.get('QUERY_STRING', ''),
+                request.META.get('HTTP_ACCEPT', ''), scope)
+
+    @staticmethod
+    def snapshot(response):
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return None
+        return response.status_code, list(response.items()), response.content, getattr(response, 'audit_access', None)
+
+    @staticmethod
+    def replay(result, request, key):
+        status, headers, content, audit_access = result
+        response = HttpResponse(content, status=status)
+        for name, value in headers:
+            response[name] = value
+        response['X-Coalesced'] = '1'
+        if audit_access is not None:
+            action, record_ids = audit_access
+            audit_log.record(action, record_ids, request.user.id, key[0])
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        key = self.key_for(request)
+        if key is None:
+            return self.get_response(request)
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.result is not None:
+                return self.replay(flight.result, request, key)
+            return self.get_response(request)
+
+        try:
+            response = self.get_response(request)
+            flight.result = self.snapshot(response)
+            return response
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def __acall__(self, request):
+        key = await sync_to_async(self.key_for)(request)
+        if key is None:
+            return await self.get_response(request)
+
+        future = self._async_flights.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                result = None
+            if result is not None:
+                return self.replay(result, request, key)
+            return await self.get_response(request)
+
+        future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            response = await self.get_response(request)
+            result = self.snapshot(response)
+            return response
+        finally:
+            del self._async_flights[key]
+            future.set_result(result)
@@ -0,0 +1,164 @@
+"""
+Deletion of doctors and patients without the Django collector.
+
+``soft_delete`` only deactivates the user and files a PurgeRequest, so the
+DELETE views return at once.  From then on the views hide the user and,
+through ``without_purged``, their records.  ``manage.py purge_deleted`` then
+calls ``purge``, which walks the cascades found in model metadata and
+deletes them with raw DELETEs of at most ``batch_size`` rows, children
+before parents, one transaction per chunk.  Only one chunk of primary keys
+per level of the cascade is held in memory.  A purge that is interrupted
+picks up where it stopped when run again.  A run claims the PurgeRequest
+first, so two runs at once never purge the same user; a claim not renewed
+for ``PURGE_CLAIM_SECONDS``, e.g. by a run that was killed, is given up.
+
+Raw statements skip the delete signals, so the record cache and the access
+index are updated here instead.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, models, transaction
+from django.db.models import F, Q
+from django.db.models.deletion import get_candidate_relations_to_delete
+from django.utils import timezone
+
+from . import shards
+from .access import access_index
+from . import roster
+from .models import Doctor, PatientRecordNew, PurgeRequest
+from .record_cache import DELETED, record_cache
+
+
+def soft_delete(user, requested_by=None):
+    """Deactivate ``user`` and queue them for purging.  Returns the PurgeRequest."""
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        purge_request, _ = PurgeRequest.objects.get_or_create(
+            user_id=user.pk, defaults={'requested_by_id': getattr(requested_by, 'pk', None)},
+        )
+    # Cached renderings would still be served, see without_purged
+    doctor_ids = list(Doctor.objects.filter(user_id=user.pk).values_list('pk', flat=True))
+    for alias in shards.all_aliases():
+        for pk in PatientRecordNew.objects.using(alias).filter(
+                Q(patient_id=user.pk) | Q(doctor_id__in=doctor_ids)).values_list('pk', flat=True):
+            record_cache.invalidate(pk)
+    return purge_request
+
+
+def is_soft_deleted(*user_ids):
+    return PurgeRequest.objects.filter(user_id__in=user_ids).exists()
+
+
+def without_purged(queryset):
+    """
+    ``queryset`` of patient records without those of soft-deleted patients
+    and doctors.  Records may be on a shard, away from the users and their
+    purge requests, so they are excluded by id rather than joined; a purged
+    user has no records left, so only those still pending are looked up.
+    """
+    user_ids = list(pending().values_list('user_id', flat=True))
+    doctor_ids = list(Doctor.objects.filter(user_id__in=user_ids).values_list('pk', flat=True)) if user_ids else []
+    if user_ids:
+        queryset = queryset.exclude(patient_id__in=user_ids)
+    if doctor_ids:
+        queryset = queryset.exclude(doctor_id__in=doctor_ids)
+    return queryset
+
+
+def aliases_for(model):
+    return shards.all_aliases() if model in shards.SHARDED_MODELS else [shards.DEFAULT]
+
+
+def _execute(alias, sql, params):
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def delete_rows(model, lookup, alias, batch_size, progress=None):
+    """
+    Delete the rows of ``model`` on ``alias`` matching ``lookup`` and all
+    that cascades from them.  Returns the number of rows deleted.
+    """
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    table, pk_column = quote(model._meta.db_table), quote(model._meta.pk.column)
+    relations = list(get_candidate_relations_to_delete(model._meta))
+    deleted = 0
+    while True:
+        pks = list(model._base_manager.using(alias).filter(**lookup).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+
+        for relation in relations:
+            field = relation.field
+            on_delete = field.remote_field.on_delete
+            if on_delete is models.DO_NOTHING:
+                continue
+            for related_alias in aliases_for(relation.related_model):
+                if on_delete is models.CASCADE:
+                    deleted += delete_rows(relation.related_model, {f'{field.attname}__in': pks}, related_alias,
+                                           batch_size, progress)
+                elif on_delete is models.SET_NULL:
+                    related_connection = connections[related_alias]
+                    related_quote = related_connection.ops.quote_name
+                    _execute(related_alias, 'UPDATE {} SET {col} = NULL WHERE {col} IN ({})'.format(
+                        related_quote(relation.related_model._meta.db_table), ', '.join(['%s'] * len(pks)),
+                        col=related_quote(field.column)), pks)
+                else:
+                    raise ValueError(f'{relation.related_model._meta.label}.{field.name} is {on_delete.__name__}')
+
+        _execute(alias, f"DELETE FROM {table} WHERE {pk_column} IN ({', '.join(['%s'] * len(pks))})", pks)
+        if model is PatientRecordNew:
+            for pk in pks:
+                record_cache.invalidate(pk, DELETED)
+        deleted += len(pks)
+        if progress:
+            progress(model, len(pks))
+
+
+def claim(purge_request):
+    """Claim ``purge_request`` for this run.  False if another run holds it."""
+    now = timezone.now()
+    return bool(PurgeRequest.objects.filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lte=now - timedelta(seconds=settings.PURGE_CLAIM_SECONDS)),
+        pk=purge_request.pk, finished_at__isnull=True,
+    ).update(claimed_at=now))
+
+
+def purge(purge_request, batch_size, progress=None):
+    """
+    Delete the user behind ``purge_request`` and everything under them.
+    Returns the number of rows deleted, or None if another run is at it.
+    """
+    if not claim(purge_request):
+        return None
+    PurgeRequest.objects.filter(pk=purge_request.pk, started_at__isnull=True).update(started_at=timezone.now())
+
+    def counted(model, rows):
+        # Renews the claim
+        PurgeRequest.objects.filter(pk=purge_request.pk).update(deleted_rows=F('deleted_rows') + rows,
+                                                                claimed_at=timezone.now())
+        if progress:
+            progress(model, rows)
+
+    try:
+        department_id = Doctor.objects.filter(user_id=purge_request.user_id).values_list(
+            'department_id', flat=True).first()
+        deleted = delete_rows(User, {'pk': purge_request.user_id}, shards.DEFAULT, batch_size, counted)
+        # The user may have been a doctor, or had relationships
+        access_index.invalidate()
+        if department_id is not None:
+            # Their patients' primary roster rows in the department are gone
+            roster.repair_primaries(shards.shard_map.alias_for(department_id), department_id)
+    except BaseException:
+        # Free for the next run to resume
+        PurgeRequest.objects.filter(pk=purge_request.pk).update(claimed_at=None)
+        raise
+    PurgeRequest.objects.filter(pk=purge_request.pk).update(finished_at=timezone.now(), claimed_at=None)
+    return deleted
+
+
+def pending():
+    return PurgeRequest.objects.filter(finished_at__isnull=True).order_by('requested_at')
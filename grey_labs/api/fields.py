@@ -0,0 +1,100 @@
+"""
+Compressed storage for long clinical text.
+
+Values are stored as a BLOB with a one byte header:
+
+    b'\\x00' + utf-8 text     short values, stored as-is
+    b'\\x01' + zlib stream    compressed against SHARED_DICTIONARY_V1
+
+Rows written before a column was converted still hold plain text and are
+returned unchanged.  Values are decoded eagerly, as rows are loaded, so
+model instances, ``values()`` and ``values_list()`` all get text; querysets
+that don't need the field should ``defer()`` it.
+"""
+import zlib
+
+from django.conf import settings
+from django.db import models
+
+RAW = b'\x00'
+ZLIB_V1 = b'\x01'
+
+# Preset dictionary for ZLIB_V1.  zlib favours matches near the end of the
+# dictionary, so the most common phrases go last.  Never edit this in place:
+# stored values depend on it, add a new header and dictionary instead.
+SHARED_DICTIONARY_V1 = ' '.join([
+    'bilateral', 'unremarkable', 'tenderness', 'auscultation', 'palpation', 'radiology',
+    'ultrasound', 'x-ray', 'MRI', 'CT scan', 'ECG', 'biopsy', 'culture', 'sensitivity',
+    'hemoglobin', 'glucose', 'cholesterol', 'creatinine', 'platelets', 'white blood cell count',
+    'hypertension', 'diabetes mellitus', 'asthma', 'infection', 'fracture', 'inflammation',
+    'fever', 'cough', 'headache', 'nausea', 'vomiting', 'fatigue', 'dizziness', 'swelling',
+    'shortness of breath', 'chest pain', 'abdominal pain', 'back pain', 'mild', 'moderate',
+    'severe', 'acute', 'chronic', 'stable', 'improving', 'worsening', 'resolved',
+    'mg', 'ml', 'once daily', 'twice daily', 'three times daily', 'as needed', 'orally',
+    'intravenous', 'for 7 days', 'for 14 days', 'prescribed', 'continue', 'discontinue',
+    'antibiotics', 'analgesics', 'paracetamol', 'ibuprofen', 'amoxicillin', 'metformin',
+    'physiotherapy', 'rest', 'diet', 'hydration', 'referral', 'follow-up appointment',
+    'blood pressure', 'heart rate', 'temperature', 'respiratory rate', 'oxygen saturation',
+    'within normal limits', 'no significant findings', 'no known allergies',
+    'history of', 'complains of', 'presents with', 'patient reports', 'on examination',
+    'physical examination', 'vital signs', 'laboratory results', 'diagnosis', 'treatment',
+    'observation', 'symptoms', 'medication', 'the patient', 'the patient was', 'the patient is',
+]).encode()
+
+
+def compress_text(text, threshold=None):
+    if threshold is None:
+        threshold = settings.COMPRESSED_TEXT_MIN_LENGTH
+    raw = text.encode()
+    if len(raw) >= threshold:
+        compressor = zlib.compressobj(level=6, zdict=SHARED_DICTIONARY_V1)
+        packed = compressor.compress(raw) + compressor.flush()
+        if len(packed) < len(raw):
+            return ZLIB_V1 + packed
+    return RAW + raw
+
+
+def decompress_text(data):
+    data = bytes(data)
+    header, body = data[:1], data[1:]
+    if header == ZLIB_V1:
+        decompressor = zlib.decompressobj(zdict=SHARED_DICTIONARY_V1)
+        return (decompressor.decompress(body) + decompressor.flush()).decode()
+    if header == RAW:
+        return body.decode()
+    raise ValueError(f'Unknown compressed text header {header!r}')
+
+
+class CompressedTextField(models.TextField):
+    """
+    TextField stored as a (possibly) compressed BLOB.  Values shorter than
+    ``COMPRESSED_TEXT_MIN_LENGTH`` bytes, or that don't shrink, are stored raw.
+
+    Only exact lookups work against the stored value; don't filter on
+    these fields with contains/startswith.
+
+    Decoding is eager: ``from_db_value`` decompresses every loaded value,
+    whether or not it is read.  This replaces the lazy decoding on first
+    attribute access the field was first written with, which left
+    ``values()`` and ``values_list()`` with raw bytes.  The only way left to
+    skip decompression is not to load the field, with ``defer()`` or
+    ``only()``.
+    """
+
+    def get_internal_type(self):
+        return 'BinaryField'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or isinstance(value, str):
+            return value
+        return decompress_text(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress_text(value)
+        return super().to_python(value)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return compress_text(str(value))
@@ -0,0 +1,170 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+The first POST with a given key runs normally and its status, headers and
+body are stored in IdempotencyRecord for ``TTL`` seconds.  A retry with the same key
+gets the stored response back, marked with ``Idempotent-Replayed: true``,
+without writing anything.  A retry that arrives while the first request is
+still running waits for it, up to ``WAIT_TIMEOUT`` seconds, then gets a 409.
+
+Keys are scoped to the route and the authenticated user.  Anonymous callers,
+e.g. of register, share one namespace per route: there is no identity to
+scope them by, and the client address is not one behind a proxy.  Since
+reusing a key with a different body is a 422, another anonymous caller's
+key only replays to a byte-identical request, but it does collide, so
+clients should send random keys such as UUID4s.  5xx responses are not stored, so the request can be retried.  A
+record left running for ``IN_PROGRESS_TIMEOUT`` seconds, e.g. by a worker
+that died, is taken over by the next retry.
+"""
+import hashlib
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .models import IdempotencyRecord
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 255
+# Longest a poll for another worker's request sleeps
+MAX_POLL_INTERVAL = 0.5
+# Response headers not stored for replay: Content-Type has its own column
+# and the rest are recomputed for the replayed response
+UNSTORED_HEADERS = {'content-type', 'content-length', 'date', 'idempotent-replayed'}
+
+
+class IdempotencyMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = settings.IDEMPOTENCY
+        self.routes = set(config['ROUTES'])
+        self.ttl = timedelta(seconds=config['TTL'])
+        self.wait_timeout = config['WAIT_TIMEOUT']
+        self.in_progress_timeout = timedelta(seconds=config['IN_PROGRESS_TIMEOUT'])
+        self.poll_interval = config['POLL_INTERVAL']
+        self.authenticator = JWTAuthentication()
+        # Requests this worker is running, so local duplicates needn't poll
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def key_for(self, request, idempotency_key):
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.url_name not in self.routes:
+            return None
+        try:
+            authenticated = self.authenticator.authenticate(request)
+        except APIException:
+            # Let the view turn the bad credentials away
+            return None
+        caller = f'user:{authenticated[0].pk}' if authenticated else 'anonymous'
+        return hashlib.sha256(f'{match.url_name}\n{caller}\n{idempotency_key}'.encode()).hexdigest()
+
+    @staticmethod
+    def fingerprint(request):
+        digest = hashlib.sha256(f'{request.method} {request.get_full_path()}\n'.encode())
+        digest.update(request.body)
+        return digest.hexdigest()
+
+    @staticmethod
+    def replay(record):
+        response = HttpResponse(bytes(record.body), status=record.status, content_type=record.content_type)
+        for name, value in record.headers:
+            response[name] = value
+        response['Idempotent-Replayed'] = 'true'
+        return response
+
+    def __call__(self, request):
+        idempotency_key = request.META.get(HEADER)
+        if request.method != 'POST' or not idempotency_key:
+            return self.get_response(request)
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return JsonResponse({'detail': f'Idempotency-Key is longer than {MAX_KEY_LENGTH} characters.'}, status=400)
+        key = self.key_for(request, idempotency_key)
+        if key is None:
+            return self.get_response(request)
+
+        fingerprint = self.fingerprint(request)
+        deadline = time.monotonic() + self.wait_timeout
+        interval = self.poll_interval
+        while True:
+            record, leader = self.claim(key, fingerprint)
+            if leader:
+                return self.run(request, record)
+            if record.fingerprint != fingerprint:
+                return JsonResponse({'detail': 'Idempotency-Key was already used for a different request.'},
+                                    status=422)
+            if record.status is not None:
+                return self.replay(record)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                response = JsonResponse({'detail': 'A request with this Idempotency-Key is still in progress.'},
+                                        status=409)
+                response['Retry-After'] = '1'
+                return response
+            with self._lock:
+                running = self._running.get(key)
+            if running is not None:
+                running.wait(remaining)
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def claim(self, key, fingerprint):
+        """
+        Return (record, True) if this request should run, or the existing
+        record and False.
+        """
+        now = timezone.now()
+        # Read first, so a replay writes nothing
+        record = IdempotencyRecord.objects.filter(key=key).first()
+        if record is None:
+            try:
+                record = IdempotencyRecord.objects.create(key=key, fingerprint=fingerprint, created_at=now,
+                                                          expires_at=now + self.ttl)
+                return record, True
+            except IntegrityError:
+                # Another worker got there first
+                return self.claim(key, fingerprint)
+        # Expired, or abandoned by a request that never finished
+        stale = (record.expires_at <= now
+                 or (record.status is None and record.created_at <= now - self.in_progress_timeout))
+        if stale and IdempotencyRecord.objects.filter(
+                key=key, created_at=record.created_at).update(
+                fingerprint=fingerprint, status=None, content_type='', headers=[], body=b'', created_at=now,
+                expires_at=now + self.ttl):
+            return IdempotencyRecord(key=key, fingerprint=fingerprint, created_at=now, expires_at=now + self.ttl), True
+        return record, False
+
+    def run(self, request, record):
+        done = threading.Event()
+        with self._lock:
+            self._running[record.key] = done
+        try:
+            response = self.get_response(request)
+            if response.status_code >= 500 or response.streaming:
+                IdempotencyRecord.objects.filter(key=record.key, created_at=record.created_at).delete()
+            else:
+                IdempotencyRecord.objects.filter(key=record.key, created_at=record.created_at).update(
+                    status=response.status_code, content_type=response.get('Content-Type', ''),
+                    headers=[[name, value] for name, value in response.items()
+                             if name.lower() not in UNSTORED_HEADERS],
+                    body=response.content)
+            return response
+        except BaseException:
+            IdempotencyRecord.objects.filter(key=record.key, created_at=record.created_at).delete()
+            raise
+        finally:
+            with self._lock:
+                del self._running[record.key]
+            done.set()
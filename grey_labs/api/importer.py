@@ -0,0 +1,219 @@
+"""
+Streaming bulk import of historical patient records from CSV or NDJSON.
+
+Rows are parsed one at a time from a text stream, checked against id maps
+that are loaded once up front, and written with one ``executemany`` INSERT
+per batch of ``PATIENT_RECORD_IMPORT_BATCH_SIZE`` rows, one transaction per
+batch and shard.  A bad
+row is rejected on its own and never fails the rest of the import.  A file
+that can't be read any further, e.g. invalid UTF-8 or broken CSV quoting,
+stops the import after the rows before it; the summary says where.
+
+Each row needs ``patient``, ``doctor``, ``diagnostics``, ``observations``
+and ``treatments``.  ``department`` defaults to the doctor's department,
+``created_date`` to now, and ``misc`` is optional.
+"""
+import csv
+import json
+from datetime import datetime, time
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .fields import compress_text
+from .models import Department, Doctor, PatientRecordNew
+from .shards import shard_aliases, shard_ids, shard_map
+
+FORMATS = ('csv', 'ndjson')
+REQUIRED_TEXT_FIELDS = ('diagnostics', 'observations', 'treatments')
+
+# Only the first rejections are kept with their reason, the rest are counted.
+MAX_REPORTED_REJECTIONS = 1000
+
+# Values produced by RecordImporter.build(), in this column order.
+COLUMNS = [
+    PatientRecordNew._meta.get_field(name).column
+    for name in ('patient', 'doctor', 'department', 'created_date', 'diagnostics', 'observations', 'treatments', 'misc',
+                 'version')
+]
+
+
+@lru_cache
+def insert_sql(alias, with_pk):
+    # With sharding on, ids come from the shared sequence and go first
+    ops = connections[alias].ops
+    columns = [PatientRecordNew._meta.pk.column, *COLUMNS] if with_pk else COLUMNS
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(
+        ops.quote_name(PatientRecordNew._meta.db_table),
+        ', '.join(ops.quote_name(column) for column in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+
+
+def guess_format(filename):
+    if filename.lower().endswith('.csv'):
+        return 'csv'
+    if filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return None
+
+
+def read_csv(stream):
+    # Line 1 is the header
+    for line_no, row in enumerate(csv.DictReader(stream), start=2):
+        yield line_no, row
+
+
+def read_ndjson(stream):
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield line_no, exc
+            continue
+        yield line_no, row
+
+
+class RecordImporter:
+    """
+    Imports rows into PatientRecordNew.  If ``department_id`` is given, rows
+    for any other department, or by a doctor from another department, are
+    rejected.  ``progress`` is called with the importer after every batch.
+    """
+
+    def __init__(self, batch_size=None, department_id=None, progress=None):
+        self.batch_size = batch_size or settings.PATIENT_RECORD_IMPORT_BATCH_SIZE
+        self.department_id = department_id
+        self.progress = progress
+        self.imported = 0
+        self.rejected = 0
+        self.rejections = []
+        self.error = None
+
+        # Only patients and doctors the views would show: active, and not
+        # soft-deleted, see api.deletion
+        self.patient_ids = set(User.objects.filter(
+            groups__name='Patients', is_active=True, purge_request__isnull=True).values_list('id', flat=True))
+        self.doctor_departments = dict(Doctor.objects.filter(
+            user__is_active=True, user__purge_request__isnull=True).values_list('id', 'department_id'))
+        self.department_ids = set(Department.objects.values_list('id', flat=True))
+
+    def run(self, stream, format):
+        rows = read_csv(stream) if format == 'csv' else read_ndjson(stream)
+        batch = []
+        line_no = 0
+        try:
+            for line_no, row in rows:
+                try:
+                    if isinstance(row, Exception):
+                        raise ValueError(f'invalid JSON: {row}')
+                    batch.append(self.build(row))
+                except (ValueError, TypeError, AttributeError) as exc:
+                    self.reject(line_no, exc)
+                    continue
+                if len(batch) >= self.batch_size:
+                    self.flush(batch)
+                    batch = []
+        except (UnicodeDecodeError, csv.Error) as exc:
+            # The reader can't go past this point
+            self.error = f'stopped after line {line_no}: {exc}'
+        if batch:
+            self.flush(batch)
+        return self.summary()
+
+    def build(self, row):
+        patient_id = self._id(row, 'patient')
+        if patient_id not in self.patient_ids:
+            raise ValueError(f'unknown patient {patient_id}')
+
+        doctor_id = self._id(row, 'doctor')
+        if doctor_id not in self.doctor_departments:
+            raise ValueError(f'unknown doctor {doctor_id}')
+
+        department_id = self._id(row, 'department', required=False) or self.doctor_departments[doctor_id]
+        if department_id not in self.department_ids:
+            raise ValueError(f'unknown department {department_id}')
+        if self.department_id is not None and department_id != self.department_id:
+            raise ValueError(f'department {department_id} is outside this import')
+        if self.department_id is not None and self.doctor_departments[doctor_id] != self.department_id:
+            raise ValueError(f'doctor {doctor_id} is not in department {self.department_id}')
+
+        text = {}
+        for name in REQUIRED_TEXT_FIELDS:
+            value = row.get(name)
+            if not value:
+                raise ValueError(f'{name} is required')
+            text[name] = str(value)
+
+        misc = row.get('misc')
+        return (
+            patient_id,
+            doctor_id,
+            department_id,
+            connection.ops.adapt_datetimefield_value(self._date(row.get('created_date'))),
+            compress_text(text['diagnostics']),
+            compress_text(text['observations']),
+            compress_text(text['treatments']),
+            compress_text(str(misc)) if misc else None,
+            1,
+        )
+
+    def flush(self, batch):
+        # One prepared INSERT run over the whole batch rather than
+        # bulk_create.  This skips building model instances, which is most of
+        # the cost of bulk_create here, and with them what a model write
+        # would do: build() is all the validation there is, it sets version
+        # and compresses the text that save() and CompressedTextField would,
+        # ids are reserved here when sharded, and no post_save is sent.  Its
+        # only receiver drops cached renderings, which new rows don't have.
+        sharded = bool(shard_aliases())
+        by_alias = {}
+        for row in batch:
+            by_alias.setdefault(shard_map.alias_for(row[2]), []).append(row)
+        for alias, rows in by_alias.items():
+            if sharded:
+                start, _ = shard_ids.reserve(PatientRecordNew, len(rows))
+                rows = [(start + offset, *row) for offset, row in enumerate(rows)]
+            with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+                cursor.executemany(insert_sql(alias, sharded), rows)
+        self.imported += len(batch)
+        if self.progress:
+            self.progress(self)
+
+    def reject(self, line_no, exc):
+        self.rejected += 1
+        if len(self.rejections) < MAX_REPORTED_REJECTIONS:
+            self.rejections.append({'line': line_no, 'error': str(exc)})
+
+    def summary(self):
+        return {'imported': self.imported, 'rejected': self.rejected, 'rejections': self.rejections,
+                'error': self.error}
+
+    @staticmethod
+    def _id(row, name, required=True):
+        value = row.get(name, row.get(f'{name}_id'))
+        if value in (None, ''):
+            if required:
+                raise ValueError(f'{name} is required')
+            return None
+        return int(value)
+
+    @staticmethod
+    def _date(value):
+        if not value:
+            return timezone.now()
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f'invalid created_date {value!r}')
+            parsed = datetime.combine(day, time())
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
@@ -0,0 +1,76 @@
+"""
+Small tables every worker keeps in memory: group ids by name and the
+departments by id.
+
+Like the shard map, a worker reloads a table when the shared cache has a
+generation it didn't load, checked at most every
+``LOOKUP_CHECK_INTERVAL`` seconds.  Writes bump the generation from the
+Group and Department signals in ``api.signals``.  If the cache isn't shared
+between processes, the tables are read from the database on every lookup.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+
+from .access import bump_generation, current_generation, generations_shared
+from .models import Department
+
+
+class CachedTable:
+    def __init__(self, generation_key, fetch):
+        self.generation_key = generation_key
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._rows = None
+        self._generation = None
+        self._checked_at = 0.0
+
+    def load(self):
+        generation = current_generation(self.generation_key)
+        rows = self.fetch()
+        with self._lock:
+            self._rows = rows
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        return rows
+
+    def _fresh(self):
+        if not generations_shared():
+            # Nothing would tell this worker about other workers' writes
+            return self.fetch()
+        rows = self._rows
+        now = time.monotonic()
+        if rows is not None and now - self._checked_at < settings.LOOKUP_CHECK_INTERVAL:
+            return rows
+        if rows is None or current_generation(self.generation_key) != self._generation:
+            rows = self.load()
+        else:
+            self._checked_at = now
+        return rows
+
+    def get(self, key):
+        return self._fresh().get(key)
+
+    def changed(self):
+        """Called after a committed write; makes every worker reload."""
+        bump_generation(self.generation_key)
+        with self._lock:
+            self._rows = None
+
+
+group_ids = CachedTable('api:group-ids:generation',
+                        lambda: dict(Group.objects.values_list('name', 'pk')))
+
+# Instances are shared by every request, treat them as read-only
+departments = CachedTable('api:departments:generation',
+                          lambda: {department.pk: department for department in Department.objects.all()})
+
+
+def group_id(name):
+    """The id of the group called ``name``, created if there is none."""
+    pk = group_ids.get(name)
+    if pk is None:
+        pk = Group.objects.get_or_create(name=name)[0].pk
+    return pk
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.archive import archive_records, retention_cutoff
+from api.models import PatientRecordNew
+from api.shards import all_aliases
+
+
+class Command(BaseCommand):
+    help = 'Move patient records older than the retention window into the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.PATIENT_RECORD_RETENTION_DAYS,
+                            help='Archive records created more than this many days ago.')
+        parser.add_argument('--batch-size', type=int, default=settings.PATIENT_RECORD_ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many records would be archived.')
+
+    def handle(self, *args, **options):
+        cutoff = retention_cutoff(options['days'])
+        if options['dry_run']:
+            count = sum(PatientRecordNew.objects.using(alias).filter(created_date__lt=cutoff).count()
+                        for alias in all_aliases())
+            self.stdout.write(f'{count} records created before {cutoff:%Y-%m-%d} would be archived')
+            return
+
+        total = 0
+        for total in archive_records(cutoff, options['batch_size']):
+            self.stdout.write(f'Archived {total} records')
+        self.stdout.write(self.style.SUCCESS(f'Done, {total} records archived'))
@@ -0,0 +1,120 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.fields import CompressedTextField, compress_text, decompress_text
+from api.models import PatientRecordNew
+
+# Sentences in the style of real notes.  Some of their words are in
+# SHARED_DICTIONARY_V1, but the numbers, names, abbreviations and wording
+# around them mostly aren't, so the synthetic saving isn't built in.
+NOTE_SENTENCES = [
+    '{age} y/o {sex} seen in clinic on {date}, c/o {complaint} for {days} days.',
+    'Pt states {complaint} started after {trigger}, worse at night, partly relieved by {relief}.',
+    'BP {sys}/{dia}, HR {hr}, T {temp}, SpO2 {sat}% on room air, RR {rr}.',
+    'Exam: {finding}. No rash, no lymphadenopathy, cap refill < 2s.',
+    'Labs from {date}: Hb {hb} g/dL, WBC {wbc} x10^9/L, CRP {crp} mg/L, eGFR {egfr}.',
+    'Imaging: {imaging}.',
+    'Impression: {impression}; r/o {differential}.',
+    'Plan: {plan}. Reviewed with {name}, safety-netting advice given, return if symptoms escalate.',
+    'Allergies: {allergy}. Lives with {household}, works as a {job}, smokes {cigs}/day.',
+]
+NOTE_VALUES = {
+    'sex': ['M', 'F'],
+    'complaint': ['intermittent palpitations', 'left knee pain after a fall', 'productive cough with green sputum',
+                  'burning on micturition', 'itchy scaly plaques on both elbows', 'low mood and poor sleep',
+                  'numbness in the right hand at night', 'epigastric discomfort after meals'],
+    'trigger': ['a long-haul flight', 'starting a new gym routine', 'a viral illness last month',
+                'moving house', 'switching to night shifts', 'no obvious trigger'],
+    'relief': ['lying flat', 'antacids', 'ice packs', 'OTC naproxen', 'a hot shower', 'nothing so far'],
+    'finding': ['crackles R base, reduced air entry', 'effusion L knee, ROM limited by guarding',
+                'soft non-tender abdo, BS present', 'Tinel +ve R wrist, thenar bulk preserved',
+                'erythematous plaques with silvery scale', 'JVP not raised, HS I+II+0, no oedema'],
+    'imaging': ['CXR shows patchy consolidation RLL', 'US abdo: gallstones, CBD 4mm',
+                'XR knee: no bony injury, soft tissue swelling', 'CTPA negative for PE', 'not indicated today'],
+    'impression': ['community-acquired pneumonia', 'probable meniscal tear', 'uncomplicated UTI',
+                   'plaque psoriasis', 'carpal tunnel syndrome', 'GORD', 'paroxysmal AF'],
+    'differential': ['PE', 'septic arthritis', 'pyelonephritis', 'eczema', 'cervical radiculopathy', 'ACS'],
+    'plan': ['doxycycline 100mg bd x5/7, repeat CXR 6/52', 'RICE, ortho referral, crutches issued',
+             'nitrofurantoin 100mg MR bd x3/7, MSU sent', 'betamethasone cream, derm review 8/52',
+             'wrist splints at night, NCS requested', 'omeprazole 20mg od, H. pylori stool test',
+             'start apixaban 5mg bd after CHA2DS2-VASc 3, echo booked'],
+    'allergy': ['NKDA', 'penicillin (rash)', 'latex', 'codeine (vomiting)', 'sulfonamides'],
+    'household': ['partner and two children', 'elderly mother', 'alone', 'flatmates'],
+    'job': ['bus driver', 'teacher', 'software developer', 'nurse', 'farmer', 'retired electrician'],
+    'name': ['Dr Okafor', 'Dr Lindqvist', 'the registrar', 'the on-call consultant', 'Dr Nakamura'],
+}
+
+
+def synthetic_notes(count, sentences=8, seed=0):
+    rng = random.Random(seed)
+
+    def note():
+        values = {name: rng.choice(choices) for name, choices in NOTE_VALUES.items()}
+        values.update(
+            age=rng.randint(18, 95), days=rng.randint(1, 30),
+            date=f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2015, 2024)}',
+            sys=rng.randint(95, 180), dia=rng.randint(55, 110), hr=rng.randint(48, 130),
+            temp=f'{rng.uniform(35.8, 39.5):.1f}', sat=rng.randint(88, 100), rr=rng.randint(10, 30),
+            hb=f'{rng.uniform(8, 17):.1f}', wbc=f'{rng.uniform(3, 20):.1f}', crp=rng.randint(1, 250),
+            egfr=rng.randint(25, 120), cigs=rng.randint(0, 20),
+        )
+        return ' '.join(template.format(**values) for template in rng.sample(NOTE_SENTENCES, sentences))
+
+    return [note() for _ in range(count)]
+
+
+class Command(BaseCommand):
+    help = 'Report bytes saved by CompressedTextField and the encode/decode cost per value.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Number of stored records to sample.')
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='Benchmark this many generated notes instead of stored records.')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            texts = synthetic_notes(options['synthetic'])
+        else:
+            texts = self.stored_texts(options['limit'])
+            self.time_list_query(options['limit'])
+        if not texts:
+            self.stdout.write('No text to benchmark, try --synthetic 1000')
+            return
+
+        start = time.perf_counter()
+        packed = [compress_text(text) for text in texts]
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for value in packed:
+            decompress_text(value)
+        decode = time.perf_counter() - start
+
+        raw_bytes = sum(len(text.encode()) for text in texts)
+        stored_bytes = sum(len(value) for value in packed)
+        self.stdout.write(f'{len(texts)} values, {raw_bytes} bytes raw, {stored_bytes} bytes stored '
+                          f'({100 * (1 - stored_bytes / raw_bytes):.1f}% saved)')
+        self.stdout.write(f'encode {encode / len(texts) * 1e6:.1f} us/value, '
+                          f'decode {decode / len(texts) * 1e6:.1f} us/value')
+
+    def stored_texts(self, limit):
+        names = [f.name for f in PatientRecordNew._meta.fields if isinstance(f, CompressedTextField)]
+        texts = []
+        for record in PatientRecordNew.objects.only('pk', *names)[:limit]:
+            texts.extend(value for value in (getattr(record, name) for name in names) if value)
+        return texts
+
+    def time_list_query(self, limit):
+        names = [f.name for f in PatientRecordNew._meta.fields if isinstance(f, CompressedTextField)]
+
+        # Values are decoded as rows load; deferring the fields skips that
+        start = time.perf_counter()
+        records = list(PatientRecordNew.objects.all()[:limit])
+        fetch = time.perf_counter() - start
+        start = time.perf_counter()
+        list(PatientRecordNew.objects.defer(*names)[:limit])
+        deferred = time.perf_counter() - start
+
+        self.stdout.write(f'{len(records)} records fetched in {fetch * 1000:.1f} ms, '
+                          f'{deferred * 1000:.1f} ms with the text fields deferred')
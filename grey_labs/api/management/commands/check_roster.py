@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.roster import check
+from api.shards import all_aliases
+
+
+class Command(BaseCommand):
+    help = 'Check the patient roster against doctor-patient relationships, and optionally repair it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Rebuild missing and stale rows and drop orphans.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        problems = 0
+        for alias in all_aliases():
+            counts = check(alias, options['batch_size'], options['fix'])
+            problems += sum(counts.values())
+            self.stdout.write(f"{alias}: {counts['missing']} missing, {counts['stale']} stale, "
+                              f"{counts['orphaned']} orphaned, {counts['primaries']} patients without one primary row")
+
+        if not problems:
+            self.stdout.write(self.style.SUCCESS('Roster is consistent'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {problems} problems'))
+        else:
+            raise CommandError(f'{problems} problems found, run with --fix to repair them')
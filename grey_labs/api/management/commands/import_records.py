@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import FORMATS, RecordImporter, guess_format
+
+
+class Command(BaseCommand):
+    help = 'Bulk import historical patient records from a CSV or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--department', type=int, help='Reject rows for any other department.')
+
+    def handle(self, *args, **options):
+        format = options['format'] or guess_format(options['path'])
+        if format is None:
+            raise CommandError('Cannot tell the file format from its name, pass --format.')
+
+        start = time.perf_counter()
+
+        def progress(importer):
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{importer.imported} imported, {importer.rejected} rejected '
+                              f'({importer.imported / elapsed:.0f} rows/s)')
+
+        importer = RecordImporter(options['batch_size'], options['department'], progress)
+        with open(options['path'], encoding='utf-8', newline='') as stream:
+            summary = importer.run(stream, format)
+
+        for rejection in summary['rejections']:
+            self.stderr.write(f"line {rejection['line']}: {rejection['error']}")
+        if summary['error']:
+            self.stderr.write(f"Import {summary['error']}")
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Done in {elapsed:.1f}s: {summary['imported']} imported, {summary['rejected']} rejected"
+        ))
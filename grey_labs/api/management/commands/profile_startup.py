@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api.startup import cold_start, import_times
+
+
+class Command(BaseCommand):
+    help = 'Report the import cost of each module loaded during a cold worker start.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', help='Module to import after django.setup() (defaults to ROOT_URLCONF).')
+        parser.add_argument('--limit', type=int, default=30, help='Number of modules to show.')
+        parser.add_argument('--sort', choices=['self', 'cumulative'], default='self')
+        parser.add_argument('--prefix', default='', help='Only show modules starting with this prefix.')
+
+    def handle(self, *args, **options):
+        rows = [row for row in import_times(options['target']) if row[0].startswith(options['prefix'])]
+        rows.sort(key=lambda row: row[1] if options['sort'] == 'self' else row[2], reverse=True)
+
+        self.stdout.write(f"{'self ms':>9} {'cumul ms':>9}  module")
+        for module, self_us, cumulative_us in rows[:options['limit']]:
+            self.stdout.write(f'{self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {module}')
+
+        seconds, modules = cold_start(options['target'])
+        self.stdout.write(self.style.SUCCESS(f'Cold start: {seconds * 1000:.0f} ms, {modules} modules imported'))
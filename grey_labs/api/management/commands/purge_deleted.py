@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.deletion import pending, purge
+
+
+class Command(BaseCommand):
+    help = 'Delete soft-deleted doctors and patients and everything that cascades from them, in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.PURGE_BATCH_SIZE)
+        parser.add_argument('--limit', type=int, help='Purge at most this many users.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the users waiting to be purged.')
+
+    def handle(self, *args, **options):
+        requests = pending()
+        if options['limit']:
+            requests = requests[:options['limit']]
+        if options['dry_run']:
+            for purge_request in requests:
+                self.stdout.write(f'User {purge_request.user_id}, requested {purge_request.requested_at:%Y-%m-%d %H:%M}')
+            return
+
+        for purge_request in requests:
+            totals = {}
+
+            def progress(model, rows):
+                totals[model._meta.label] = totals.get(model._meta.label, 0) + rows
+                self.stdout.write(f'User {purge_request.user_id}: {totals[model._meta.label]} {model._meta.label} rows deleted')
+
+            deleted = purge(purge_request, options['batch_size'], progress)
+            if deleted is None:
+                self.stdout.write(self.style.WARNING(f'User {purge_request.user_id} is being purged by another run, skipped'))
+                continue
+            self.stdout.write(self.style.SUCCESS(f'Purged user {purge_request.user_id}, {deleted} rows'))
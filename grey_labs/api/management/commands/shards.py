@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Department
+from api.shards import all_aliases, move_department, row_counts, shard_map
+
+
+class Command(BaseCommand):
+    help = 'Show where departments are stored, or move a department to another shard.'
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='subcommand', required=True)
+        subcommands.add_parser('status', help='List the shards, their departments and row counts.')
+        move = subcommands.add_parser('move', help='Move a department to another shard in batches.')
+        move.add_argument('department', type=int)
+        move.add_argument('alias')
+        move.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['subcommand'] == 'status':
+            self.status()
+        else:
+            self.move(options['department'], options['alias'], options['batch_size'])
+
+    def status(self):
+        departments = {}
+        for department_id, name in Department.objects.values_list('id', 'name'):
+            departments.setdefault(shard_map.alias_for(department_id), []).append(f'{department_id} ({name})')
+        for alias, counts in row_counts().items():
+            rows = ', '.join(f'{count} {name}' for name, count in counts.items())
+            self.stdout.write(f"{alias}: {rows}; departments: {', '.join(departments.get(alias, [])) or '-'}")
+
+    def move(self, department_id, alias, batch_size):
+        if not Department.objects.filter(pk=department_id).exists():
+            raise CommandError(f'Department {department_id} does not exist.')
+        if alias not in all_aliases():
+            raise CommandError(f"'{alias}' is not 'default' or one of DATABASE_SHARDS['ALIASES'].")
+
+        totals = {}
+
+        def progress(phase, model, rows):
+            key = (phase, model._meta.object_name)
+            totals[key] = totals.get(key, 0) + rows
+            self.stdout.write(f'{phase}: {totals[key]} {model._meta.object_name} rows')
+
+        try:
+            move_department(department_id, alias, batch_size, progress)
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(f'Department {department_id} is on {alias}'))
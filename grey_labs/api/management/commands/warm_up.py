@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = 'Run the worker warm-up (routes, serializers, in-memory tables, connections) and time each step.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pre-fork', action='store_true', help='Close the database connections afterwards.')
+
+    def handle(self, *args, **options):
+        total = 0.0
+        for step, count, seconds in warm_up(pre_fork=options['pre_fork']):
+            total += seconds
+            self.stdout.write(f'{step:<12} {count:>4}  {seconds * 1000:8.1f} ms')
+        self.stdout.write(self.style.SUCCESS(f'Warmed up in {total * 1000:.1f} ms'))
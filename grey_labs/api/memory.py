@@ -0,0 +1,117 @@
+"""
+Per route memory profiling with tracemalloc.
+
+``measure()`` runs a callable with tracemalloc on and returns its peak
+allocation and the lines that allocated most of what is still held when it
+returns.  MemoryProfilerMiddleware does that for requests when
+``MEMORY_PROFILING['ENABLED']`` is set, and ``memory_stats`` keeps the peak
+per URL name, with the allocation sites of the worst request seen.  They are
+listed at /api/metrics/memory/.
+
+tracemalloc counts the whole process, so only one request is profiled at a
+time and the others run unmeasured; tracing also slows every allocation, so
+leave it off in production unless chasing a leak.
+"""
+import threading
+import tracemalloc
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+class Measurement:
+    __slots__ = ('peak', 'top')
+
+    def __init__(self, peak, top):
+        self.peak = peak
+        self.top = top
+
+
+def _top_sites(before, after, limit):
+    stats = after.compare_to(before, 'lineno')
+    return [
+        {'site': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+         'size': stat.size_diff, 'count': stat.count_diff}
+        for stat in stats[:limit] if stat.size_diff > 0
+    ]
+
+
+def measure(func, *args, top=10, frames=1, **kwargs):
+    """
+    Call ``func`` and return ``(result, Measurement)``: the peak bytes
+    allocated during the call, above what was allocated before it, and the
+    ``top`` sites of what it still holds at the end.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot() if top else None
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        sites = _top_sites(before, tracemalloc.take_snapshot(), top) if top else []
+    finally:
+        if started:
+            tracemalloc.stop()
+    return result, Measurement(peak, sites)
+
+
+class RouteMemoryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def add(self, route, measurement):
+        with self._lock:
+            stats = self._routes.setdefault(route, {'requests': 0, 'peak_total': 0, 'peak_max': 0, 'top': []})
+            stats['requests'] += 1
+            stats['peak_total'] += measurement.peak
+            if measurement.peak >= stats['peak_max']:
+                stats['peak_max'] = measurement.peak
+                stats['top'] = measurement.top
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {
+                    'requests': stats['requests'],
+                    'peak_avg': stats['peak_total'] // stats['requests'],
+                    'peak_max': stats['peak_max'],
+                    'top': stats['top'],
+                }
+                for route, stats in sorted(self._routes.items())
+            }
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+memory_stats = RouteMemoryStats()
+
+
+class MemoryProfilerMiddleware:
+    def __init__(self, get_response):
+        config = settings.MEMORY_PROFILING
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.top = config['TOP']
+        self._busy = threading.Lock()
+        # Kept on for the life of the worker, so the first request isn't
+        # charged for starting it
+        tracemalloc.start(config['FRAMES'])
+
+    def __call__(self, request):
+        if not self._busy.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            response, measurement = measure(self.get_response, request, top=self.top)
+        finally:
+            self._busy.release()
+        match = getattr(request, 'resolver_match', None)
+        memory_stats.add(match.url_name if match else None, measurement)
+        response['X-Memory-Peak'] = str(measurement.peak)
+        return response
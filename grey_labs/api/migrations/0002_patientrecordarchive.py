@@ -0,0 +1,33 @@
+# Generated by Django 5.1.15 on 2026-10-19 14:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='created_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='PatientRecordArchive',
+            fields=[
+                ('record_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_date', models.DateTimeField()),
+                ('archived_date', models.DateTimeField(auto_now_add=True)),
+                ('payload', models.BinaryField()),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_patient_records', to='api.department')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_patient_records', to='api.doctor')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_patient_records', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
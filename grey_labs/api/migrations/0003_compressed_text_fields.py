@@ -0,0 +1,39 @@
+# Generated by Django 5.1.15 on 2026-10-19 14:49
+
+import api.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_patientrecordarchive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='department',
+            name='diagnostics',
+            field=api.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='diagnostics',
+            field=api.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='misc',
+            field=api.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='observations',
+            field=api.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='treatments',
+            field=api.fields.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.db import migrations
+
+from api.fields import decompress_text
+
+BATCH_SIZE = 500
+
+COMPRESSED_FIELDS = {
+    'Department': ['diagnostics'],
+    'PatientRecordNew': ['diagnostics', 'observations', 'treatments', 'misc'],
+}
+
+
+def raw_batches(connection, model, fields):
+    """
+    Yield the rows of ``model`` in batches of (pk, *values), as the driver
+    returns them: text for values still stored plain, bytes once encoded.
+    """
+    quote = connection.ops.quote_name
+    pk = quote(model._meta.pk.column)
+    columns = ', '.join(quote(model._meta.get_field(name).column) for name in fields)
+    select = f'SELECT {pk}, {columns} FROM {quote(model._meta.db_table)}'
+    last_pk = None
+    while True:
+        with connection.cursor() as cursor:
+            if last_pk is None:
+                cursor.execute(f'{select} ORDER BY {pk} LIMIT {BATCH_SIZE}')
+            else:
+                cursor.execute(f'{select} WHERE {pk} > %s ORDER BY {pk} LIMIT {BATCH_SIZE}', [last_pk])
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield rows
+
+
+def _text(value):
+    return value if value is None or isinstance(value, str) else decompress_text(value)
+
+
+def compress_existing_text(apps, schema_editor):
+    # Rows written before 0003 still hold plain text; saving them through
+    # CompressedTextField re-encodes them.
+    connection = schema_editor.connection
+    for model_name, fields in COMPRESSED_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        for rows in raw_batches(connection, model, fields):
+            pending = [
+                model(pk=row[0], **{name: _text(value) for name, value in zip(fields, row[1:])})
+                for row in rows if any(isinstance(value, str) for value in row[1:])
+            ]
+            if pending:
+                model.objects.using(connection.alias).bulk_update(pending, fields)
+
+
+def decompress_existing_text(apps, schema_editor):
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    for model_name, fields in COMPRESSED_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        table = quote(model._meta.db_table)
+        assignments = ', '.join(f'{quote(name)} = %s' for name in fields)
+        for rows in raw_batches(connection, model, fields):
+            with connection.cursor() as cursor:
+                for row in rows:
+                    if all(value is None or isinstance(value, str) for value in row[1:]):
+                        continue
+                    cursor.execute(
+                        f'UPDATE {table} SET {assignments} WHERE {quote(model._meta.pk.column)} = %s',
+                        [*(_text(value) for value in row[1:]), row[0]],
+                    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_compressed_text_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_existing_text, decompress_existing_text),
+    ]
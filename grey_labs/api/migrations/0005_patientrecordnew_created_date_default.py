@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-19 14:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_compress_existing_text'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='created_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
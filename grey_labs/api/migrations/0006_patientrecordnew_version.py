@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_patientrecordnew_created_date_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientrecordnew',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
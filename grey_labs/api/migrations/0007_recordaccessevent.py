@@ -0,0 +1,24 @@
+# Generated by Django 5.1.15 on 2026-10-19 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_patientrecordnew_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordAccessEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('record_id', models.IntegerField(db_index=True)),
+                ('user_id', models.IntegerField(null=True)),
+                ('action', models.CharField(choices=[('read', 'Read'), ('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('route', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.1.15 on 2026-10-19 15:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_recordaccessevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepartmentShard',
+            fields=[
+                ('department', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to='api.department')),
+                ('alias', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='doctorpatientrelationship',
+            name='doctor',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='doctor_patient_relationships', to='api.doctor'),
+        ),
+        migrations.AlterField(
+            model_name='doctorpatientrelationship',
+            name='patient',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='doctor_patient_relationships', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='department',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='patient_records_new', to='api.department'),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='doctor',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='patient_records_new', to='api.doctor'),
+        ),
+        migrations.AlterField(
+            model_name='patientrecordnew',
+            name='patient',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='patient_records_new', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.15 on 2026-10-19 15:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_purgerequest'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientRoster',
+            fields=[
+                ('relationship', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='roster', serialize=False, to='api.doctorpatientrelationship')),
+                ('is_primary', models.BooleanField(default=False)),
+                ('username', models.CharField(max_length=150)),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('department', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.department')),
+                ('doctor', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.doctor')),
+                ('patient', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'patient'], name='api_patient_doctor__181252_idx'), models.Index(fields=['department', 'patient'], name='api_patient_departm_906016_idx'), models.Index(fields=['is_primary', 'patient'], name='api_patient_is_prim_6641f0_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('is_primary', True)), fields=('department', 'patient'), name='one_primary_roster_row_per_department')],
+            },
+        ),
+    ]
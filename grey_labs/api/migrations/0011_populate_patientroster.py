@@ -0,0 +1,58 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def populate_roster(apps, schema_editor):
+    # Doctors and users are always on 'default', relationships may be on a
+    # shard. Shards migrated before 'default' can be filled in afterwards
+    # with check_roster --fix.
+    db = schema_editor.connection.alias
+    Doctor = apps.get_model('api', 'Doctor')
+    DoctorPatientRelationship = apps.get_model('api', 'DoctorPatientRelationship')
+    PatientRoster = apps.get_model('api', 'PatientRoster')
+    User = apps.get_model('auth', 'User')
+
+    departments = dict(Doctor.objects.using('default').values_list('pk', 'department_id'))
+    primaries = set()
+    relationships = DoctorPatientRelationship.objects.using(db).order_by('pk').values_list('pk', 'doctor_id', 'patient_id')
+    pending = []
+
+    def flush():
+        users = {pk: (username, email) for pk, username, email in User.objects.using('default').filter(
+            pk__in={patient_id for _, _, patient_id in pending}).values_list('pk', 'username', 'email')}
+        rows = []
+        for pk, doctor_id, patient_id in pending:
+            department_id = departments.get(doctor_id)
+            if department_id is None or patient_id not in users:
+                continue
+            is_primary = (department_id, patient_id) not in primaries
+            primaries.add((department_id, patient_id))
+            username, email = users[patient_id]
+            rows.append(PatientRoster(relationship_id=pk, patient_id=patient_id, doctor_id=doctor_id,
+                                      department_id=department_id, is_primary=is_primary,
+                                      username=username, email=email))
+        PatientRoster.objects.using(db).bulk_create(rows)
+        pending.clear()
+
+    for relationship in relationships.iterator(chunk_size=BATCH_SIZE):
+        pending.append(relationship)
+        if len(pending) >= BATCH_SIZE:
+            flush()
+    if pending:
+        flush()
+
+
+def clear_roster(apps, schema_editor):
+    apps.get_model('api', 'PatientRoster').objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_patientroster'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_roster, clear_roster),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-19 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='headers',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
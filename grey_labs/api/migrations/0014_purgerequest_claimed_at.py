@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-19 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_idempotencyrecord_headers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purgerequest',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
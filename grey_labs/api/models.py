@@ -1,14 +1,12 @@
-from django.db import models
-
-# Create your models here.
-
-
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django.contrib.auth.models import User
+from .fields import CompressedTextField
 
 class Department(models.Model):
     name = models.CharField(max_length=100)
-    diagnostics = models.TextField()
+    diagnostics = CompressedTextField()
     location = models.CharField(max_length=255)
     specialization = models.CharField(max_length=255)
 
@@ -22,23 +20,203 @@ class Doctor(models.Model):
     def __str__(self):
         return f'Dr. {self.user.username} - {self.department.name}'
 
-class PatientRecordNew(models.Model):
+class DepartmentShardedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # QuerySet.create() saves to self.db, which the router can only pick
+        # without the instance; let save() route it by its department.
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+class DepartmentShardedModel(models.Model):
+    """
+    Rows of these models live on the database of their department's shard
+    (see ``api.shards``).  Their foreign keys can point across databases, so
+    they carry no database constraints, and new rows take ids from a shared
+    sequence once sharding is on, so ids stay unique across shards.
+    """
+
+    objects = DepartmentShardedQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.pk is None:
+            from .shards import shard_ids
+            pk = shard_ids.next(type(self))
+            if pk is not None:
+                self.pk = pk
+                kwargs['force_insert'] = True
+        super().save(*args, **kwargs)
+
+class PatientRecordNew(DepartmentShardedModel):
     record_id = models.AutoField(primary_key=True)
-    patient = models.ForeignKey(User, related_name='patient_records_new', on_delete=models.CASCADE)
-    doctor = models.ForeignKey(Doctor, related_name='patient_records_new', on_delete=models.CASCADE)
-    created_date = models.DateTimeField(auto_now_add=True)
-    diagnostics = models.TextField()
-    observations = models.TextField()
-    treatments = models.TextField()
-    department = models.ForeignKey(Department, related_name='patient_records_new', on_delete=models.CASCADE)
-    misc = models.TextField(blank=True, null=True)
+    patient = models.ForeignKey(User, related_name='patient_records_new', on_delete=models.CASCADE, db_constraint=False)
+    doctor = models.ForeignKey(Doctor, related_name='patient_records_new', on_delete=models.CASCADE, db_constraint=False)
+    # Not auto_now_add so that imported historical records keep their dates
+    created_date = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+    diagnostics = CompressedTextField()
+    observations = CompressedTextField()
+    treatments = CompressedTextField()
+    department = models.ForeignKey(Department, related_name='patient_records_new', on_delete=models.CASCADE,
+                                   db_constraint=False)
+    misc = CompressedTextField(blank=True, null=True)
+    # Bumped on every save, so cached renderings can tell they're stale.  Use
+    # F('version') + 1 with update().
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    # Set on records rebuilt from PatientRecordArchive, which are read-only.
+    is_archived = False
 
     def __str__(self):
         return f'Record {self.record_id} for {self.patient.username}'
 
-class DoctorPatientRelationship(models.Model):
-    doctor = models.ForeignKey(Doctor, related_name='doctor_patient_relationships', on_delete=models.CASCADE)
-    patient = models.ForeignKey(User, related_name='doctor_patient_relationships', on_delete=models.CASCADE)
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        # Bumped in the database: two saves of the same loaded version must
+        # not both write version + 1
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        self.version = F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            self.refresh_from_db(using=using, fields=['version'])
+
+class DoctorPatientRelationship(DepartmentShardedModel):
+    # Sharded by the doctor's department
+    doctor = models.ForeignKey(Doctor, related_name='doctor_patient_relationships', on_delete=models.CASCADE,
+                               db_constraint=False)
+    patient = models.ForeignKey(User, related_name='doctor_patient_relationships', on_delete=models.CASCADE,
+                                db_constraint=False)
 
     def __str__(self):
         return f'Doctor {self.doctor.user.username} - Patient {self.patient.username}'
+
+    def save(self, *args, **kwargs):
+        from . import roster
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        # The roster row is written in the same transaction
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            roster.relationship_saved(self, using)
+
+class PatientRecordArchive(models.Model):
+    """
+    Cold copy of a PatientRecordNew that is older than the retention window.
+    The clinical text fields are kept zlib-compressed in ``payload``.
+    """
+    record_id = models.IntegerField(primary_key=True)
+    patient = models.ForeignKey(User, related_name='archived_patient_records', on_delete=models.CASCADE)
+    doctor = models.ForeignKey(Doctor, related_name='archived_patient_records', on_delete=models.CASCADE)
+    department = models.ForeignKey(Department, related_name='archived_patient_records', on_delete=models.CASCADE)
+    created_date = models.DateTimeField()
+    archived_date = models.DateTimeField(auto_now_add=True)
+    payload = models.BinaryField()
+
+    def __str__(self):
+        return f'Archived record {self.record_id}'
+
+class RecordAccessEvent(models.Model):
+    """
+    Audit trail of reads and writes of patient records.  Ids are plain
+    integers so events outlive the records and users they refer to.
+    """
+    READ = 'read'
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = [(READ, 'Read'), (CREATE, 'Create'), (UPDATE, 'Update'), (DELETE, 'Delete')]
+
+    record_id = models.IntegerField(db_index=True)
+    user_id = models.IntegerField(null=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    route = models.CharField(max_length=100)
+    timestamp = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.action} of record {self.record_id} by user {self.user_id}'
+
+class DepartmentShard(models.Model):
+    """Database alias holding a department's sharded rows, if not 'default'."""
+    department = models.OneToOneField(Department, primary_key=True, related_name='shard', on_delete=models.CASCADE)
+    alias = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f'{self.department_id} on {self.alias}'
+
+class IdSequence(models.Model):
+    """Next free primary key of a sharded model, shared by all shards."""
+    name = models.CharField(max_length=100, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.name}: {self.next_value}'
+
+class PurgeRequest(models.Model):
+    """
+    A soft-deleted user waiting for ``manage.py purge_deleted`` to remove
+    them and everything that cascades from them.  Kept once finished.
+    """
+    # No constraint, the row outlives the user
+    user = models.OneToOneField(User, related_name='purge_request', on_delete=models.DO_NOTHING, db_constraint=False)
+    requested_by_id = models.IntegerField(null=True)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True)  # by the purge_deleted run at it, renewed every chunk
+    deleted_rows = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'Purge of user {self.user_id}'
+
+class PatientRoster(models.Model):
+    """
+    Denormalized copy of DoctorPatientRelationship for patient listings,
+    kept on the same shard and written in the same transaction.  One row is
+    marked primary for each patient in each department: their earliest
+    relationship there.  See ``api.roster``.
+    """
+    relationship = models.OneToOneField(DoctorPatientRelationship, primary_key=True, related_name='roster',
+                                        on_delete=models.CASCADE, db_constraint=False)
+    patient = models.ForeignKey(User, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    doctor = models.ForeignKey(Doctor, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    department = models.ForeignKey(Department, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False)
+    is_primary = models.BooleanField(default=False)
+    username = models.CharField(max_length=150)
+    email = models.CharField(max_length=254, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'patient']),
+            models.Index(fields=['department', 'patient']),
+            models.Index(fields=['is_primary', 'patient']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['department', 'patient'], condition=Q(is_primary=True),
+                                    name='one_primary_roster_row_per_department'),
+        ]
+
+    def __str__(self):
+        return f'{self.username} with doctor {self.doctor_id}'
+
+class IdempotencyRecord(models.Model):
+    """
+    Outcome of a POST sent with an Idempotency-Key, replayed to retries
+    until ``expires_at``.  A null ``status`` means it is still running.
+    """
+    key = models.CharField(max_length=64, primary_key=True)  # sha256 of route, caller and key
+    fingerprint = models.CharField(max_length=64)  # sha256 of the request
+    status = models.PositiveSmallIntegerField(null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    headers = models.JSONField(default=list, blank=True)  # [name, value] pairs replayed besides Content-Type
+    body = models.BinaryField(blank=True)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.key} ({self.status or "running"})'
@@ -0,0 +1,170 @@
+"""
+Cache of rendered patient record JSON for patient_record_detail.
+
+Entries hold the rendered bytes together with the record's version and its
+patient and doctor ids, so the permission check can run without loading the
+record.  They live in the Django cache named by ``SHARED_ALIAS``, which every
+worker shares, and in an in-process LRU capped at ``MAX_BYTES`` of rendered
+JSON.  Without ``SHARED_ALIAS`` nothing is cached: a worker can't hear about
+writes made by the others.
+
+Every invalidation also changes the record's stamp in the shared cache.  A
+local entry is only served while the stamp is still the one it was stored
+with, so a write in any worker retires it everywhere.  Invalidation leaves a
+tombstone with the new version too, so a rendering of an older version that
+finishes after the write is never stored.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Tombstones are only needed for the length of a request, keep a bounded number.
+MAX_TOMBSTONES = 10000
+
+# Tombstone version for deleted records, newer than any real version.
+DELETED = 2 ** 63
+
+
+class CachedRecord:
+    __slots__ = ('record_id', 'version', 'patient_id', 'doctor_id', 'body')
+
+    def __init__(self, record_id, version, patient_id, doctor_id, body):
+        self.record_id = record_id
+        self.version = version
+        self.patient_id = patient_id
+        self.doctor_id = doctor_id
+        self.body = body
+
+    def as_tuple(self):
+        return (self.record_id, self.version, self.patient_id, self.doctor_id, self.body)
+
+
+class RecordCache:
+    def __init__(self, max_bytes, shared_alias=None, shared_timeout=None):
+        self.max_bytes = max_bytes
+        self.shared_alias = shared_alias
+        self.shared_timeout = shared_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tombstones = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    @staticmethod
+    def shared_key(record_id):
+        return f'api:record:{record_id}'
+
+    @staticmethod
+    def stamp_key(record_id):
+        return f'api:record-stamp:{record_id}'
+
+    def _stamp(self, record_id):
+        """The record's current stamp, set if it has none (e.g. evicted)."""
+        key = self.stamp_key(record_id)
+        stamp = self.shared.get(key)
+        if stamp is None:
+            self.shared.add(key, uuid.uuid4().hex, None)
+            stamp = self.shared.get(key)
+        return stamp
+
+    def _drop(self, record_id):
+        # Called with the lock held
+        old = self._entries.pop(record_id, None)
+        if old is not None:
+            self._bytes -= len(old[0].body)
+
+    def get(self, record_id):
+        if self.shared is None:
+            return None
+        stamp = self._stamp(record_id)
+        with self._lock:
+            local = self._entries.get(record_id)
+            if local is not None:
+                if local[1] == stamp:
+                    self._entries.move_to_end(record_id)
+                    self.hits += 1
+                    return local[0]
+                # Written in some worker since it was stored
+                self._drop(record_id)
+
+        value = self.shared.get(self.shared_key(record_id))
+        if value is not None and value[0] != 'invalidated':
+            entry = CachedRecord(*value)
+            self._store(entry, stamp)
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, entry):
+        if self.shared is None:
+            return
+        stamp = self._stamp(entry.record_id)
+        if not self._store(entry, stamp):
+            return
+        key = self.shared_key(entry.record_id)
+        current = self.shared.get(key)
+        if current is None or current[1] < entry.version or (current[0] == 'invalidated' and current[1] == entry.version):
+            self.shared.set(key, entry.as_tuple(), self.shared_timeout)
+
+    def _store(self, entry, stamp):
+        size = len(entry.body)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if entry.version < self._tombstones.get(entry.record_id, 0):
+                return False
+            self._drop(entry.record_id)
+            self._entries[entry.record_id] = (entry, stamp)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+        return True
+
+    def invalidate(self, record_id, version=None):
+        """
+        Drop ``record_id``.  If the new ``version`` is known, renderings of
+        anything older are refused from now on.
+        """
+        with self._lock:
+            self._drop(record_id)
+            if version is not None:
+                self._tombstones[record_id] = version
+                self._tombstones.move_to_end(record_id)
+                while len(self._tombstones) > MAX_TOMBSTONES:
+                    self._tombstones.popitem(last=False)
+        if self.shared is not None:
+            # The tombstone first, so a worker that sees the new stamp can't
+            # pick up the old entry
+            self.shared.set(self.shared_key(record_id), ('invalidated', version or 0), self.shared_timeout)
+            self.shared.set(self.stamp_key(record_id), uuid.uuid4().hex, None)
+
+    def clear(self):
+        """Forget every entry and tombstone in this process."""
+        with self._lock:
+            self._entries.clear()
+            self._tombstones.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+record_cache = RecordCache(
+    settings.RECORD_CACHE['MAX_BYTES'],
+    settings.RECORD_CACHE['SHARED_ALIAS'],
+    settings.RECORD_CACHE['SHARED_TIMEOUT'],
+)
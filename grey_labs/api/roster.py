@@ -0,0 +1,188 @@
+"""
+Patient roster: a PatientRoster row per DoctorPatientRelationship, carrying
+the doctor's department and the patient's display fields, so patient
+listings by doctor or department read one index range and never join users
+to relationships.
+
+``DoctorPatientRelationship.save`` writes the row in its own transaction and
+deletes cascade to it.  One row per patient and department is primary, so a
+department listing has each patient once; when the primary row goes, the
+oldest remaining one takes over.  Changes made around the models, e.g. with
+``update()`` or raw SQL, are found and repaired by ``manage.py check_roster``.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Q
+
+from . import shards
+from .models import Doctor, DoctorPatientRelationship, PatientRoster, PurgeRequest
+
+ROSTER_FIELDS = ('patient_id', 'doctor_id', 'department_id', 'username', 'email')
+
+
+def _expected(relationship, department_id, user):
+    username, email = user
+    return dict(patient_id=relationship.patient_id, doctor_id=relationship.doctor_id,
+                department_id=department_id, username=username, email=email)
+
+
+def promote(using, department_id, patient_id):
+    """Make the oldest row of a patient in a department primary, if none is."""
+    rows = PatientRoster.objects.using(using).filter(department_id=department_id, patient_id=patient_id)
+    if not rows.filter(is_primary=True).exists():
+        first = rows.order_by('pk').values_list('pk', flat=True).first()
+        if first is not None:
+            rows.filter(pk=first).update(is_primary=True)
+
+
+def relationship_saved(relationship, using):
+    """Write ``relationship``'s roster row; runs inside its transaction."""
+    old = PatientRoster.objects.using(using).filter(pk=relationship.pk).values_list(
+        'department_id', 'patient_id', 'is_primary').first()
+    user = User.objects.using(shards.DEFAULT).values_list('username', 'email').get(pk=relationship.patient_id)
+    department_id = shards.department_of_doctor(relationship.doctor_id)
+    row = _expected(relationship, department_id, user)
+
+    if old is None:
+        PatientRoster.objects.using(using).create(relationship_id=relationship.pk, **row)
+    else:
+        moved = old[:2] != (department_id, relationship.patient_id)
+        PatientRoster.objects.using(using).filter(pk=relationship.pk).update(
+            is_primary=old[2] and not moved, **row)
+        if moved:
+            promote(using, *old[:2])
+    promote(using, department_id, relationship.patient_id)
+
+
+def relationship_deleted(relationship, using):
+    """The row itself is gone with the cascade, hand primary on if it was."""
+    department_id = shards.department_of_doctor(relationship.doctor_id)
+    if department_id is not None:
+        promote(using, department_id, relationship.patient_id)
+
+
+def patient_changed(user):
+    for alias in shards.all_aliases():
+        PatientRoster.objects.using(alias).filter(patient_id=user.pk).update(username=user.username, email=user.email)
+
+
+def doctor_moved(doctor_id, old_department_id):
+    """Rebuild a doctor's rows after they changed department."""
+    for alias in shards.all_aliases():
+        PatientRoster.objects.using(alias).filter(doctor_id=doctor_id).delete()
+        repair_primaries(alias, old_department_id)
+    for alias in shards.all_aliases():
+        for relationship in DoctorPatientRelationship.objects.using(alias).filter(doctor_id=doctor_id):
+            with transaction.atomic(using=alias):
+                relationship_saved(relationship, alias)
+
+
+def repair_primaries(using, department_id=None, batch_size=1000):
+    """
+    Give every patient and department exactly one primary row.  Returns the
+    number of pairs that needed it.
+    """
+    rows = PatientRoster.objects.using(using)
+    if department_id is not None:
+        rows = rows.filter(department_id=department_id)
+    repaired = 0
+    while True:
+        bad = list(
+            rows.values('department_id', 'patient_id')
+            .annotate(primaries=Count('pk', filter=Q(is_primary=True)))
+            .exclude(primaries=1).values_list('department_id', 'patient_id')[:batch_size]
+        )
+        if not bad:
+            return repaired
+        for pair_department_id, patient_id in bad:
+            with transaction.atomic(using=using):
+                pair = PatientRoster.objects.using(using).filter(department_id=pair_department_id,
+                                                                 patient_id=patient_id)
+                pair.update(is_primary=False)
+                pair.filter(pk=pair.order_by('pk').values_list('pk', flat=True).first()).update(is_primary=True)
+        repaired += len(bad)
+
+
+def check(using, batch_size=1000, fix=False):
+    """
+    Compare the roster on ``using`` with the relationships there.  Returns
+    counts of missing, stale and orphaned rows and of patients without
+    exactly one primary row; with ``fix``, repairs them as well.
+    """
+    doctor_departments = dict(Doctor.objects.using(shards.DEFAULT).values_list('pk', 'department_id'))
+    counts = {'missing': 0, 'stale': 0, 'orphaned': 0, 'primaries': 0}
+
+    last_pk = 0
+    while True:
+        relationships = list(DoctorPatientRelationship.objects.using(using).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not relationships:
+            break
+        last_pk = relationships[-1].pk
+        users = {pk: (username, email) for pk, username, email in User.objects.using(shards.DEFAULT).filter(
+            pk__in={r.patient_id for r in relationships}).values_list('pk', 'username', 'email')}
+        actual = {row[0]: dict(zip(ROSTER_FIELDS, row[1:])) for row in PatientRoster.objects.using(using).filter(
+            pk__in=[r.pk for r in relationships]).values_list('pk', *ROSTER_FIELDS)}
+
+        rebuild = []
+        for relationship in relationships:
+            if relationship.patient_id not in users:
+                continue
+            expected = _expected(relationship, doctor_departments.get(relationship.doctor_id),
+                                 users[relationship.patient_id])
+            if relationship.pk not in actual:
+                counts['missing'] += 1
+            elif actual[relationship.pk] != expected:
+                counts['stale'] += 1
+            else:
+                continue
+            rebuild.append(PatientRoster(relationship_id=relationship.pk, **expected))
+        if fix and rebuild:
+            with transaction.atomic(using=using):
+                # Primaries are settled by repair_primaries below
+                PatientRoster.objects.using(using).filter(pk__in=[row.pk for row in rebuild]).delete()
+                PatientRoster.objects.using(using).bulk_create(rebuild)
+
+    last_pk = 0
+    while True:
+        pks = list(PatientRoster.objects.using(using).filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        orphans = set(pks) - set(DoctorPatientRelationship.objects.using(using).filter(pk__in=pks).values_list('pk', flat=True))
+        counts['orphaned'] += len(orphans)
+        if fix and orphans:
+            PatientRoster.objects.using(using).filter(pk__in=orphans).delete()
+
+    if fix:
+        counts['primaries'] = repair_primaries(using, batch_size=batch_size)
+    else:
+        counts['primaries'] = (
+            PatientRoster.objects.using(using).values('department_id', 'patient_id')
+            .annotate(primaries=Count('pk', filter=Q(is_primary=True))).exclude(primaries=1).count()
+        )
+    return counts
+
+
+def _listed(rows):
+    # Users waiting to be purged are not listed
+    pending = set(PurgeRequest.objects.filter(finished_at__isnull=True).values_list('user_id', flat=True))
+    seen = set()
+    for patient_id, username, email in rows:
+        if patient_id not in seen and patient_id not in pending:
+            seen.add(patient_id)
+            yield {'id': patient_id, 'username': username, 'email': email}
+
+
+def patients_of_doctor(doctor_id):
+    rows = shards.for_doctor(PatientRoster, doctor_id).filter(doctor_id=doctor_id).order_by('patient_id')
+    return list(_listed(rows.values_list('patient_id', 'username', 'email')))
+
+
+def all_patients():
+    rows = []
+    for alias in shards.all_aliases():
+        rows.extend(PatientRoster.objects.using(alias).filter(is_primary=True).order_by('patient_id')
+                    .values_list('patient_id', 'username', 'email'))
+    if len(shards.all_aliases()) > 1:
+        rows.sort()
+    return list(_listed(rows))
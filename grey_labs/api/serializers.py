@@ -1,7 +1,7 @@
-
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from .models import Doctor, DoctorPatientRelationship, Department,PatientRecordNew
+from .lookups import group_id
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
@@ -24,8 +24,8 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         )
         
         # Add the user to the appropriate group
-        group, created = Group.objects.get_or_create(name=group_name)
-        user.groups.add(group)
+        # Group ids are kept in memory, see api.lookups
+        user.groups.add(group_id(group_name))
 
         if group_name == 'Doctors':
             # If the user is a doctor, ensure a department is provided and create a Doctor record
@@ -50,33 +50,6 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             )
         return user
 
-# from rest_framework import serializers
-# from django.contrib.auth.models import User
-# from .models import Doctor
-
-# class DoctorSerializer(serializers.ModelSerializer):
-#     username = serializers.CharField(source='user.username')
-#     email = serializers.EmailField(source='user.email')
-#     password = serializers.CharField(write_only=True, source='user.password')
-
-#     class Meta:
-#         model = Doctor
-#         fields = ('id', 'username', 'email', 'password', 'department')
-
-#     def create(self, validated_data):
-#         user_data = validated_data.pop('user')
-#         password = user_data.pop('password')
-#         user = User.objects.create_user(
-#             username=user_data['username'],
-#             email=user_data['email'],
-#             password=password
-#         )
-#         doctor = Doctor.objects.create(user=user, department=validated_data['department'])
-#         return doctor
-# from rest_framework import serializers
-from django.contrib.auth.models import User
-from .models import Doctor
-
 class DoctorSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username')
     email = serializers.EmailField(source='user.email')
@@ -118,9 +91,6 @@ class DoctorSerializer(serializers.ModelSerializer):
         return instance
 
 
-from rest_framework import serializers
-from django.contrib.auth.models import User
-
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=False)
 
@@ -155,18 +125,12 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
-from rest_framework import serializers
-from .models import PatientRecordNew
-
 class PatientRecordNewSerializer(serializers.ModelSerializer):
     class Meta:
         model = PatientRecordNew
         fields = ['record_id', 'patient', 'created_date', 'diagnostics', 'observations', 'treatments', 'misc', 'doctor', 'department']
         read_only_fields = ['record_id', 'created_date', 'doctor', 'department']
 
-from rest_framework import serializers
-from .models import Department
-
 class DepartmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Department
@@ -0,0 +1,351 @@
+"""
+Optional sharding of department data across database aliases.
+
+PatientRecordNew and PatientRoster rows live on the shard of their
+department, and DoctorPatientRelationship rows on the shard of their
+doctor's department.
+The shard map is the DepartmentShard table on 'default'; departments that
+aren't in it stay on 'default'.  Everything else always lives on 'default'.
+With ``DATABASE_SHARDS['ALIASES']`` empty, the router stays out of the way
+and nothing here touches the database.
+
+Every alias carries the full schema, so migrations run unchanged with
+``migrate --database=<alias>``.  Ids of sharded rows come from IdSequence on
+'default' in blocks of ``ID_BLOCK_SIZE``, so they stay unique across shards
+and rows can move between shards with their ids.
+
+A worker reloads the map when the generation counter in the shared cache
+changes, checked at most every ``CHECK_INTERVAL`` seconds, as with the
+access index.  Moving a department relies on that, so it needs a cache
+shared by every worker.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Max
+
+from .access import access_index, bump_generation, current_generation, generations_shared
+from .models import (
+    Department, DepartmentShard, Doctor, DoctorPatientRelationship, IdSequence, PatientRecordNew, PatientRoster,
+)
+
+DEFAULT = 'default'
+GENERATION_KEY = 'api:shard-map:generation'
+SHARDED_MODELS = (PatientRecordNew, DoctorPatientRelationship, PatientRoster)
+
+
+def shard_aliases():
+    """Aliases besides 'default' that can hold departments."""
+    return [alias for alias in settings.DATABASE_SHARDS['ALIASES'] if alias != DEFAULT]
+
+
+def all_aliases():
+    return [DEFAULT, *shard_aliases()]
+
+
+class ShardMap:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aliases = None  # department id -> alias
+        self._generation = None
+        self._checked_at = 0.0
+
+    def load(self):
+        generation = current_generation(GENERATION_KEY)
+        aliases = dict(DepartmentShard.objects.using(DEFAULT).values_list('department_id', 'alias'))
+        with self._lock:
+            self._aliases = aliases
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        return aliases
+
+    def _fresh(self):
+        aliases = self._aliases
+        now = time.monotonic()
+        if aliases is not None and now - self._checked_at < settings.DATABASE_SHARDS['CHECK_INTERVAL']:
+            return aliases
+        if aliases is None or current_generation(GENERATION_KEY) != self._generation:
+            aliases = self.load()
+        else:
+            self._checked_at = now
+        return aliases
+
+    def alias_for(self, department_id):
+        if not shard_aliases():
+            return DEFAULT
+        return self._fresh().get(department_id, DEFAULT)
+
+    def assign(self, department_id, alias):
+        if alias == DEFAULT:
+            DepartmentShard.objects.using(DEFAULT).filter(department_id=department_id).delete()
+        else:
+            DepartmentShard.objects.using(DEFAULT).update_or_create(department_id=department_id,
+                                                                     defaults={'alias': alias})
+        bump_generation(GENERATION_KEY)
+        self.load()
+
+    def invalidate(self):
+        with self._lock:
+            self._aliases = None
+
+
+shard_map = ShardMap()
+
+
+class ShardIds:
+    """Hands out primary keys for sharded models, reserving them in blocks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}  # model label -> (next id, end of block)
+
+    def next(self, model):
+        """The next id for a new ``model`` row, or None when sharding is off."""
+        if not shard_aliases():
+            return None
+        label = model._meta.label
+        with self._lock:
+            next_id, end = self._blocks.get(label, (0, 0))
+            if next_id >= end:
+                next_id, end = self.reserve(model, settings.DATABASE_SHARDS['ID_BLOCK_SIZE'])
+            self._blocks[label] = (next_id + 1, end)
+            return next_id
+
+    def reserve(self, model, count):
+        """Reserve ``count`` ids for ``model``; returns the (start, end) range."""
+        label = model._meta.label
+        with transaction.atomic(using=DEFAULT):
+            # The UPDATE takes the row lock before the value is read
+            if not IdSequence.objects.using(DEFAULT).filter(name=label).update(next_value=F('next_value') + count):
+                highest = max(model._base_manager.using(alias).aggregate(highest=Max('pk'))['highest'] or 0
+                              for alias in all_aliases())
+                IdSequence.objects.using(DEFAULT).get_or_create(name=label, defaults={'next_value': highest + 1})
+                IdSequence.objects.using(DEFAULT).filter(name=label).update(next_value=F('next_value') + count)
+            end = IdSequence.objects.using(DEFAULT).values_list('next_value', flat=True).get(name=label)
+        return end - count, end
+
+
+shard_ids = ShardIds()
+
+
+def department_of(instance):
+    if isinstance(instance, (PatientRecordNew, PatientRoster)):
+        return instance.department_id
+    if isinstance(instance, DoctorPatientRelationship):
+        return department_of_doctor(instance.doctor_id)
+    if isinstance(instance, Department):
+        return instance.pk
+    if isinstance(instance, Doctor):
+        return instance.department_id
+    return None
+
+
+def department_of_doctor(doctor_id):
+    department_id = access_index.department_for_doctor(doctor_id)
+    if department_id is None:
+        # Not in the index yet, e.g. created earlier in this transaction
+        department_id = Doctor.objects.using(DEFAULT).filter(pk=doctor_id).values_list(
+            'department_id', flat=True).first()
+    return department_id
+
+
+def for_department(model, department_id):
+    """``model``'s default manager on the shard of ``department_id``."""
+    return model.objects.using(shard_map.alias_for(department_id))
+
+
+def for_doctor(model, doctor_id):
+    if not shard_aliases():
+        return model.objects.using(DEFAULT)
+    return for_department(model, department_of_doctor(doctor_id))
+
+
+def get(model, **lookup):
+    """Look a row up on every alias, for when its department isn't known."""
+    for alias in all_aliases():
+        try:
+            return model.objects.using(alias).get(**lookup)
+        except model.DoesNotExist:
+            pass
+    raise model.DoesNotExist(f'{model._meta.object_name} matching {lookup} not found')
+
+
+def delete_everywhere(model, **lookup):
+    """
+    Delete matching rows on the shards.  Cascades from models on 'default'
+    only reach rows on 'default'.
+    """
+    for alias in shard_aliases():
+        model.objects.using(alias).filter(**lookup).delete()
+
+
+class DepartmentShardRouter:
+    """Sends sharded models to their department's shard and the rest to 'default'."""
+
+    def _db(self, model, hints):
+        if not shard_aliases():
+            return None
+        if model not in SHARDED_MODELS:
+            return DEFAULT
+        department_id = department_of(hints.get('instance'))
+        if department_id is None:
+            return None
+        return shard_map.alias_for(department_id)
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, SHARDED_MODELS) or isinstance(obj2, SHARDED_MODELS):
+            return True
+        return None
+
+
+# Rebalancing
+
+def _department_filters(department_id):
+    doctor_ids = list(Doctor.objects.using(DEFAULT).filter(department_id=department_id).values_list('pk', flat=True))
+    return [
+        (PatientRecordNew, {'department_id': department_id}),
+        (DoctorPatientRelationship, {'doctor_id__in': doctor_ids}),
+        (PatientRoster, {'department_id': department_id}),
+    ]
+
+
+def _has_version(model):
+    return any(f.name == 'version' for f in model._meta.concrete_fields)
+
+
+def _versions(model, alias, **lookup):
+    fields = ['pk', 'version'] if _has_version(model) else ['pk']
+    rows = model._base_manager.using(alias).filter(**lookup).values_list(*fields)
+    return {row[0]: row[-1] if len(fields) == 2 else 0 for row in rows}
+
+
+def copy_rows(model, lookup, source, target, batch_size):
+    """
+    Bring ``target`` up to date with the matching rows on ``source``: copy
+    rows that are missing, at an older version or, for models without a
+    version, different, and drop rows that are gone from ``source``.  Yields
+    the number of rows written after each batch.
+    """
+    manager = model._base_manager
+    fields = [f.name for f in model._meta.concrete_fields if not f.primary_key]
+    attnames = [f.attname for f in model._meta.concrete_fields if not f.primary_key]
+    versioned = _has_version(model)
+    last_pk = None
+    while True:
+        batch = manager.using(source).filter(**lookup).order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        pks = [obj.pk for obj in batch]
+        if versioned:
+            current = _versions(model, target, pk__in=pks)
+            stale = [obj for obj in batch if current.get(obj.pk, -1) < obj.version]
+        else:
+            current = {row[0]: row[1:] for row in manager.using(target).filter(pk__in=pks).values_list('pk', *attnames)}
+            stale = [obj for obj in batch if current.get(obj.pk) != tuple(getattr(obj, name) for name in attnames)]
+        if stale:
+            manager.using(target).bulk_create(stale, update_conflicts=True,
+                                              unique_fields=[model._meta.pk.name], update_fields=fields)
+        yield len(stale)
+
+    gone = set(_versions(model, target, **lookup)) - set(_versions(model, source, **lookup))
+    if gone:
+        raw_delete(model, target, sorted(gone), batch_size)
+
+
+def raw_delete(model, alias, pks, batch_size):
+    """
+    DELETE without signals: the rows still exist on another shard, so the
+    record cache and access index must not hear about it.
+    """
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    for start in range(0, len(pks), batch_size):
+        chunk = pks[start:start + batch_size]
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE {} IN ({})'.format(
+                    quote(model._meta.db_table), quote(model._meta.pk.column), ', '.join(['%s'] * len(chunk))),
+                chunk,
+            )
+
+
+def move_department(department_id, target, batch_size, progress=None):
+    """
+    Move a department's rows to ``target``.  Rows are copied in batches while
+    the department stays readable and writable on its old shard, then the
+    map is switched.  After ``MOVE_GRACE_SECONDS``, or ``CHECK_INTERVAL`` if
+    longer, every worker uses the new map and requests that started on the
+    old one have finished; writes made meanwhile are copied over until a
+    pass finds none, and the old rows are deleted.  ``progress`` is called
+    with (phase, model, rows).
+    """
+    if target not in all_aliases():
+        raise ValueError(f'{target!r} is not in DATABASE_SHARDS')
+    if not generations_shared():
+        raise ValueError('Moving a department needs a cache shared by every worker, '
+                         'see CACHES in settings')
+    source = shard_map.alias_for(department_id)
+    if source == target:
+        return
+    filters = _department_filters(department_id)
+
+    for model, lookup in filters:
+        for written in copy_rows(model, lookup, source, target, batch_size):
+            if progress:
+                progress('copy', model, written)
+
+    shard_map.assign(department_id, target)
+    config = settings.DATABASE_SHARDS
+    time.sleep(max(config['CHECK_INTERVAL'], config['MOVE_GRACE_SECONDS']))
+
+    for model, lookup in filters:
+        while True:
+            total = 0
+            for written in copy_rows(model, lookup, source, target, batch_size):
+                total += written
+                if progress:
+                    progress('catch-up', model, written)
+            if not total:
+                break
+        pks = sorted(_versions(model, source, **lookup))
+        raw_delete(model, source, pks, batch_size)
+        if progress:
+            progress('delete', model, len(pks))
+
+
+def rehome(model, alias, pks, batch_size=500):
+    """
+    Move rows of ``model`` on ``alias`` whose department now maps to another
+    shard, e.g. after their department was changed with ``update()``.
+    """
+    if not shard_aliases():
+        return
+    by_target = {}
+    for obj in model._base_manager.using(alias).filter(pk__in=pks):
+        target = shard_map.alias_for(department_of(obj))
+        if target != alias:
+            by_target.setdefault(target, []).append(obj.pk)
+    for target, moved in by_target.items():
+        for _ in copy_rows(model, {'pk__in': moved}, alias, target, batch_size):
+            pass
+        raw_delete(model, alias, moved, batch_size)
+
+
+def row_counts():
+    """{alias: {model name: rows}} for every alias."""
+    return {
+        alias: {model._meta.object_name: model._base_manager.using(alias).count() for model in SHARDED_MODELS}
+        for alias in all_aliases()
+    }
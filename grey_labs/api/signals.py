@@ -0,0 +1,105 @@
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import roster, shards
+from .access import access_index
+from .lookups import departments, group_ids
+from .models import Department, Doctor, DoctorPatientRelationship, PatientRecordNew
+from .record_cache import DELETED, record_cache
+
+# Index updates wait for the commit, so a rolled back write never grants
+# access and other workers don't reload before the row is visible.
+
+
+@receiver(post_save, sender=DoctorPatientRelationship)
+def relationship_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: access_index.add_relationship(instance.doctor_id, instance.patient_id))
+    else:
+        # The old doctor/patient pair isn't known here
+        transaction.on_commit(access_index.invalidate)
+
+
+@receiver(post_delete, sender=DoctorPatientRelationship)
+def relationship_deleted(sender, instance, using, **kwargs):
+    # Inside the delete's transaction, like the roster write on save
+    roster.relationship_deleted(instance, using)
+    transaction.on_commit(lambda: access_index.remove_relationship(instance.doctor_id, instance.patient_id))
+
+
+@receiver(pre_save, sender=Doctor)
+def doctor_saving(sender, instance, using, **kwargs):
+    # The department as stored.  Not from the index: a worker that reloads it
+    # during the save already reads the new department there.
+    instance._stored_department_id = None if instance.pk is None else Doctor.objects.using(using).filter(
+        pk=instance.pk).values_list('department_id', flat=True).first()
+
+
+@receiver(post_save, sender=Doctor)
+def doctor_saved(sender, instance, created, **kwargs):
+    old_department = None if created else instance.__dict__.pop('_stored_department_id', None)
+
+    def update():
+        old_alias = shards.shard_map.alias_for(old_department)
+        access_index.set_doctor(instance.pk, instance.user_id, instance.department_id)
+        if old_department is not None and old_alias != shards.shard_map.alias_for(instance.department_id):
+            # Relationships follow the doctor to the new department's shard
+            pks = list(DoctorPatientRelationship.objects.using(old_alias).filter(
+                doctor_id=instance.pk).values_list('pk', flat=True))
+            shards.rehome(DoctorPatientRelationship, old_alias, pks)
+        if old_department is not None and old_department != instance.department_id:
+            roster.doctor_moved(instance.pk, old_department)
+
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=Doctor)
+def doctor_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: access_index.remove_doctor(instance.pk))
+    transaction.on_commit(lambda: shards.delete_everywhere(DoctorPatientRelationship, doctor_id=instance.pk))
+    transaction.on_commit(lambda: shards.delete_everywhere(PatientRecordNew, doctor_id=instance.pk))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not {'username', 'email'} & set(update_fields)):
+        return
+    roster.patient_changed(instance)
+
+
+# Cascades only reach rows on the same database, clear the shards after them
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: shards.delete_everywhere(DoctorPatientRelationship, patient_id=instance.pk))
+    transaction.on_commit(lambda: shards.delete_everywhere(PatientRecordNew, patient_id=instance.pk))
+
+
+@receiver(post_delete, sender=Department)
+def department_deleted(sender, instance, **kwargs):
+    transaction.on_commit(departments.changed)
+    transaction.on_commit(lambda: shards.delete_everywhere(PatientRecordNew, department_id=instance.pk))
+
+
+@receiver(post_save, sender=Department)
+def department_saved(sender, instance, **kwargs):
+    transaction.on_commit(departments.changed)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    transaction.on_commit(group_ids.changed)
+
+
+@receiver(post_save, sender=PatientRecordNew)
+def record_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: record_cache.invalidate(instance.pk, instance.version))
+
+
+@receiver(post_delete, sender=PatientRecordNew)
+def record_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: record_cache.invalidate(instance.pk, DELETED))
@@ -0,0 +1,72 @@
+"""
+Helpers for measuring how expensive it is to start a worker.
+
+Everything runs in a fresh interpreter so the numbers reflect a cold start
+and not whatever the current process has already imported.
+"""
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+
+# What a worker does before it can serve its first request: build the WSGI
+# application, which sets Django up and loads the middleware, then load the
+# URLconf.
+COLD_START_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+import {target}
+print(time.perf_counter() - start)
+print(' '.join(sys.modules))
+"""
+
+
+def _run(target, *python_args):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'grey_labs.settings'))
+    return subprocess.run(
+        [sys.executable, *python_args, '-c', COLD_START_SCRIPT.format(target=target)],
+        cwd=settings.BASE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def _cold_start(target):
+    seconds, modules = _run(target or settings.ROOT_URLCONF).stdout.splitlines()[-2:]
+    return float(seconds), modules.split()
+
+
+def cold_start(target=None):
+    """
+    Return ``(seconds, module_count)`` for building the WSGI application and
+    importing ``target`` (the root URLconf by default) in a new interpreter.
+    """
+    seconds, modules = _cold_start(target)
+    return seconds, len(modules)
+
+
+def loaded_modules(target=None):
+    """The names of the modules loaded by the cold start of ``cold_start``."""
+    return set(_cold_start(target)[1])
+
+
+def import_times(target=None):
+    """
+    Return ``[(module, self_us, cumulative_us), ...]`` from ``python -X importtime``
+    for a cold start that imports ``target``.  Modules loaded through
+    ``importlib.import_module``, as Django loads apps and middleware, are
+    missing: only import statements are timed.
+    """
+    result = _run(target or settings.ROOT_URLCONF, '-X', 'importtime')
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        rows.append((module.strip(), int(self_us), int(cumulative_us)))
+    return rows
@@ -0,0 +1,271 @@
+"""
+Statement time budgets and the slow query log.
+
+StatementBudgetMiddleware gives a request the budget of its route from
+``STATEMENT_BUDGETS['ROUTES']``, or ``DEFAULT_SECONDS``, and ``enforce_budget``,
+an execute wrapper on every connection, stops any single statement that runs
+longer.  How a statement is stopped depends on the database and is looked up
+in ``INTERRUPTERS`` by vendor: on SQLite a progress handler interrupts it, on
+PostgreSQL and MySQL the session's statement timeout is set.  A stopped
+statement raises StatementTimeout and the request gets a 503.  On SQLite only
+the work done before the first row comes back is covered, which is where a
+sort or a scan spends its time.
+
+Statements slower than ``SLOW_QUERY_SECONDS``, with or without a budget, and
+those that were stopped go to ``slow_query_log``, grouped by their SQL with
+literals and parameters taken out.  The first of each is logged with its plan
+from EXPLAIN (EXPLAIN QUERY PLAN on SQLite); later ones are only counted.
+They are listed at /api/metrics/slow-queries/.
+"""
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, OperationalError
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Longest SQL kept as an example of a slow query
+MAX_SQL_LENGTH = 2000
+
+# SQLite virtual machine instructions between checks of the deadline
+SQLITE_PROGRESS_STEPS = 1000
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+# (route, seconds) of the current request
+_budget = ContextVar('api_statement_budget', default=(None, None))
+_explaining = ContextVar('api_statement_explaining', default=False)
+
+
+class StatementTimeout(OperationalError):
+    pass
+
+
+# Interrupters: context managers that stop a statement after ``seconds``, or
+# lift the limit when ``seconds`` is None.
+
+@contextmanager
+def sqlite_interrupt(connection, seconds):
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    raw = connection.connection
+    raw.set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        raw.set_progress_handler(None, 0)
+
+
+def session_timeout(statement):
+    """
+    An interrupter that sets a session variable to the budget in
+    milliseconds, 0 meaning none.  It is only set again when it changes.
+    """
+    @contextmanager
+    def interrupter(connection, seconds):
+        milliseconds = 0 if seconds is None else max(1, int(seconds * 1000))
+        raw = connection.connection
+        if getattr(connection, '_statement_budget', (id(raw), 0)) != (id(raw), milliseconds):
+            cursor = raw.cursor()
+            try:
+                cursor.execute(statement % milliseconds)
+            finally:
+                cursor.close()
+            connection._statement_budget = (id(raw), milliseconds)
+        yield
+
+    return interrupter
+
+
+postgresql_timeout = session_timeout('SET statement_timeout = %d')
+mysql_timeout = session_timeout('SET SESSION max_execution_time = %d')
+
+
+@contextmanager
+def _no_interrupt(connection, seconds):
+    yield
+
+
+_interrupters = {}
+
+
+def interrupter_for(vendor):
+    interrupter = _interrupters.get(vendor)
+    if interrupter is None:
+        path = settings.STATEMENT_BUDGETS['INTERRUPTERS'].get(vendor)
+        interrupter = _interrupters[vendor] = import_string(path) if path else _no_interrupt
+    return interrupter
+
+
+# Slow query log
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """``sql`` with literals and parameters as ``?`` and IN lists as ``(...)``."""
+    sql = _NUMBERS.sub('?', _STRINGS.sub('?', sql)).replace('%s', '?')
+    return _SPACES.sub(' ', _LISTS.sub('(...)', sql)).strip()
+
+
+def explain(connection, sql, params):
+    """The plan of ``sql`` as a list of lines, or None if it can't be explained."""
+    prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+    if prefix is None or params is None or sql.lstrip()[:6].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+        return None
+    token = _explaining.set(True)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+    except DatabaseError as exc:
+        return [f'EXPLAIN failed: {exc}']
+    finally:
+        _explaining.reset(token)
+    if connection.vendor == 'mysql':
+        return [' | '.join(str(value) for value in row) for row in rows]
+    # SQLite's detail and PostgreSQL's plan line are the last column
+    return [str(row[-1]) for row in rows]
+
+
+class SlowQueryLog:
+    def __init__(self, threshold, max_entries):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # normalized sql -> entry
+
+    def add(self, connection, sql, params, seconds, route, timed_out=False):
+        key = normalize(sql)
+        now = datetime.now(timezone.utc).isoformat()
+        milliseconds = seconds * 1000
+        with self._lock:
+            entry = self._entries.get(key)
+            first = entry is None
+            if first:
+                if len(self._entries) >= self.max_entries:
+                    self.dropped += 1
+                    return
+                entry = self._entries[key] = {
+                    'sql': key, 'example': sql[:MAX_SQL_LENGTH], 'alias': connection.alias,
+                    'count': 0, 'timeouts': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'routes': [], 'plan': None, 'first_seen': now,
+                }
+            entry['count'] += 1
+            entry['timeouts'] += timed_out
+            entry['total_ms'] += milliseconds
+            entry['max_ms'] = max(entry['max_ms'], milliseconds)
+            entry['last_seen'] = now
+            if route not in entry['routes']:
+                entry['routes'].append(route)
+        if first:
+            entry['plan'] = explain(connection, sql, params)
+            logger.warning('Slow query, %.0f ms on %s for %s%s: %s\n%s', milliseconds, connection.alias, route,
+                           ' (timed out)' if timed_out else '', entry['example'], '\n'.join(entry['plan'] or []))
+
+    def entries(self, limit=None):
+        with self._lock:
+            entries = sorted((dict(entry, routes=list(entry['routes'])) for entry in self._entries.values()),
+                             key=lambda entry: entry['total_ms'], reverse=True)
+        return entries[:limit] if limit else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.dropped = 0
+
+
+slow_query_log = SlowQueryLog(settings.STATEMENT_BUDGETS['SLOW_QUERY_SECONDS'],
+                              settings.STATEMENT_BUDGETS['MAX_SLOW_QUERIES'])
+
+
+def enforce_budget(execute, sql, params, many, context):
+    if _explaining.get():
+        return execute(sql, params, many, context)
+    connection = context['connection']
+    route, budget = _budget.get()
+    timed_out = False
+    start = time.perf_counter()
+    try:
+        with interrupter_for(connection.vendor)(connection, budget):
+            return execute(sql, params, many, context)
+    except DatabaseError as exc:
+        timed_out = budget is not None and time.perf_counter() - start >= budget
+        if timed_out:
+            raise StatementTimeout(f'Statement ran over the {budget}s budget of {route}') from exc
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if timed_out or seconds >= slow_query_log.threshold:
+            slow_query_log.add(connection, sql, None if many else params, seconds, route, timed_out)
+
+
+def _add_wrapper(connection, **kwargs):
+    if enforce_budget not in connection.execute_wrappers:
+        connection.execute_wrappers.append(enforce_budget)
+
+
+def install():
+    """Add ``enforce_budget`` to every database connection."""
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+
+    connection_created.connect(_add_wrapper, dispatch_uid='api.statements')
+    for connection in connections.all(initialized_only=True):
+        _add_wrapper(connection)
+
+
+class StatementBudgetMiddleware:
+    def __init__(self, get_response):
+        config = settings.STATEMENT_BUDGETS
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.routes = config['ROUTES']
+        self.default = config['DEFAULT_SECONDS']
+        self.retry_after = config['RETRY_AFTER']
+
+    def budget_for(self, request):
+        try:
+            name = resolve(request.path_info).url_name
+        except Resolver404:
+            return None, self.default
+        for key in (f'{name}:{request.method}', name):
+            if key in self.routes:
+                return name, self.routes[key]
+        return name, self.default
+
+    def __call__(self, request):
+        token = _budget.set(self.budget_for(request))
+        try:
+            return self.get_response(request)
+        finally:
+            _budget.reset(token)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, StatementTimeout):
+            logger.warning('%s %s: %s', request.method, request.path, exception)
+            response = JsonResponse({'detail': 'The request took too long, please retry later.'}, status=503)
+            response['Retry-After'] = str(self.retry_after)
+            return response
+        return None
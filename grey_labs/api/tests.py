@@ -1,3 +1,1287 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import Group, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, router, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import get_resolver
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import archive, roster, statements
+from .access import AccessIndex, access_index
+from .admin import EstimatedCountPaginator
+from .admission import AdmissionControlMiddleware, AdmissionController, RouteClass
+from .checks import check_shared_cache
+from .deletion import purge, soft_delete
+from .audit import AuditLog, DatabaseSink, FileSink, audit_log, get_sink
+from .idempotency import IdempotencyMiddleware
+from .lazy import LazyView
+from .lookups import CachedTable, departments
+from .memory import measure, memory_stats
+from .models import (
+    Department, DepartmentShard, Doctor, DoctorPatientRelationship, IdempotencyRecord, IdSequence,
+    PatientRecordArchive, PatientRecordNew, PatientRoster, PurgeRequest, RecordAccessEvent,
+)
+from .record_cache import CachedRecord, RecordCache, record_cache
+from .shards import move_department, rehome, shard_ids, shard_map
+from .statements import SlowQueryLog, StatementBudgetMiddleware, StatementTimeout, _budget, normalize, slow_query_log
+from .startup import cold_start, loaded_modules
+from .tracing import TraceBuffer, TracingMiddleware, span
+
+# Cold start budget for a worker: get_wsgi_application(), which sets Django
+# up and loads the middleware, plus the root URLconf.
+COLD_START_BUDGET_SECONDS = 1.5
+COLD_START_MODULE_BUDGET = 700
+
+# Peak allocation budget of a list request: a fixed allowance plus so much
+# per row listed.
+MEMORY_BUDGET_ROWS = 500
+MEMORY_BUDGET_BASE_BYTES = 512 * 1024
+RECORD_LIST_BYTES_PER_ROW = 6 * 1024
+PATIENT_LIST_BYTES_PER_ROW = 1536
+
+
+def file_cache(location):
+    return {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}
+
+
+def setUpModule():
+    # Generation counters and cached records never go to the cache in settings
+    directory = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(directory.cleanup)
+    caches_override = override_settings(CACHES=file_cache(directory.name))
+    caches_override.enable()
+    unittest.addModuleCleanup(caches_override.disable)
+
+
+class StartupBudgetTests(SimpleTestCase):
+    def test_cold_start_within_budget(self):
+        seconds, modules = cold_start()
+        self.assertLess(seconds, COLD_START_BUDGET_SECONDS)
+        self.assertLess(modules, COLD_START_MODULE_BUDGET)
+
+    def test_urlconf_does_not_import_views(self):
+        modules = loaded_modules()
+        self.assertIn('api.lazy', modules)
+        # The middleware is part of the cold start
+        self.assertIn('api.idempotency', modules)
+        self.assertFalse({m for m in modules if m.startswith(('api.views', 'api.serializers'))})
+
+
+class LazyViewTests(SimpleTestCase):
+    def test_every_route_resolves(self):
+        for pattern in get_resolver('api.urls').url_patterns:
+            self.assertIsInstance(pattern.callback, LazyView)
+            self.assertTrue(callable(pattern.callback.resolve()))
+
+
+def audit_to_files(test):
+    # The audit flush thread can't write to the test database while a test
+    # holds it, so audit events go to files instead.
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    patcher = mock.patch.object(audit_log, 'sink', FileSink(directory.name, 1024 * 1024))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    test.addCleanup(audit_log.flush)
+
+
+
+class AuditLogTests(TestCase):
+    def audit_log(self, sink, batch_size=100, flush_interval=60.0, max_buffer=1000):
+        log = AuditLog(sink, batch_size, flush_interval, max_buffer)
+        self.addCleanup(log.close)
+        return log
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'timed out')
+            time.sleep(0.005)
+
+    def events(self, sink):
+        return [event for call in sink.write.call_args_list for event in call.args[0]]
+
+    def test_flushed_when_batch_is_full(self):
+        sink = mock.Mock()
+        log = self.audit_log(sink, batch_size=3)
+        log.record(RecordAccessEvent.READ, [1, 2], 7, 'patient-record-detail')
+        log.record(RecordAccessEvent.READ, [3], 7, 'patient-record-detail')
+        self.wait_for(lambda: sink.write.called)
+        self.assertEqual([event[:4] for event in self.events(sink)],
+                         [(record_id, 7, RecordAccessEvent.READ, 'patient-record-detail') for record_id in (1, 2, 3)])
+
+    def test_flushed_after_interval(self):
+        sink = mock.Mock()
+        log = self.audit_log(sink, flush_interval=0.05)
+        log.record(RecordAccessEvent.UPDATE, [1], 7, 'patient-record-detail')
+        self.wait_for(lambda: sink.write.called)
+        self.assertEqual(log.stats(), {'buffered': 0, 'dropped': 0})
+
+    def test_failed_batch_requeued_within_max_buffer(self):
+        sink = mock.Mock()
+        log = self.audit_log(sink, max_buffer=3)
+        log.record(RecordAccessEvent.READ, [1, 2], 7, 'route')
+
+        def fail(events):
+            # Recorded while the batch was being written
+            log.record(RecordAccessEvent.READ, [3, 4], 7, 'route')
+            raise OSError('disk full')
+
+        sink.write.side_effect = fail
+        with self.assertLogs('api.audit', 'ERROR'):
+            self.assertEqual(log.flush(), 0)
+        self.assertEqual(log.stats(), {'buffered': 3, 'dropped': 1})
+        # Past MAX_BUFFER new events are dropped too
+        log.record(RecordAccessEvent.READ, [5], 7, 'route')
+        self.assertEqual(log.stats(), {'buffered': 3, 'dropped': 2})
+        sink.write.side_effect = None
+        self.assertEqual(log.flush(), 3)
+        self.assertEqual([event[0] for event in self.events(sink)[-3:]], [1, 3, 4])
+
+    def test_sinks(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.assertIsInstance(get_sink({**settings.AUDIT_LOG, 'BACKEND': 'db'}), DatabaseSink)
+        file_sink = get_sink({**settings.AUDIT_LOG, 'BACKEND': 'file', 'DIRECTORY': directory.name})
+        self.assertIsInstance(file_sink, FileSink)
+        self.addCleanup(file_sink.close)
+        now = timezone.now()
+        events = [(1, 7, RecordAccessEvent.READ, 'route', now), (2, None, RecordAccessEvent.DELETE, 'route', now)]
+
+        with mock.patch('api.audit.close_old_connections'):
+            DatabaseSink().write(events)
+        self.assertEqual(list(RecordAccessEvent.objects.order_by('record_id').values_list(
+            'record_id', 'user_id', 'action', 'route', 'timestamp')), events)
+
+        file_sink.write(events)
+        [segment] = os.listdir(directory.name)
+        with open(os.path.join(directory.name, segment), encoding='utf-8') as lines:
+            self.assertEqual([json.loads(line) for line in lines], [
+                {'record_id': 1, 'user_id': 7, 'action': RecordAccessEvent.READ, 'route': 'route',
+                 'timestamp': now.isoformat()},
+                {'record_id': 2, 'user_id': None, 'action': RecordAccessEvent.DELETE, 'route': 'route',
+                 'timestamp': now.isoformat()},
+            ])
+
+    def test_file_segments_rotate(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        sink = FileSink(directory.name, segment_bytes=200)
+        self.addCleanup(sink.close)
+        now = timezone.now()
+        for record_id in range(10):
+            sink.write([(record_id, 7, RecordAccessEvent.READ, 'route', now)])
+        segments = sorted(os.listdir(directory.name))
+        self.assertGreater(len(segments), 1)
+        self.assertEqual([name.rsplit('-', 1)[1] for name in segments],
+                         [f'{n:06d}.jsonl' for n in range(1, len(segments) + 1)])
+        record_ids = []
+        for name in segments:
+            with open(os.path.join(directory.name, name), encoding='utf-8') as lines:
+                record_ids += [json.loads(line)['record_id'] for line in lines]
+            # A segment is only left once it has passed its size
+            if name != segments[-1]:
+                self.assertGreaterEqual(os.path.getsize(os.path.join(directory.name, name)), 200)
+        self.assertEqual(record_ids, list(range(10)))
+
+
+class MemoryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                                   specialization='Heart')
+        cls.doctor_user = User.objects.create_user('doctor', password='secret')
+        doctor = Doctor.objects.create(user=cls.doctor_user, department=cls.department)
+        patients = User.objects.bulk_create([
+            User(username=f'patient{i}', email=f'patient{i}@example.com') for i in range(MEMORY_BUDGET_ROWS)
+        ])
+        DoctorPatientRelationship.objects.bulk_create([
+            DoctorPatientRelationship(doctor=doctor, patient=patient) for patient in patients
+        ])
+        roster.check('default', fix=True)
+        PatientRecordNew.objects.bulk_create([
+            PatientRecordNew(patient=patient, doctor=doctor, department=cls.department,
+                             diagnostics='Routine check-up results ' * 4,
+                             observations='No significant issues found ' * 4,
+                             treatments='Prescribed vitamins ' * 4, misc='Follow-up in six months')
+            for patient in patients
+        ])
+
+    def setUp(self):
+        audit_to_files(self)
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor_user)
+
+    def assertPeakWithinBudget(self, url, bytes_per_row):
+        # The first request warms up caches and lazy imports
+        self.client.get(url)
+        response, measurement = measure(self.client.get, url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), MEMORY_BUDGET_ROWS)
+        budget = MEMORY_BUDGET_BASE_BYTES + bytes_per_row * MEMORY_BUDGET_ROWS
+        self.assertLess(measurement.peak, budget, f'{url} allocated most in {measurement.top[:3]}')
+
+    def test_record_list_within_budget(self):
+        self.assertPeakWithinBudget('/api/patient_records/', RECORD_LIST_BYTES_PER_ROW)
+
+    def test_department_patients_within_budget(self):
+        self.assertPeakWithinBudget(f'/api/department/{self.department.pk}/patients/', PATIENT_LIST_BYTES_PER_ROW)
+
+    def test_patient_list_within_budget(self):
+        self.assertPeakWithinBudget('/api/patients/', PATIENT_LIST_BYTES_PER_ROW)
+
+    @override_settings(MEMORY_PROFILING={'ENABLED': True, 'FRAMES': 1, 'TOP': 5})
+    def test_profiler_records_peak_per_route(self):
+        memory_stats.clear()
+        self.addCleanup(memory_stats.clear)
+        # The middleware leaves tracemalloc on for the life of the worker
+        self.addCleanup(tracemalloc.stop)
+        client = APIClient()
+        client.force_authenticate(self.doctor_user)
+        response = client.get('/api/patient_records/')
+        self.assertGreater(int(response['X-Memory-Peak']), 0)
+        stats = memory_stats.snapshot()['patient-record-list-create']
+        self.assertEqual(stats['requests'], 1)
+        self.assertTrue(stats['top'])
+
+
+class SharedCacheTestCase(TestCase):
+    """
+    Runs with the default cache in a temporary directory of its own: a file
+    cache like the one in settings, which separate AccessIndex or RecordCache
+    instances share the way workers do.  They check it on every lookup.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        cls.enterClassContext(override_settings(CACHES=file_cache(directory.name), ACCESS_INDEX_CHECK_INTERVAL=0,
+                                                LOOKUP_CHECK_INTERVAL=0))
+        super().setUpClass()
+
+
+class AccessIndexTests(SharedCacheTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                               specialization='Heart')
+        cls.doctor = Doctor.objects.create(user=User.objects.create_user('doctor'), department=department)
+        cls.patient = User.objects.create_user('patient')
+
+    def setUp(self):
+        access_index.invalidate()
+        # The index of another worker
+        self.other = AccessIndex()
+        self.assertFalse(self.other.doctor_has_patient(self.doctor.pk, self.patient.pk))
+
+    def test_grant_reaches_every_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            DoctorPatientRelationship.objects.create(doctor=self.doctor, patient=self.patient)
+        self.assertTrue(access_index.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        self.assertTrue(self.other.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        self.assertTrue(self.other.can_access_patient(self.doctor.user_id, self.patient.pk))
+
+    def test_revoke_reaches_every_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            relationship = DoctorPatientRelationship.objects.create(doctor=self.doctor, patient=self.patient)
+        self.assertTrue(self.other.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            relationship.delete()
+        self.assertFalse(access_index.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        self.assertFalse(self.other.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        self.assertFalse(self.other.can_access_patient(self.doctor.user_id, self.patient.pk))
+
+    @override_settings(ACCESS_INDEX_CHECK_INTERVAL=60)
+    def test_lookups_between_checks_stay_in_memory(self):
+        self.other.load()
+        with mock.patch('api.access.cache') as cache:
+            self.assertFalse(self.other.doctor_has_patient(self.doctor.pk, self.patient.pk))
+        cache.get.assert_not_called()
+
+
+class SharedCacheSettingsTests(SimpleTestCase):
+    def test_default_cache_is_shared(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_reported(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['api.W001'])
+
+
+class RecordCacheTests(SharedCacheTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                               specialization='Heart')
+        cls.doctor_user = User.objects.create_user('doctor')
+        doctor = Doctor.objects.create(user=cls.doctor_user, department=department)
+        cls.record = PatientRecordNew.objects.create(
+            patient=User.objects.create_user('patient'), doctor=doctor, department=department,
+            diagnostics='Initial diagnosis', observations='None', treatments='None',
+        )
+
+    def setUp(self):
+        audit_to_files(self)
+        access_index.invalidate()
+        record_cache.clear()
+        self.url = f'/api/patient_records/{self.record.pk}/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor_user)
+
+    def test_put_in_another_worker_retires_local_entry(self):
+        self.client.get(self.url)
+        self.assertIsNotNone(record_cache.get(self.record.pk))
+
+        # Another worker, with its own record cache, takes the PUT
+        other = RecordCache(1024 * 1024, 'default', 300)
+        with mock.patch('api.views.records.record_cache', other), mock.patch('api.signals.record_cache', other), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(self.url, {'diagnostics': 'EDITED'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get(self.url).json()['diagnostics'], 'EDITED')
+
+    def test_concurrent_saves_get_their_own_versions(self):
+        first = PatientRecordNew.objects.get(pk=self.record.pk)
+        second = PatientRecordNew.objects.get(pk=self.record.pk)
+        # A GET that rendered the first write finishes after both
+        with self.captureOnCommitCallbacks(execute=True):
+            first.diagnostics = 'First'
+            first.save()
+        rendering = CachedRecord(self.record.pk, first.version, self.record.patient_id, self.record.doctor_id,
+                                 b'{"diagnostics": "First"}')
+        with self.captureOnCommitCallbacks(execute=True):
+            second.diagnostics = 'Second'
+            second.save()
+        self.assertEqual((first.version, second.version), (2, 3))
+        record_cache.put(rendering)
+        self.assertEqual(self.client.get(self.url).json()['diagnostics'], 'Second')
+
+    def test_admin_department_sync_bumps_version(self):
+        model_admin = admin.site._registry[PatientRecordNew]
+        rendering = CachedRecord(self.record.pk, self.record.version, self.record.patient_id, self.record.doctor_id,
+                                 b'{}')
+        with mock.patch.object(model_admin, 'message_user'):
+            model_admin.sync_department_with_doctor(None, PatientRecordNew.objects.filter(pk=self.record.pk))
+        self.assertEqual(PatientRecordNew.objects.get(pk=self.record.pk).version, self.record.version + 1)
+        # A rendering of the old version, finishing late, isn't cached
+        record_cache.put(rendering)
+        self.assertIsNone(record_cache.get(self.record.pk))
+
+    def test_nothing_cached_without_shared_cache(self):
+        local = RecordCache(1024 * 1024)
+        local.put(CachedRecord(self.record.pk, self.record.version, self.record.patient_id, self.record.doctor_id,
+                               b'{}'))
+        self.assertIsNone(local.get(self.record.pk))
+
+
+class LookupTests(SharedCacheTestCase):
+    def test_new_department_reaches_every_worker(self):
+        # The department table of another worker
+        other = CachedTable(departments.generation_key, departments.fetch)
+        self.assertEqual(other.get(1), None)
+        with self.captureOnCommitCallbacks(execute=True):
+            department = Department.objects.create(name='Neurology', diagnostics='EEG', location='B',
+                                                   specialization='Brain')
+        self.assertEqual(other.get(department.pk).name, 'Neurology')
+
+
+class ImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cardiology, neurology = Department.objects.bulk_create([
+            Department(name='Cardiology', diagnostics='ECG', location='A', specialization='Heart'),
+            Department(name='Neurology', diagnostics='EEG', location='B', specialization='Brain'),
+        ])
+        cls.doctor_user = User.objects.create_user('doctor')
+        cls.doctor = Doctor.objects.create(user=cls.doctor_user, department=cardiology)
+        cls.colleague = Doctor.objects.create(user=User.objects.create_user('colleague'), department=cardiology)
+        cls.outsider = Doctor.objects.create(user=User.objects.create_user('outsider'), department=neurology)
+        cls.patients = Group.objects.create(name='Patients')
+        cls.patient = User.objects.create_user('patient')
+        cls.patient.groups.add(cls.patients)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor_user)
+
+    def upload(self, content):
+        return self.client.post('/api/patient_records/import/',
+                                {'file': SimpleUploadedFile('records.csv', content)}, format='multipart')
+
+    def line(self, doctor):
+        return f'{self.patient.pk},{doctor.pk},{self.doctor.department_id},Flu,Fever,Rest\n'.encode()
+
+    def test_rows_of_doctors_from_other_departments_rejected(self):
+        response = self.upload(b'patient,doctor,department,diagnostics,observations,treatments\n'
+                               + self.line(self.colleague) + self.line(self.outsider))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['imported'], 1)
+        self.assertEqual(response.json()['rejections'][0]['line'], 3)
+        self.assertFalse(PatientRecordNew.objects.filter(doctor=self.outsider).exists())
+
+    def test_undecodable_file_stops_with_summary(self):
+        response = self.upload(b'patient,doctor,department,diagnostics,observations,treatments\n'
+                               + self.line(self.doctor) * 1000 + b'\xff\xfe')
+        # Lines are decoded a block at a time, so only those in the blocks
+        # before the bad bytes are read
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(response.json()['imported'], 0)
+        self.assertLess(response.json()['imported'], 1000)
+        self.assertIn('stopped after line', response.json()['error'])
+
+    def test_only_active_patients_and_doctors(self):
+        inactive = User.objects.create_user('inactive', is_active=False)
+        deleted = User.objects.create_user('deleted')
+        for user in (inactive, deleted):
+            user.groups.add(self.patients)
+        soft_delete(deleted)
+        soft_delete(self.colleague.user)
+        rows = [(self.patient, self.doctor), (self.doctor_user, self.doctor), (inactive, self.doctor),
+                (deleted, self.doctor), (self.patient, self.colleague)]
+        response = self.upload(b'patient,doctor,diagnostics,observations,treatments\n' + b''.join(
+            f'{patient.pk},{doctor.pk},Flu,Fever,Rest\n'.encode() for patient, doctor in rows))
+        self.assertEqual(response.json()['imported'], 1)
+        self.assertEqual([rejection['error'] for rejection in response.json()['rejections']], [
+            f'unknown patient {self.doctor_user.pk}', f'unknown patient {inactive.pk}', f'unknown patient {deleted.pk}',
+            f'unknown doctor {self.colleague.pk}',
+        ])
+
+
+class DepartmentSoftDeleteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                                   specialization='Heart')
+        cls.doctor_user = User.objects.create_user('doctor')
+        doctor = Doctor.objects.create(user=cls.doctor_user, department=cls.department)
+        cls.deleted_doctor = Doctor.objects.create(user=User.objects.create_user('deleted'), department=cls.department)
+        cls.deleted_patient = User.objects.create_user('patient')
+        DoctorPatientRelationship.objects.create(doctor=doctor, patient=cls.deleted_patient)
+        soft_delete(cls.deleted_doctor.user)
+        soft_delete(cls.deleted_patient)
+
+    def setUp(self):
+        access_index.invalidate()
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor_user)
+
+    def test_deleted_doctors_not_listed(self):
+        response = self.client.get(f'/api/department/{self.department.pk}/doctors/')
+        self.assertNotIn(self.deleted_doctor.pk, [doctor['id'] for doctor in response.json()])
+
+    def test_deleted_doctors_not_updated(self):
+        response = self.client.put(f'/api/department/{self.department.pk}/doctors/',
+                                   [{'id': self.deleted_doctor.pk, 'username': 'back'}], format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_deleted_patients_not_updated(self):
+        response = self.client.put(f'/api/department/{self.department.pk}/patients/',
+                                   [{'id': self.deleted_patient.pk, 'email': 'back@example.com'}], format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+
+class PurgeTests(SharedCacheTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                                   specialization='Heart')
+        cls.doctor_user = User.objects.create_user('doctor')
+        cls.doctor = Doctor.objects.create(user=cls.doctor_user, department=cls.department)
+        cls.colleague = Doctor.objects.create(user=User.objects.create_user('colleague'), department=cls.department)
+        cls.patient = User.objects.create_user('patient')
+        cls.other_patient = User.objects.create_user('other')
+        for doctor, patient in ((cls.doctor, cls.patient), (cls.doctor, cls.other_patient),
+                                (cls.colleague, cls.other_patient)):
+            DoctorPatientRelationship.objects.create(doctor=doctor, patient=patient)
+        cls.records = {
+            (doctor.pk, patient.pk): [
+                PatientRecordNew.objects.create(patient=patient, doctor=doctor, department=cls.department,
+                                                diagnostics=f'Diagnosis {i}', observations='None', treatments='None')
+                for i in range(3)
+            ]
+            for doctor, patient in ((cls.doctor, cls.patient), (cls.doctor, cls.other_patient),
+                                    (cls.colleague, cls.other_patient))
+        }
+
+    def setUp(self):
+        audit_to_files(self)
+        record_cache.clear()
+        access_index.invalidate()
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor_user)
+
+    def listed(self):
+        return {record['record_id'] for record in self.client.get('/api/patient_records/').json()}
+
+    def ids(self, doctor, patient):
+        return {record.pk for record in self.records[doctor.pk, patient.pk]}
+
+    def test_records_of_soft_deleted_users_are_hidden(self):
+        record = self.records[self.doctor.pk, self.patient.pk][0]
+        url = f'/api/patient_records/{record.pk}/'
+        # Cached before the delete
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertIsNotNone(record_cache.get(record.pk))
+        soft_delete(self.patient)
+        soft_delete(self.colleague.user)
+        self.assertEqual(self.listed(), self.ids(self.doctor, self.other_patient))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_purge(self):
+        soft_delete(self.patient)
+        soft_delete(self.colleague.user)
+        call_command('purge_deleted', batch_size=2, stdout=mock.Mock())
+        self.assertFalse(User.objects.filter(pk__in=[self.patient.pk, self.colleague.user_id]).exists())
+        self.assertEqual(set(PatientRecordNew.objects.values_list('pk', flat=True)),
+                         self.ids(self.doctor, self.other_patient))
+        self.assertEqual(list(DoctorPatientRelationship.objects.values_list('doctor', 'patient')),
+                         [(self.doctor.pk, self.other_patient.pk)])
+        self.assertEqual(list(PurgeRequest.objects.filter(finished_at__isnull=True, claimed_at__isnull=True)), [])
+        # Records, relationships, roster rows and the user; the colleague also has their Doctor
+        self.assertEqual(sorted(PurgeRequest.objects.values_list('deleted_rows', flat=True)), [6, 7])
+
+    def test_interrupted_purge_resumes(self):
+        purge_request = soft_delete(self.patient)
+
+        def interrupt(model, rows):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            purge(purge_request, batch_size=2, progress=interrupt)
+        purge_request.refresh_from_db()
+        self.assertIsNotNone(purge_request.started_at)
+        self.assertEqual((purge_request.finished_at, purge_request.claimed_at, purge_request.deleted_rows),
+                         (None, None, 2))
+        self.assertEqual(purge(purge_request, batch_size=2), 4)
+        purge_request.refresh_from_db()
+        self.assertEqual(purge_request.deleted_rows, 6)
+        self.assertIsNotNone(purge_request.finished_at)
+        self.assertFalse(PatientRecordNew.objects.filter(patient=self.patient).exists())
+
+    def test_claimed_purge_is_left_to_its_run(self):
+        purge_request = soft_delete(self.patient)
+        PurgeRequest.objects.filter(pk=purge_request.pk).update(claimed_at=timezone.now())
+        self.assertIsNone(purge(purge_request, batch_size=2))
+        self.assertTrue(User.objects.filter(pk=self.patient.pk).exists())
+        # Until the claim runs out, as when the run holding it died
+        PurgeRequest.objects.filter(pk=purge_request.pk).update(
+            claimed_at=timezone.now() - timedelta(seconds=settings.PURGE_CLAIM_SECONDS))
+        self.assertEqual(purge(purge_request, batch_size=2), 6)
+
+
+class CoalescingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                                   specialization='Heart')
+        cls.doctor_user = User.objects.create_user('doctor')
+        Doctor.objects.create(user=cls.doctor_user, department=cls.department)
+
+    def setUp(self):
+        access_index.invalidate()
+        self.url = f'/api/department/{self.department.pk}/doctors/'
+
+    def test_view_reuses_middleware_authentication(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.doctor_user)}')
+        with mock.patch.object(JWTAuthentication, 'get_user', autospec=True,
+                               side_effect=JWTAuthentication.get_user) as get_user:
+            response = client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_user.call_count, 1)
+
+    def test_bad_token_still_refused(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        self.assertEqual(client.get(self.url).status_code, 401)
+
+
+class CompressedTextFieldTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                               specialization='Heart')
+        doctor = Doctor.objects.create(user=User.objects.create_user('doctor'), department=department)
+        cls.long_text = 'Patient reports chest pain on exertion, ECG shows ST depression. ' * 5
+        cls.record = PatientRecordNew.objects.create(
+            patient=User.objects.create_user('patient'), doctor=doctor, department=department,
+            diagnostics=cls.long_text, observations='Initial diagnosis', treatments='None',
+        )
+
+    def test_values_return_text(self):
+        records = PatientRecordNew.objects.filter(pk=self.record.pk)
+        self.assertEqual(records.values('diagnostics', 'observations').get(),
+                         {'diagnostics': self.long_text, 'observations': 'Initial diagnosis'})
+        self.assertEqual(records.values_list('observations', flat=True).get(), 'Initial diagnosis')
+
+    def test_saved_text_round_trips(self):
+        record = PatientRecordNew.objects.get(pk=self.record.pk)
+        record.treatments = 'Aspirin'
+        record.save()
+        record.refresh_from_db()
+        self.assertEqual((record.diagnostics, record.treatments), (self.long_text, 'Aspirin'))
+
+
+SHARDS = ('shard1', 'shard2')
+
+# Databases for the shard tests, created by the test runner like 'default'.
+# They must exist before it runs the checks, which is before any setUpClass.
+for alias in SHARDS:
+    connections.settings.setdefault(alias, {**connections.settings['default'], 'NAME': ':memory:'})
+
+
+class ShardedTestCase(SharedCacheTestCase):
+    """Runs with 'shard1' and 'shard2' listed in ``DATABASE_SHARDS['ALIASES']``."""
+    databases = {'default', *SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.enterClassContext(override_settings(DATABASE_SHARDS={
+            'ALIASES': list(SHARDS), 'CHECK_INTERVAL': 0, 'ID_BLOCK_SIZE': 5, 'MOVE_GRACE_SECONDS': 0,
+        }))
+        shard_ids._blocks.clear()
+        shard_map.invalidate()
+        super().setUpClass()
+
+    def setUp(self):
+        # Blocks reserved by rolled back tests are gone with the sequence row
+        shard_ids._blocks.clear()
+        shard_map.invalidate()
+        access_index.invalidate()
+
+
+class ShardTests(ShardedTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology, cls.neurology = Department.objects.bulk_create([
+            Department(name='Cardiology', diagnostics='ECG', location='A', specialization='Heart'),
+            Department(name='Neurology', diagnostics='EEG', location='B', specialization='Brain'),
+        ])
+        cls.doctor = Doctor.objects.create(user=User.objects.create_user('doctor'), department=cls.cardiology)
+        cls.patient = User.objects.create_user('patient', email='patient@example.com')
+        cls.relationship = DoctorPatientRelationship.objects.create(doctor=cls.doctor, patient=cls.patient)
+        cls.records = [
+            PatientRecordNew.objects.create(patient=cls.patient, doctor=cls.doctor, department=cls.cardiology,
+                                            diagnostics=f'Diagnosis {i}', observations='None', treatments='None')
+            for i in range(3)
+        ]
+
+    def create_record(self, department):
+        return PatientRecordNew.objects.create(patient=self.patient, doctor=self.doctor, department=department,
+                                               diagnostics='Flu', observations='Fever', treatments='Rest')
+
+    def aliases_of(self, model, **lookup):
+        return [alias for alias in ('default', *SHARDS) if model.objects.using(alias).filter(**lookup).exists()]
+
+    def test_router_sends_rows_to_their_departments_shard(self):
+        shard_map.assign(self.neurology.pk, 'shard1')
+        placed = self.create_record(self.neurology)
+        unplaced = self.create_record(self.cardiology)
+        self.assertEqual(self.aliases_of(PatientRecordNew, pk=placed.pk), ['shard1'])
+        self.assertEqual(self.aliases_of(PatientRecordNew, pk=unplaced.pk), ['default'])
+        self.assertEqual(router.db_for_write(Doctor, instance=self.doctor), 'default')
+
+    def test_ids_are_unique_across_shards(self):
+        shard_map.assign(self.neurology.pk, 'shard1')
+        ids = [self.create_record(department).pk for department in (self.neurology, self.cardiology) * 4]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+
+    def test_sequence_starts_above_every_shard(self):
+        IdSequence.objects.all().delete()
+        PatientRecordNew.objects.using('shard2').bulk_create([PatientRecordNew(
+            pk=500, patient=self.patient, doctor=self.doctor, department=self.neurology,
+            diagnostics='Flu', observations='Fever', treatments='Rest')])
+        self.assertEqual(shard_ids.reserve(PatientRecordNew, 3), (501, 504))
+        self.assertEqual(shard_ids.reserve(PatientRecordNew, 3), (504, 507))
+
+    @override_settings(DATABASE_SHARDS={'ALIASES': list(SHARDS), 'CHECK_INTERVAL': 0, 'ID_BLOCK_SIZE': 5,
+                                        'MOVE_GRACE_SECONDS': 7})
+    def test_move_department_copies_writes_made_during_grace_period(self):
+        def late_writes(seconds):
+            # A request that still had the old map writes to 'default'
+            PatientRecordNew.objects.using('default').filter(pk=self.records[0].pk).update(
+                diagnostics='Late', version=F('version') + 1)
+            PatientRoster.objects.using('default').filter(pk=self.relationship.pk).update(email='late@example.com')
+
+        with mock.patch('api.shards.time.sleep', side_effect=late_writes) as sleep:
+            move_department(self.cardiology.pk, 'shard1', batch_size=2)
+        sleep.assert_called_once_with(7)
+
+        self.assertEqual(DepartmentShard.objects.get(department=self.cardiology).alias, 'shard1')
+        for model in (PatientRecordNew, DoctorPatientRelationship, PatientRoster):
+            self.assertFalse(model.objects.using('default').exists())
+        self.assertEqual(PatientRecordNew.objects.using('shard1').count(), 3)
+        self.assertEqual(PatientRecordNew.objects.using('shard1').get(pk=self.records[0].pk).diagnostics, 'Late')
+        self.assertEqual(PatientRoster.objects.using('shard1').get(pk=self.relationship.pk).email,
+                         'late@example.com')
+
+    def test_move_refused_without_shared_cache(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(ValueError):
+                move_department(self.cardiology.pk, 'shard1', batch_size=2)
+        self.assertTrue(PatientRecordNew.objects.using('default').exists())
+
+    def test_rehome_moves_rows_whose_department_changed(self):
+        shard_map.assign(self.neurology.pk, 'shard2')
+        moved = [record.pk for record in self.records[:2]]
+        PatientRecordNew.objects.using('default').filter(pk__in=moved).update(department=self.neurology)
+        rehome(PatientRecordNew, 'default', [record.pk for record in self.records])
+        self.assertEqual(sorted(PatientRecordNew.objects.using('shard2').values_list('pk', flat=True)), moved)
+        self.assertEqual(list(PatientRecordNew.objects.using('default').values_list('pk', flat=True)),
+                         [self.records[2].pk])
+
+    def test_doctor_moving_department_takes_relationships_along(self):
+        shard_map.assign(self.neurology.pk, 'shard1')
+        # As in a fresh worker, the index loads during the save
+        access_index.invalidate()
+        self.doctor.department = self.neurology
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.save()
+        self.assertEqual(self.aliases_of(DoctorPatientRelationship, pk=self.relationship.pk), ['shard1'])
+        self.assertEqual(PatientRoster.objects.using('shard1').get(pk=self.relationship.pk).department_id,
+                         self.neurology.pk)
+
+
+
+
+class ArchiveTests(ShardedTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology, cls.neurology = Department.objects.bulk_create([
+            Department(name='Cardiology', diagnostics='ECG', location='A', specialization='Heart'),
+            Department(name='Neurology', diagnostics='EEG', location='B', specialization='Brain'),
+        ])
+        cls.doctor_user = User.objects.create_user('doctor')
+        cls.doctor = Doctor.objects.create(user=cls.doctor_user, department=cls.cardiology)
+        cls.patient = User.objects.create_user('patient')
+
+    def setUp(self):
+        super().setUp()
+        audit_to_files(self)
+        record_cache.clear()
+        self.now = timezone.now()
+        self.cutoff = self.now - timedelta(days=settings.PATIENT_RECORD_RETENTION_DAYS)
+
+    def create_record(self, days_old, department=None, **fields):
+        record = PatientRecordNew.objects.create(
+            patient=self.patient, doctor=self.doctor, department=department or self.cardiology,
+            **{'diagnostics': 'Flu', 'observations': 'Fever', 'treatments': 'Rest', **fields})
+        created_date = self.now - timedelta(days=days_old)
+        PatientRecordNew.objects.using(router.db_for_write(PatientRecordNew, instance=record)).filter(
+            pk=record.pk).update(created_date=created_date)
+        record.created_date = created_date
+        return record
+
+    def test_archive_batch_moves_records_past_cutoff(self):
+        old = [self.create_record(days_old) for days_old in (900, 800, 760)]
+        recent = self.create_record(30)
+        self.assertEqual(archive.archive_batch(self.cutoff, batch_size=2), 2)
+        # Oldest first
+        self.assertEqual(list(PatientRecordArchive.objects.order_by('pk').values_list('pk', flat=True)),
+                         [old[0].pk, old[1].pk])
+        self.assertEqual(archive.archive_batch(self.cutoff, batch_size=2), 1)
+        self.assertEqual(archive.archive_batch(self.cutoff, batch_size=2), 0)
+        self.assertEqual(list(PatientRecordNew.objects.values_list('pk', flat=True)), [recent.pk])
+
+    def test_archive_records_in_batches_on_every_shard(self):
+        shard_map.assign(self.neurology.pk, 'shard1')
+        for days_old in (900, 800, 760):
+            self.create_record(days_old)
+        self.create_record(900, department=self.neurology)
+        self.create_record(30, department=self.neurology)
+        self.assertEqual(list(archive.archive_records(batch_size=2)), [2, 3, 4])
+        self.assertEqual(PatientRecordArchive.objects.count(), 4)
+        self.assertEqual(PatientRecordNew.objects.using('shard1').count(), 1)
+
+    def test_payload_round_trip(self):
+        record = self.create_record(900, diagnostics='Ünïcode ' * 50, misc=None)
+        archive.archive_batch(self.cutoff, batch_size=10)
+        restored = archive.get_record(record.pk)
+        self.assertTrue(restored.is_archived)
+        for name in ('record_id', 'patient_id', 'doctor_id', 'department_id', 'created_date', *archive.ARCHIVED_FIELDS):
+            self.assertEqual(getattr(restored, name), getattr(record, name), name)
+
+    def test_get_record_falls_back_to_archive(self):
+        hot, cold = self.create_record(30), self.create_record(900)
+        archive.archive_batch(self.cutoff, batch_size=10)
+        self.assertFalse(getattr(archive.get_record(hot.pk), 'is_archived', False))
+        self.assertTrue(archive.get_record(cold.pk).is_archived)
+        with self.assertRaises(PatientRecordNew.DoesNotExist):
+            archive.get_record(cold.pk + 100)
+
+    def test_archived_record_is_read_only(self):
+        record = self.create_record(900)
+        archive.archive_batch(self.cutoff, batch_size=10)
+        client = APIClient()
+        client.force_authenticate(self.doctor_user)
+        url = f'/api/patient_records/{record.pk}/'
+        response = client.get(url)
+        self.assertEqual((response.status_code, response.json()['diagnostics']), (200, 'Flu'))
+        self.assertIsNone(record_cache.get(record.pk))
+        response = client.put(url, {'diagnostics': 'Changed'}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(archive.get_record(record.pk).diagnostics, 'Flu')
+
+
+class AdminTests(ShardedTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology, cls.neurology = Department.objects.bulk_create([
+            Department(name='Cardiology', diagnostics='ECG', location='A', specialization='Heart'),
+            Department(name='Neurology', diagnostics='EEG', location='B', specialization='Brain'),
+        ])
+        cls.doctor = Doctor.objects.create(user=User.objects.create_user('doctor'), department=cls.cardiology)
+        cls.patient = User.objects.create_user('patient')
+        cls.records = [
+            PatientRecordNew.objects.create(patient=cls.patient, doctor=cls.doctor, department=cls.cardiology,
+                                            diagnostics=f'Diagnosis {i}', observations='None', treatments='None')
+            for i in range(10)
+        ]
+
+    def archive_oldest(self, count):
+        # As archive_records does: the highest id stays, so MAX(pk) overshoots
+        PatientRecordNew.objects.filter(pk__in=[record.pk for record in self.records[:count]]).delete()
+
+    def test_estimate_corrected_by_short_page(self):
+        self.archive_oldest(6)
+        paginator = EstimatedCountPaginator(PatientRecordNew.objects.order_by('pk'), 3)
+        self.assertEqual(paginator.num_pages, 4)
+        page = paginator.page(2)
+        self.assertEqual([record.pk for record in page], [self.records[9].pk])
+        self.assertFalse(page.has_next())
+        self.assertEqual((paginator.count, list(paginator.page_range)), (4, [1, 2]))
+
+    def test_page_past_the_last_row_is_clamped(self):
+        self.archive_oldest(6)
+        paginator = EstimatedCountPaginator(PatientRecordNew.objects.order_by('pk'), 2)
+        page = paginator.page(4)
+        self.assertEqual((page.number, paginator.count, paginator.num_pages), (2, 4, 2))
+        self.assertEqual([record.pk for record in page], [record.pk for record in self.records[8:]])
+
+    def test_changelist_last_pages_after_archiving(self):
+        self.archive_oldest(6)
+        self.client.force_login(User.objects.create_superuser('admin'))
+        model_admin = admin.site._registry[PatientRecordNew]
+        with mock.patch.object(model_admin, 'list_per_page', 2):
+            # Both past the last of the 4 rows, newest first
+            for page in (3, 5):
+                with self.subTest(page=page):
+                    response = self.client.get(f'/admin/api/patientrecordnew/?p={page}')
+                    self.assertEqual(response.status_code, 200)
+                    changelist = response.context['cl']
+                    self.assertEqual((changelist.page_num, changelist.result_count), (2, 4))
+                    self.assertEqual([record.pk for record in changelist.result_list],
+                                     [self.records[7].pk, self.records[6].pk])
+
+    def test_department_sync_on_a_shard(self):
+        shard_map.assign(self.neurology.pk, 'shard1')
+        PatientRecordNew.objects.filter(pk__in=[record.pk for record in self.records[:2]]).update(
+            department=self.neurology)
+        rehome(PatientRecordNew, 'default', [record.pk for record in self.records])
+        model_admin = admin.site._registry[PatientRecordNew]
+        with mock.patch.object(model_admin, 'message_user') as message_user:
+            model_admin.sync_department_with_doctor(None, PatientRecordNew.objects.using('shard1').all())
+        message_user.assert_called_once_with(None, '2 records updated.')
+        self.assertFalse(PatientRecordNew.objects.using('shard1').exists())
+        self.assertEqual(set(PatientRecordNew.objects.values_list('department', flat=True)), {self.cardiology.pk})
+        self.assertEqual(PatientRecordNew.objects.get(pk=self.records[0].pk).version, 2)
+
+
+class RosterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cardiology, cls.neurology = Department.objects.bulk_create([
+            Department(name='Cardiology', diagnostics='ECG', location='A', specialization='Heart'),
+            Department(name='Neurology', diagnostics='EEG', location='B', specialization='Brain'),
+        ])
+        cls.doctor_user = User.objects.create_user('doctor')
+        cls.doctor = Doctor.objects.create(user=cls.doctor_user, department=cls.cardiology)
+        cls.colleague = Doctor.objects.create(user=User.objects.create_user('colleague'), department=cls.cardiology)
+        cls.neurologist = Doctor.objects.create(user=User.objects.create_user('neurologist'),
+                                                department=cls.neurology)
+        cls.patient = User.objects.create_user('patient', email='patient@example.com')
+
+    def setUp(self):
+        access_index.invalidate()
+
+    def relate(self, doctor):
+        return DoctorPatientRelationship.objects.create(doctor=doctor, patient=self.patient)
+
+    def rows(self):
+        return list(PatientRoster.objects.order_by('pk').values_list(
+            'relationship_id', 'department_id', 'is_primary', 'username', 'email'))
+
+    def assertConsistent(self):
+        self.assertEqual(roster.check('default'), {'missing': 0, 'stale': 0, 'orphaned': 0, 'primaries': 0})
+
+    def test_first_relationship_per_department_is_primary(self):
+        first, second, other = self.relate(self.doctor), self.relate(self.colleague), self.relate(self.neurologist)
+        self.assertEqual(self.rows(), [
+            (first.pk, self.cardiology.pk, True, 'patient', 'patient@example.com'),
+            (second.pk, self.cardiology.pk, False, 'patient', 'patient@example.com'),
+            (other.pk, self.neurology.pk, True, 'patient', 'patient@example.com'),
+        ])
+        self.assertConsistent()
+
+    def test_primary_handed_over_on_delete(self):
+        first, second = self.relate(self.doctor), self.relate(self.colleague)
+        first.delete()
+        self.assertEqual(self.rows(), [(second.pk, self.cardiology.pk, True, 'patient', 'patient@example.com')])
+        second.delete()
+        self.assertEqual(self.rows(), [])
+        self.assertConsistent()
+
+    def test_patient_changes_reach_roster(self):
+        self.relate(self.doctor)
+        self.relate(self.neurologist)
+        self.patient.username, self.patient.email = 'renamed', 'renamed@example.com'
+        self.patient.save()
+        self.assertEqual({row[3:] for row in self.rows()}, {('renamed', 'renamed@example.com')})
+        self.assertConsistent()
+
+    def test_doctor_changing_department_moves_rows(self):
+        first, second = self.relate(self.doctor), self.relate(self.colleague)
+        client = APIClient()
+        client.force_authenticate(self.doctor_user)
+        # As in a fresh worker, the index loads during the save
+        access_index.invalidate()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.put(f'/api/doctors/{self.doctor.pk}/', {'department': self.neurology.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rows(), [
+            (first.pk, self.neurology.pk, True, 'patient', 'patient@example.com'),
+            (second.pk, self.cardiology.pk, True, 'patient', 'patient@example.com'),
+        ])
+        self.assertConsistent()
+
+
+class IdempotencyTests(SharedCacheTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name='Cardiology', diagnostics='ECG', location='A',
+                                                   specialization='Heart')
+
+    def register(self, key, username='doctor'):
+        return self.client.post('/api/register/', {
+            'username': username, 'password': 'secret', 'email': f'{username}@example.com', 'group': 'Doctors',
+            'department': self.department.pk,
+        }, content_type='application/json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def middleware(self, response=None):
+        return IdempotencyMiddleware(lambda request: response or HttpResponse(status=201))
+
+    @staticmethod
+    def request(key='key'):
+        return RequestFactory().post('/api/register/', b'{}', content_type='application/json',
+                                     HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_completed_key_is_replayed(self):
+        first = self.register('key')
+        second = self.register('key')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((second.status_code, second.content), (201, first.content))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(User.objects.filter(username='doctor').count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        self.register('key')
+        response = self.register('key', username='other')
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(User.objects.filter(username='other').exists())
+
+    def test_headers_are_replayed(self):
+        created = HttpResponse(status=201, headers={'Location': '/api/patients/7/'})
+        middleware = self.middleware(created)
+        middleware(self.request())
+        response = middleware(self.request())
+        self.assertIsNot(response, created)
+        self.assertEqual(response['Location'], '/api/patients/7/')
+
+    def test_duplicate_waits_for_running_request(self):
+        middleware = self.middleware()
+        request = self.request()
+        key = middleware.key_for(request, 'key')
+        now = timezone.now()
+
+        def finish(seconds):
+            IdempotencyRecord.objects.filter(key=key).update(status=201, body=b'done')
+
+        for running_here in (False, True):
+            with self.subTest(running_here=running_here):
+                # The first request is still running, in another worker or in this one
+                IdempotencyRecord.objects.create(key=key, fingerprint=middleware.fingerprint(request),
+                                                 created_at=now, expires_at=now + timedelta(days=1))
+                if running_here:
+                    middleware._running[key] = mock.Mock(wait=finish)
+                with mock.patch('api.idempotency.time.sleep', side_effect=finish) as sleep:
+                    response = middleware(self.request())
+                middleware._running.clear()
+                self.assertEqual((response.status_code, response.content), (201, b'done'))
+                self.assertEqual(sleep.called, not running_here)
+                IdempotencyRecord.objects.filter(key=key).delete()
+
+    @override_settings(IDEMPOTENCY={**settings.IDEMPOTENCY, 'WAIT_TIMEOUT': 0})
+    def test_duplicate_gives_up_after_wait_timeout(self):
+        middleware = self.middleware()
+        request = self.request()
+        now = timezone.now()
+        IdempotencyRecord.objects.create(key=middleware.key_for(request, 'key'),
+                                         fingerprint=middleware.fingerprint(request), created_at=now,
+                                         expires_at=now + timedelta(days=1))
+        response = middleware(request)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_expired_keys_are_cleared(self):
+        self.register('key')
+        IdempotencyRecord.objects.update(expires_at=timezone.now())
+        call_command('clear_idempotency_keys', stdout=mock.Mock())
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        # The key is free again
+        response = self.register('key', username='other')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+
+# A statement that runs for seconds on SQLite
+SLOW_SQL = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) '
+            'SELECT COUNT(*) FROM n')
+
+
+class StatementTests(TestCase):
+    def setUp(self):
+        slow_query_log.clear()
+        self.addCleanup(slow_query_log.clear)
+
+    def test_budget_by_route_and_method(self):
+        middleware = StatementBudgetMiddleware(lambda request: None)
+        factory = RequestFactory()
+        self.assertEqual(middleware.budget_for(factory.get('/api/patient_records/')),
+                         ('patient-record-list-create', 5.0))
+        self.assertEqual(middleware.budget_for(factory.post('/api/patient_records/')),
+                         ('patient-record-list-create', 10.0))
+        self.assertEqual(middleware.budget_for(factory.post('/api/patient_records/import/')),
+                         ('patient-record-import', 60.0))
+        self.assertEqual(middleware.budget_for(factory.get('/nowhere/')), (None, 10.0))
+
+    def test_statement_over_budget_is_interrupted(self):
+        token = _budget.set(('test', 0.05))
+        try:
+            with self.assertRaises(StatementTimeout), transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(SLOW_SQL)
+        finally:
+            _budget.reset(token)
+        [entry] = slow_query_log.entries()
+        self.assertEqual((entry['count'], entry['timeouts'], entry['routes']), (1, 1, ['test']))
+
+    @override_settings(STATEMENT_BUDGETS={**settings.STATEMENT_BUDGETS, 'ROUTES': {'slow-queries': 0.05},
+                                          'RETRY_AFTER': 3})
+    def test_request_over_budget_gets_503(self):
+        def entries(limit):
+            with connection.cursor() as cursor:
+                cursor.execute(SLOW_SQL)
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('admin'))
+        with mock.patch.object(slow_query_log, 'entries', entries):
+            response = client.get('/api/metrics/slow-queries/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT *  FROM t\nWHERE a = 'it''s' AND b IN (%s, %s, %s) AND c > 2.5 AND d = %s"),
+            'SELECT * FROM t WHERE a = ? AND b IN (...) AND c > ? AND d = ?')
+
+    def test_slow_queries_grouped_with_first_plan(self):
+        log = SlowQueryLog(threshold=0, max_entries=1)
+        sql = 'SELECT name FROM api_department WHERE id = %s'
+        with mock.patch('api.statements.explain', wraps=statements.explain) as explain:
+            log.add(connection, sql, [1], 0.002, 'department-detail')
+            log.add(connection, sql.replace('%s', '7'), None, 0.004, 'department-list')
+            log.add(connection, 'SELECT name FROM api_doctor', None, 0.001, 'doctor-list')
+        explain.assert_called_once()
+        [entry] = log.entries()
+        self.assertEqual(entry['sql'], 'SELECT name FROM api_department WHERE id = ?')
+        self.assertEqual((entry['count'], entry['routes'], entry['max_ms']),
+                         (2, ['department-detail', 'department-list'], 4.0))
+        self.assertTrue(any('api_department' in line for line in entry['plan']), entry['plan'])
+        self.assertEqual(log.dropped, 1)
+
+    def test_only_queries_are_explained(self):
+        log = SlowQueryLog(threshold=0, max_entries=10)
+        log.add(connection, 'INSERT INTO api_department (name) VALUES (%s)', ['x'], 0.002, None)
+        self.assertIsNone(log.entries()[0]['plan'])
+
+    def test_slow_queries_limit_must_be_a_number(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('admin'))
+        for limit in ('x', '-1'):
+            with self.subTest(limit=limit):
+                self.assertEqual(client.get(f'/api/metrics/slow-queries/?limit={limit}').status_code, 400)
+        self.assertEqual(client.get('/api/metrics/slow-queries/?limit=5').status_code, 200)
+
+
+class TracingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.export_path = f'{directory.name}/traces.jsonl'
+        self.buffer = TraceBuffer(2, self.export_path)
+        patcher = mock.patch('api.tracing.trace_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def traced(self, status=200, random=0.5, **config):
+        def view(request):
+            with span('work', step=1):
+                pass
+            return HttpResponse(status=status)
+
+        tracing = {**settings.TRACING, 'ENABLED': True, 'SAMPLE_RATE': 0.1, 'SLOW_REQUEST_SECONDS': None,
+                   'KEEP_ERRORS': True, **config}
+        with override_settings(TRACING=tracing), mock.patch('api.tracing.random.random', return_value=random):
+            return TracingMiddleware(view)(RequestFactory().get('/api/patients/'))
+
+    def test_head_sample_is_traced_with_spans(self):
+        response = self.traced(random=0.05)
+        [trace] = self.buffer.recent()
+        self.assertEqual(response['X-Trace-Id'], trace['id'])
+        self.assertEqual((trace['reason'], trace['detailed'], trace['status']), ('sampled', True, 200))
+        self.assertEqual([(span['name'], span['step']) for span in trace['spans']], [('work', 1)])
+
+    def test_other_requests_are_not_kept(self):
+        response = self.traced()
+        self.assertEqual(self.buffer.recent(), [])
+        self.assertFalse(response.has_header('X-Trace-Id'))
+
+    def test_slow_and_failed_requests_are_kept_without_spans(self):
+        self.traced(SLOW_REQUEST_SECONDS=0)
+        self.traced(status=503)
+        # Without KEEP_ERRORS not even timed
+        with mock.patch('api.tracing.Trace') as trace:
+            self.traced(status=503, KEEP_ERRORS=False)
+        trace.assert_not_called()
+        self.assertEqual([(trace['reason'], trace['detailed'], trace['spans'], trace['queries'])
+                          for trace in self.buffer.recent()],
+                         [('error', False, None, None), ('slow', False, None, None)])
+
+    def test_kept_traces_are_exported(self):
+        for status in (500, 502, 504):
+            self.traced(status=status)
+        # The buffer holds the newest two, the export all three
+        self.assertEqual([trace['status'] for trace in self.buffer.recent()], [504, 502])
+        with open(self.export_path, encoding='utf-8') as export:
+            self.assertEqual([json.loads(line)['status'] for line in export], [500, 502, 504])
+
+
+class TraceMetricsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser('admin'))
+        self.buffer = TraceBuffer(10)
+        patcher = mock.patch('api.views.metrics.trace_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_export_as_json_lines(self):
+        self.buffer.add(mock.Mock(as_dict=lambda: {'id': 'a', 'duration_ms': 5.0}))
+        self.buffer.add(mock.Mock(as_dict=lambda: {'id': 'b', 'duration_ms': 700.0}))
+        response = self.client.get('/api/metrics/traces/?export=1&min_ms=500')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response.content, b'{"id": "b", "duration_ms": 700.0}\n')
+
+    def test_bad_parameters(self):
+        for query in ('limit=x', 'limit=-1', 'min_ms=nan', 'min_ms=slow'):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f'/api/metrics/traces/?{query}').status_code, 400)
+        self.assertEqual(self.client.get('/api/metrics/traces/?limit=5&min_ms=0.5').status_code, 200)
+
+
+class AdmissionTests(SimpleTestCase):
+    def controller(self):
+        return AdmissionController({
+            'CLASSES': {
+                'bulk': {'CONCURRENCY': 1, 'QUEUE': 0, 'TIMEOUT': 1.0},
+                'cheap': {'CONCURRENCY': 2, 'QUEUE': 2, 'TIMEOUT': 1.0},
+            },
+            'ROUTES': {'patient-record-import': 'bulk', 'patient-record-list-create:GET': 'bulk'},
+            'DEFAULT_CLASS': 'cheap',
+            'RETRY_AFTER': 4,
+        })
+
+    def test_routes_are_classed_by_name_and_method(self):
+        controller, factory = self.controller(), RequestFactory()
+        self.assertEqual(controller.classify(factory.post('/api/patient_records/import/')).name, 'bulk')
+        self.assertEqual(controller.classify(factory.get('/api/patient_records/')).name, 'bulk')
+        self.assertEqual(controller.classify(factory.post('/api/patient_records/')).name, 'cheap')
+        self.assertEqual(controller.classify(factory.get('/nowhere/')).name, 'cheap')
+
+    def test_full_queue_is_turned_away(self):
+        route_class = RouteClass('bulk', concurrency=1, queue=0, timeout=10.0)
+        self.assertTrue(route_class.acquire())
+        start = time.monotonic()
+        self.assertFalse(route_class.acquire())
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(route_class.stats(), {'concurrency': 1, 'queue': 0, 'active': 1, 'waiting': 0,
+                                               'admitted': 1, 'rejected': 1, 'timed_out': 0})
+
+    def test_wait_in_queue_times_out(self):
+        route_class = RouteClass('bulk', concurrency=1, queue=1, timeout=0.05)
+        self.assertTrue(route_class.acquire())
+        self.assertFalse(route_class.acquire())
+        route_class.release()
+        self.assertTrue(route_class.acquire())
+        self.assertEqual(route_class.stats(), {'concurrency': 1, 'queue': 1, 'active': 1, 'waiting': 0,
+                                               'admitted': 2, 'rejected': 1, 'timed_out': 1})
+
+    def test_queued_request_runs_when_a_slot_frees(self):
+        route_class = RouteClass('bulk', concurrency=1, queue=1, timeout=10.0)
+        self.assertTrue(route_class.acquire())
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(route_class.acquire()))
+        waiter.start()
+        while route_class.stats()['waiting'] < 1:
+            time.sleep(0.001)
+        # The queue is full now
+        self.assertFalse(route_class.acquire())
+        route_class.release()
+        waiter.join()
+        self.assertEqual(admitted, [True])
+        stats = route_class.stats()
+        self.assertEqual((stats['active'], stats['waiting'], stats['admitted'], stats['rejected']), (1, 0, 2, 1))
+
+    def test_busy_class_gets_503_and_others_still_run(self):
+        controller = self.controller()
+        with mock.patch('api.admission._controller', controller):
+            middleware = AdmissionControlMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+        self.assertTrue(controller.classes['bulk'].acquire())
+        response = middleware(factory.post('/api/patient_records/import/'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '4')
+        self.assertEqual(middleware(factory.post('/api/patient_records/')).status_code, 200)
+        self.assertEqual({name: stats['rejected'] for name, stats in controller.stats().items()},
+                         {'bulk': 1, 'cheap': 0})
+        self.assertEqual(controller.stats()['cheap']['active'], 0)
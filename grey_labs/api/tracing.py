@@ -0,0 +1,300 @@
+"""
+In-process request tracing.
+
+TracingMiddleware gives a request a Trace in a context variable and
+``span()`` records timed steps into it: JWT decoding and user loading, each
+permission class, every database query, serializer validation and save,
+and rendering.  ``install()`` hooks those in; it runs from
+``ApiConfig.ready()`` only when ``TRACING['ENABLED']`` is set, and with
+tracing off the middleware removes itself, so nothing is added to a request.
+``install()`` replaces DRF's ``APIView.check_permissions``,
+``APIView.check_object_permissions`` and ``Response.rendered_content`` for
+the whole process with copies that add spans, so they must follow DRF's
+if it changes them.  Outside a trace they cost one context variable lookup
+per span.
+
+Only requests in the head sample (``SAMPLE_RATE``) get spans.  The others
+are just timed, and kept without spans if slower than
+``SLOW_REQUEST_SECONDS`` or, with ``KEEP_ERRORS``, answered with a 5xx, so
+tail sampling costs next to nothing.  Kept traces go to a ring buffer of
+``BUFFER_SIZE`` and are also appended as JSON lines to ``EXPORT_PATH`` if it
+is set.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+# Longest SQL kept on a span
+MAX_SQL_LENGTH = 1000
+
+# Spans kept per trace, e.g. a bulk import runs thousands of queries; the
+# rest are only counted.
+MAX_SPANS = 2000
+
+_current = ContextVar('api_trace', default=None)
+
+
+class Trace:
+    def __init__(self, request, reason, detailed=True):
+        self.id = uuid.uuid4().hex
+        self.method = request.method
+        self.path = request.path
+        self.route = None
+        self.status = None
+        self.reason = reason
+        # Whether spans are recorded, only for the head sample
+        self.detailed = detailed
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.dropped_spans = 0
+        self.depth = 0
+
+    def finish(self, request, response):
+        self.duration = time.perf_counter() - self.start
+        self.status = response.status_code
+        match = getattr(request, 'resolver_match', None)
+        self.route = match.url_name if match else None
+
+    def as_dict(self):
+        queries = [span for span in self.spans if span['name'] == 'db']
+        detailed = self.detailed
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'route': self.route,
+            'status': self.status,
+            'reason': self.reason,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(self.duration * 1000, 3),
+            'detailed': detailed,
+            'queries': len(queries) if detailed else None,
+            'db_ms': round(sum(span['duration_ms'] for span in queries), 3) if detailed else None,
+            'dropped_spans': self.dropped_spans,
+            'spans': self.spans if detailed else None,
+        }
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'attrs', 'start', 'record')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        trace = self.trace
+        # Appended now so spans come out in start order, filled in on exit
+        self.record = {'name': self.name, 'depth': trace.depth, **self.attrs}
+        trace.spans.append(self.record)
+        trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.trace.depth -= 1
+        self.record['start_ms'] = round((self.start - self.trace.start) * 1000, 3)
+        self.record['duration_ms'] = round((end - self.start) * 1000, 3)
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **attrs):
+    """Time a block as a span of the current trace, if there is one."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    if len(trace.spans) >= MAX_SPANS:
+        trace.dropped_spans += 1
+        return _NO_SPAN
+    return _Span(trace, name, attrs)
+
+
+class TraceBuffer:
+    def __init__(self, size, export_path=None):
+        self._traces = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.export_path = export_path
+
+    def add(self, trace):
+        data = trace.as_dict()
+        with self._lock:
+            self._traces.append(data)
+            if self.export_path:
+                with open(self.export_path, 'a', encoding='utf-8') as export:
+                    export.write(json.dumps(data) + '\n')
+
+    def recent(self, limit=None, min_duration_ms=0):
+        with self._lock:
+            traces = [t for t in reversed(self._traces) if t['duration_ms'] >= min_duration_ms]
+        return traces[:limit] if limit else traces
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+
+trace_buffer = TraceBuffer(settings.TRACING['BUFFER_SIZE'], settings.TRACING['EXPORT_PATH'])
+
+
+def to_jsonl(traces):
+    return ''.join(json.dumps(trace) + '\n' for trace in traces)
+
+
+class TracingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.TRACING
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['SAMPLE_RATE']
+        self.slow = config['SLOW_REQUEST_SECONDS']
+        self.keep_errors = config['KEEP_ERRORS']
+        self.trace_all = self.slow is not None or self.keep_errors
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        if self.sample_rate and random.random() < self.sample_rate:
+            trace = Trace(request, 'sampled')
+            return trace, _current.set(trace)
+        if self.trace_all:
+            # Timed for the tail sample, but out of reach of span()
+            return Trace(request, None, detailed=False), None
+        return None
+
+    def end(self, started, request, response):
+        trace, token = started
+        if token is not None:
+            _current.reset(token)
+        trace.finish(request, response)
+        if trace.reason is None:
+            if self.slow is not None and trace.duration >= self.slow:
+                trace.reason = 'slow'
+            elif self.keep_errors and trace.status >= 500:
+                trace.reason = 'error'
+            else:
+                return response
+        trace_buffer.add(trace)
+        response['X-Trace-Id'] = trace.id
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = self.start(request)
+        if started is None:
+            return self.get_response(request)
+        response = self.get_response(request)
+        return self.end(started, request, response)
+
+    async def __acall__(self, request):
+        started = self.start(request)
+        if started is None:
+            return await self.get_response(request)
+        response = await self.get_response(request)
+        return self.end(started, request, response)
+
+
+# Instrumentation
+
+def trace_queries(execute, sql, params, many, context):
+    trace = _current.get()
+    if trace is None or len(trace.spans) >= MAX_SPANS:
+        if trace is not None:
+            trace.dropped_spans += 1
+        return execute(sql, params, many, context)
+    with _Span(trace, 'db', {'alias': context['connection'].alias, 'sql': sql[:MAX_SQL_LENGTH], 'many': many}):
+        return execute(sql, params, many, context)
+
+
+def _add_query_wrapper(connection, **kwargs):
+    if trace_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(trace_queries)
+
+
+def _wrap(cls, name, span_name):
+    original = getattr(cls, name)
+
+    def traced(self, *args, **kwargs):
+        with span(span_name, cls=type(self).__name__):
+            return original(self, *args, **kwargs)
+
+    traced.__wrapped__ = original
+    setattr(cls, name, traced)
+
+
+def install():
+    """Hook spans into DRF, simplejwt and every database connection."""
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    from rest_framework.response import Response
+    from rest_framework.serializers import BaseSerializer
+    from rest_framework.views import APIView
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+
+    connection_created.connect(_add_query_wrapper, dispatch_uid='api.tracing')
+    for connection in connections.all(initialized_only=True):
+        _add_query_wrapper(connection)
+
+    _wrap(JWTAuthentication, 'get_validated_token', 'auth.jwt_decode')
+    _wrap(JWTAuthentication, 'get_user', 'auth.user_load')
+    _wrap(BaseSerializer, 'is_valid', 'serializer.validate')
+    _wrap(BaseSerializer, 'save', 'serializer.save')
+
+    def check_permissions(self, request):
+        # APIView.check_permissions with a span per permission class
+        for permission in self.get_permissions():
+            with span('permission', cls=type(permission).__name__):
+                allowed = permission.has_permission(request, self)
+            if not allowed:
+                self.permission_denied(request, message=getattr(permission, 'message', None),
+                                       code=getattr(permission, 'code', None))
+
+    def check_object_permissions(self, request, obj):
+        for permission in self.get_permissions():
+            with span('object_permission', cls=type(permission).__name__):
+                allowed = permission.has_object_permission(request, self, obj)
+            if not allowed:
+                self.permission_denied(request, message=getattr(permission, 'message', None),
+                                       code=getattr(permission, 'code', None))
+
+    APIView.check_permissions = check_permissions
+    APIView.check_object_permissions = check_object_permissions
+
+    rendered_content = Response.rendered_content
+
+    @property
+    def traced_rendered_content(self):
+        with span('render', renderer=type(getattr(self, 'accepted_renderer', None)).__name__):
+            return rendered_content.fget(self)
+
+    Response.rendered_content = traced_rendered_content
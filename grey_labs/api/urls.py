@@ -1,19 +1,22 @@
 from django.urls import path
-from .views import *
+from .lazy import LazyView
 
 urlpatterns = [
-    path('register/', register_user),
-    path('login/', login_view, name='login'),
-    path('doctors/', DoctorListCreateView.as_view(), name='doctor-list-create'),
-    path('doctors/<int:pk>/', doctor_detail, name='doctor-detail'),
-    path('patients/', PatientListCreateView.as_view(), name='patient-list-create'),
-    path('patients/<int:pk>/', patient_detail, name='patient-detail'),
-    path('patient_records/', PatientRecordListCreateView.as_view(), name='patient-record-list-create'),
-    path('patient_records/<int:pk>/', patient_record_detail, name='patient-record-detail'),
-     path('departments/', DepartmentListCreateView.as_view(), name='department-list-create'),
-      path('department/<int:pk>/doctors/', department_doctors, name='department-doctors'),
-       path('department/<int:pk>/patients/', department_patients, name='department-patients'),
-       path('logout/', logout, name='logout'),
-   
-    
+    path('register/', LazyView('api.views.auth.register_user'), name='register'),
+    path('login/', LazyView('api.views.auth.login_view'), name='login'),
+    path('doctors/', LazyView('api.views.doctors.DoctorListCreateView'), name='doctor-list-create'),
+    path('doctors/<int:pk>/', LazyView('api.views.doctors.doctor_detail'), name='doctor-detail'),
+    path('patients/', LazyView('api.views.patients.PatientListCreateView'), name='patient-list-create'),
+    path('patients/<int:pk>/', LazyView('api.views.patients.patient_detail'), name='patient-detail'),
+    path('patient_records/', LazyView('api.views.records.PatientRecordListCreateView'), name='patient-record-list-create'),
+    path('patient_records/import/', LazyView('api.views.records.import_patient_records'), name='patient-record-import'),
+    path('patient_records/<int:pk>/', LazyView('api.views.records.patient_record_detail'), name='patient-record-detail'),
+    path('departments/', LazyView('api.views.departments.DepartmentListCreateView'), name='department-list-create'),
+    path('department/<int:pk>/doctors/', LazyView('api.views.departments.department_doctors'), name='department-doctors'),
+    path('department/<int:pk>/patients/', LazyView('api.views.departments.department_patients'), name='department-patients'),
+    path('logout/', LazyView('api.views.auth.logout'), name='logout'),
+    path('metrics/admission/', LazyView('api.views.metrics.admission_metrics'), name='admission-metrics'),
+    path('metrics/traces/', LazyView('api.views.metrics.request_traces'), name='request-traces'),
+    path('metrics/memory/', LazyView('api.views.metrics.memory_metrics'), name='memory-metrics'),
+    path('metrics/slow-queries/', LazyView('api.views.metrics.slow_queries'), name='slow-queries'),
 ]
@@ -0,0 +1,39 @@
+"""
+Views for the api app, split per resource so a route only imports the
+module it needs.  ``api.views.<name>`` keeps working and loads the owning
+module on first access.
+"""
+import importlib
+
+_VIEW_MODULES = {
+    'register_user': 'auth',
+    'login_view': 'auth',
+    'logout': 'auth',
+    'IsDoctor': 'doctors',
+    'DoctorListCreateView': 'doctors',
+    'doctor_detail': 'doctors',
+    'PatientListCreateView': 'patients',
+    'patient_detail': 'patients',
+    'PatientRecordListCreateView': 'records',
+    'patient_record_detail': 'records',
+    'import_patient_records': 'records',
+    'DepartmentListCreateView': 'departments',
+    'department_doctors': 'departments',
+    'department_patients': 'departments',
+    'admission_metrics': 'metrics',
+    'request_traces': 'metrics',
+    'memory_metrics': 'metrics',
+    'slow_queries': 'metrics',
+}
+
+
+def __getattr__(name):
+    try:
+        module = _VIEW_MODULES[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    return getattr(importlib.import_module(f'.{module}', __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_VIEW_MODULES))
@@ -0,0 +1,171 @@
+from django.contrib.auth.models import User
+from django.http import Http404
+from rest_framework import status, generics
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework.exceptions import PermissionDenied
+from ..models import Department, Doctor
+from ..serializers import UserSerializer, DoctorSerializer, DepartmentSerializer
+from ..access import access_index
+from .. import roster
+from ..lookups import departments
+
+
+def get_department(pk):
+    # Departments are kept in memory, see api.lookups
+    department = departments.get(pk)
+    if department is None:
+        raise Http404('No Department matches the given query.')
+    return department
+
+
+# to get all departments
+
+
+class DepartmentListCreateView(generics.ListCreateAPIView):
+    queryset = Department.objects.all()
+    serializer_class = DepartmentSerializer
+
+"""
+get all data
+post:
+{
+    "name": "Cardiology",
+    "diagnostics": "Heart-related diagnostics",
+    "location": "Building A, Floor 2",
+    "specialization": "Cardiovascular diseases"
+}
+"""
+
+# to get all doctors in particular departments
+
+
+
+@api_view(['GET', 'PUT'])
+def department_doctors(request, pk):
+    # Retrieve the department
+    department = get_department(pk)
+
+    # Check if the current user is a doctor in this department
+    try:
+        doctor = request.user.doctor_profile
+    except AttributeError:
+        return Response({'detail': 'User is not a doctor'}, status=status.HTTP_403_FORBIDDEN)
+
+    if doctor.department_id != department.pk:
+        raise PermissionDenied("You do not have permission to access doctors in this department.")
+
+    if request.method == 'GET':
+        doctors = Doctor.objects.filter(department=department, user__purge_request__isnull=True)
+        serializer = DoctorSerializer(doctors, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    elif request.method == 'PUT':
+        # This method allows updating doctor details. Ensure to handle updates appropriately.
+        # Here, we assume that the request data includes doctor IDs to update or other necessary data.
+        data = request.data
+
+        # Note: Actual implementation would depend on what fields are being updated and how
+        # We will need to handle updating doctor instances based on the provided data
+
+        # Example: Updating a specific doctor
+        for doctor_data in data:
+            doctor_id = doctor_data.get('id')
+            try:
+                doctor = Doctor.objects.get(pk=doctor_id, department=department, user__purge_request__isnull=True)
+                serializer = DoctorSerializer(doctor, data=doctor_data, partial=True)
+                if serializer.is_valid():
+                    serializer.save()
+                else:
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            except Doctor.DoesNotExist:
+                return Response({'detail': f'Doctor with ID {doctor_id} not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({'detail': 'Doctors updated successfully'}, status=status.HTTP_200_OK)
+
+
+"""
+get all doctor in same department
+
+put:
+[
+    {
+        "id": 1,
+        "username": "updated_doctor1",
+        "email": "updated_doctor1@example.com"
+    },
+    {
+        "id": 2,
+        "username": "updated_doctor2",
+        "email": "updated_doctor2@example.com"
+    }
+]"""
+
+
+# to get all patients in particular department
+
+
+
+
+@api_view(['GET', 'PUT'])
+def department_patients(request, pk):
+    # Retrieve the department
+    department = get_department(pk)
+
+    # Check if the current user is a doctor in this department
+    try:
+        doctor = request.user.doctor_profile
+    except AttributeError:
+        return Response({'detail': 'User is not a doctor'}, status=status.HTTP_403_FORBIDDEN)
+
+    if doctor.department_id != department.pk:
+        raise PermissionDenied("You do not have permission to access patients in this department.")
+
+    if request.method == 'GET':
+        # Get all patients in the specified department
+        # The roster has this doctor's patients with their display fields
+        return Response(roster.patients_of_doctor(doctor.pk), status=status.HTTP_200_OK)
+
+    elif request.method == 'PUT':
+        # Update patient details
+        data = request.data
+        updated_count = 0
+
+        for patient_data in data:
+            patient_id = patient_data.get('id')
+            try:
+                patient = User.objects.get(pk=patient_id, purge_request__isnull=True)
+                # Ensure the patient is in the same department
+                if not access_index.doctor_has_patient(doctor.pk, patient.pk):
+                    return Response({'detail': f'Patient with ID {patient_id} is not associated with this doctor.'}, status=status.HTTP_400_BAD_REQUEST)
+
+                serializer = UserSerializer(patient, data=patient_data, partial=True)
+                if serializer.is_valid():
+                    serializer.save()
+                    updated_count += 1
+                else:
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            except User.DoesNotExist:
+                return Response({'detail': f'Patient with ID {patient_id} not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({'detail': f'{updated_count} patients updated successfully'}, status=status.HTTP_200_OK)
+
+
+"""
+
+put:
+[
+    {
+        "id": 1,
+        "username": "updated_patient1",
+        "email": "updated_patient1@example.com",
+        "password": "newpassword123"
+    },
+    {
+        "id": 2,
+        "username": "updated_patient2",
+        "email": "updated_patient2@example.com",
+        "password": "anothernewpassword"
+    }
+]
+"""
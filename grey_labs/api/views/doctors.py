@@ -0,0 +1,82 @@
+from rest_framework import status, generics, permissions
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework.exceptions import PermissionDenied
+from ..models import Doctor
+from ..serializers import DoctorSerializer
+from ..deletion import soft_delete
+
+
+# # to get all doctors list ids and names
+
+class IsDoctor(permissions.BasePermission):
+    """
+    Custom permission to only allow users in the 'Doctors' group.
+    """
+    def has_permission(self, request, view):
+        return request.user and request.user.groups.filter(name='Doctors').exists()
+
+class DoctorListCreateView(generics.ListCreateAPIView):
+    # Doctors waiting to be purged are gone as far as the API is concerned
+    queryset = Doctor.objects.filter(user__purge_request__isnull=True)
+    serializer_class = DoctorSerializer
+    permission_classes = [permissions.IsAuthenticated, IsDoctor]
+
+    def list(self, request, *args, **kwargs):
+        # Override list method to return only IDs and names
+        queryset = self.get_queryset()
+        data = [{'id': doctor.user.id, 'name': doctor.user.username} for doctor in queryset]
+        return Response(data)
+
+
+"""
+get: list of doctors
+for post
+{
+    "username": "dr_new",
+    "email": "dr_new@example.com",
+    "password": "password123",
+    "department": 1
+}
+"""
+
+# to get particular doctor details
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+def doctor_detail(request, pk):
+    try:
+        doctor = Doctor.objects.get(pk=pk, user__purge_request__isnull=True)
+    except Doctor.DoesNotExist:
+        return Response({'error': 'Doctor not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Check if the current user is the doctor whose profile is being accessed
+    if request.user != doctor.user:
+        raise PermissionDenied("You do not have permission to access this profile.")
+
+    if request.method == 'GET':
+        serializer = DoctorSerializer(doctor)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    elif request.method == 'PUT':
+        serializer = DoctorSerializer(doctor, data=request.data, partial=True)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    elif request.method == 'DELETE':
+        # The user and everything under them are purged later by purge_deleted
+        soft_delete(doctor.user, request.user)
+        return Response({'message': 'Doctor profile scheduled for deletion'}, status=status.HTTP_202_ACCEPTED)
+
+"""
+get:particular id
+
+Put:
+{
+    "username": "doctor-3",
+    "email": "dr_new@example.com",
+    "password": "password123",
+    "department": 1
+}"""
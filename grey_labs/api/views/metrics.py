@@ -0,0 +1,78 @@
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from ..admission import get_controller
+from ..memory import memory_stats
+from ..statements import slow_query_log
+from ..tracing import to_jsonl, trace_buffer
+
+
+def query_number(request, name, default, kind=int):
+    """The query parameter ``name`` as a non-negative ``kind``, ValueError if it isn't one."""
+    value = kind(request.query_params.get(name, default))
+    if not 0 <= value < float('inf'):
+        raise ValueError(f'{name} must be a non-negative number')
+    return value
+
+
+# admission control queue depths and rejection counts, per route class
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def admission_metrics(request):
+    return Response(get_controller().stats(), status=status.HTTP_200_OK)
+
+
+# recently kept request traces, newest first
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def request_traces(request):
+    try:
+        limit = query_number(request, 'limit', 50)
+        min_ms = query_number(request, 'min_ms', 0, float)
+    except ValueError:
+        return Response({'error': 'limit and min_ms must be non-negative numbers'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    traces = trace_buffer.recent(limit, min_ms)
+    if request.query_params.get('export'):
+        return HttpResponse(to_jsonl(traces), content_type='application/x-ndjson')
+    return Response(traces, status=status.HTTP_200_OK)
+
+"""
+get: ?limit=50&min_ms=500
+export as JSON lines: ?export=1
+"""
+
+
+# peak allocation per route and where the worst request allocated, when
+# MEMORY_PROFILING is enabled
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def memory_metrics(request):
+    return Response(memory_stats.snapshot(), status=status.HTTP_200_OK)
+
+
+# slow statements grouped by normalized SQL, with their plans, most total
+# time first
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def slow_queries(request):
+    try:
+        limit = query_number(request, 'limit', 50)
+    except ValueError:
+        return Response({'error': 'limit must be a non-negative integer'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'dropped': slow_query_log.dropped, 'queries': slow_query_log.entries(limit)},
+                    status=status.HTTP_200_OK)
+
+"""
+get: ?limit=50
+"""
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import User
+from django.shortcuts import get_object_or_404
+from rest_framework import status, generics
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import PermissionDenied
+from ..models import DoctorPatientRelationship, PatientRecordNew
+from ..serializers import UserSerializer
+from ..access import access_index
+from ..deletion import soft_delete
+from .. import roster
+
+
+# to get all patients list id and name
+
+
+class PatientListCreateView(generics.ListCreateAPIView):
+    serializer_class = UserSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        # Return all users who are patients associated with any doctor
+        # Relationships can be sharded away from the users table, the index has them all
+        return User.objects.filter(id__in=access_index.patient_ids(), purge_request__isnull=True)
+
+    def list(self, request, *args, **kwargs):
+        # The roster has the display fields and one primary row per patient and department
+        return Response(roster.all_patients())
+
+    def perform_create(self, serializer):
+        # Create the new user (patient)
+        user = serializer.save()
+
+        # Create the relationship with the authenticated doctor
+        DoctorPatientRelationship.objects.create(
+            doctor=self.request.user.doctor_profile,
+            patient=user
+        )
+
+        # Create a new patient record in the PatientRecordNew table
+        # Assuming you have default or placeholder values for the fields
+        PatientRecordNew.objects.create(
+            patient=user,
+            doctor=self.request.user.doctor_profile,
+            diagnostics="Initial diagnostics",
+            observations="Initial observations",
+            treatments="Initial treatments",
+            department=self.request.user.doctor_profile.department,
+            misc="No additional information"
+        )
+
+
+# to get particular patient id
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def patient_detail(request, pk):
+    # Fetch the patient user object
+    patient = get_object_or_404(User, pk=pk, purge_request__isnull=True)
+
+    # Check if the requesting user is either the patient or a relevant doctor
+    if not access_index.can_access_patient(request.user.id, patient.pk):
+        raise PermissionDenied("You do not have permission to access this patient.")
+
+    if request.method == 'GET':
+        serializer = UserSerializer(patient)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    elif request.method == 'PUT':
+        serializer = UserSerializer(patient, data=request.data)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    elif request.method == 'DELETE':
+        # Their records and relationships are purged later by purge_deleted
+        soft_delete(patient, request.user)
+        return Response({'message': 'Patient scheduled for deletion'}, status=status.HTTP_202_ACCEPTED)
+
+"""
+
+get: particular id
+put:
+{
+    "username": "updated_username",
+    "email": "updatedemail@example.com",
+    "password": "newpassword123"
+}
+"""
@@ -0,0 +1,170 @@
+import io
+
+from django.http import HttpResponse
+from rest_framework import status, generics
+from rest_framework.decorators import api_view, permission_classes, parser_classes
+from rest_framework.parsers import MultiPartParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import PermissionDenied
+from ..models import PatientRecordNew, PatientRecordArchive, RecordAccessEvent
+from ..serializers import PatientRecordNewSerializer
+from ..permissions import IsDoctorInSameDepartment
+from .. import archive
+from ..access import access_index
+from ..record_cache import DELETED, CachedRecord, record_cache
+from ..importer import RecordImporter, guess_format
+from ..shards import for_department
+from ..deletion import is_soft_deleted, without_purged
+from ..audit import log_access
+
+
+#  to get all patient records
+
+
+class PatientRecordListCreateView(generics.ListCreateAPIView):
+    serializer_class = PatientRecordNewSerializer
+    permission_classes = [IsAuthenticated, IsDoctorInSameDepartment]
+
+    def get_queryset(self):
+        user = self.request.user
+        try:
+            doctor = user.doctor_profile
+        except AttributeError:
+            return PatientRecordNew.objects.none()  # Return empty queryset if user is not a doctor
+
+        return without_purged(
+            for_department(PatientRecordNew, doctor.department_id).filter(department=doctor.department_id))
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        return log_access(request, response, RecordAccessEvent.READ, [item['record_id'] for item in response.data])
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        return log_access(request, response, RecordAccessEvent.CREATE, [response.data['record_id']])
+
+    def perform_create(self, serializer):
+        user = self.request.user
+        try:
+            doctor = user.doctor_profile
+        except AttributeError:
+            raise PermissionDenied("You do not have permission to create records.")
+
+        # Automatically set the doctor and department based on the authenticated user
+        serializer.save(doctor=doctor, department=doctor.department)
+
+
+"""
+get same department records
+post:
+{
+    "patient": 21,
+    "diagnostics": "Routine check-up results",
+    "observations": "No significant issues found",
+    "treatments": "Prescribed vitamins",
+    "misc": "Patient requested a follow-up appointment"
+}
+"""
+
+# to get particular patient records
+
+
+def check_record_access(user, patient_id, doctor_id):
+    # Check if the current user is the patient or the doctor for this record
+    if user.id not in (patient_id, access_index.user_id_for_doctor(doctor_id)):
+        raise PermissionDenied("You do not have permission to access this record.")
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+def patient_record_detail(request, pk):
+    # Rendered JSON is cached per record, only the permission check runs on a hit
+    serve_cached = request.method == 'GET' and request.accepted_renderer.format == 'json'
+    if serve_cached:
+        cached = record_cache.get(pk)
+        if cached is not None:
+            check_record_access(request.user, cached.patient_id, cached.doctor_id)
+            response = HttpResponse(cached.body, content_type='application/json')
+            return log_access(request, response, RecordAccessEvent.READ, [pk])
+
+    try:
+        # Falls back to the archive for records past the retention window
+        record = archive.get_record(pk)
+    except PatientRecordNew.DoesNotExist:
+        return Response({'detail': 'Record not found'}, status=status.HTTP_404_NOT_FOUND)
+    # Soft-deleted patients and doctors take their records with them, and
+    # soft_delete dropped the cached renderings
+    if is_soft_deleted(record.patient_id, access_index.user_id_for_doctor(record.doctor_id)):
+        return Response({'detail': 'Record not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    check_record_access(request.user, record.patient_id, record.doctor_id)
+
+    if request.method == 'GET':
+        serializer = PatientRecordNewSerializer(record)
+        if not serve_cached or record.is_archived:
+            response = Response(serializer.data, status=status.HTTP_200_OK)
+        else:
+            body = JSONRenderer().render(serializer.data)
+            record_cache.put(CachedRecord(record.pk, record.version, record.patient_id, record.doctor_id, body))
+            response = HttpResponse(body, content_type='application/json')
+        return log_access(request, response, RecordAccessEvent.READ, [record.pk])
+
+    elif request.method == 'PUT':
+        if record.is_archived:
+            return Response({'detail': 'Archived records are read-only'}, status=status.HTTP_409_CONFLICT)
+        serializer = PatientRecordNewSerializer(record, data=request.data, partial=True)
+        if serializer.is_valid():
+            serializer.save()
+            record_cache.invalidate(record.pk, record.version)
+            response = Response(serializer.data, status=status.HTTP_200_OK)
+            return log_access(request, response, RecordAccessEvent.UPDATE, [record.pk])
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    elif request.method == 'DELETE':
+        if record.is_archived:
+            PatientRecordArchive.objects.filter(pk=record.pk).delete()
+        else:
+            record.delete()
+            record_cache.invalidate(record.pk, DELETED)
+        response = Response({'message': 'Record deleted successfully'}, status=status.HTTP_204_NO_CONTENT)
+        return log_access(request, response, RecordAccessEvent.DELETE, [pk])
+
+"""
+put:
+{
+    "diagnostics": "Updated diagnostics",
+    "observations": "Updated observations"
+}
+
+"""
+
+
+# to bulk import historical records into the doctor's department, by doctors
+# of that department
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsDoctorInSameDepartment])
+@parser_classes([MultiPartParser])
+def import_patient_records(request):
+    upload = request.FILES.get('file')
+    if upload is None:
+        return Response({'error': 'A CSV or NDJSON file is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    format = request.data.get('format') or guess_format(upload.name)
+    if format not in ('csv', 'ndjson'):
+        return Response({'error': 'Unknown file format, send format=csv or format=ndjson'}, status=status.HTTP_400_BAD_REQUEST)
+
+    importer = RecordImporter(department_id=request.user.doctor_profile.department_id)
+    summary = importer.run(io.TextIOWrapper(upload.file, encoding='utf-8', newline=''), format)
+    return Response(summary, status=status.HTTP_201_CREATED if summary['imported'] else status.HTTP_400_BAD_REQUEST)
+
+"""
+post: multipart/form-data
+file: records.csv (or records.ndjson)
+format: csv | ndjson (optional, taken from the file name)
+
+csv header:
+patient,doctor,created_date,diagnostics,observations,treatments,misc
+"""
@@ -0,0 +1,101 @@
+"""
+Warm-up of a worker before it serves its first request.
+
+``warm_up()`` does up front what the first requests would otherwise pay
+for: compiling the URL patterns and importing every lazy view, building the
+fields of every serializer, loading the in-process tables (group ids,
+departments, the access index and the shard map) and opening a connection
+to every database.  Connections only outlive a request with ``CONN_MAX_AGE``
+set, as it is in settings.
+
+``grey_labs/wsgi.py`` and ``asgi.py`` call it when ``WARMUP['ENABLED']`` is
+set.  If the application is loaded before the server forks (gunicorn
+``--preload``), set ``WARMUP['PRE_FORK']``: the connections are closed
+again, as they must not be shared by the workers, and a ``post_fork`` hook
+can call ``open_connections()``.  ``manage.py warm_up`` runs it and reports
+how long each step took.
+"""
+import inspect
+import time
+
+from django.db import connections
+from django.urls import URLResolver, get_resolver
+
+from .lazy import LazyView
+
+
+def _patterns(resolver):
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, URLResolver):
+            yield from _patterns(pattern)
+        else:
+            yield pattern
+
+
+def resolve_urls():
+    resolver = get_resolver()
+    # Compiles every pattern and builds the reverse lookup tables
+    resolver.reverse_dict
+    views = 0
+    for pattern in _patterns(resolver):
+        pattern.pattern.regex
+        if isinstance(pattern.callback, LazyView):
+            pattern.callback.resolve()
+            views += 1
+    return views
+
+
+def build_serializers():
+    from rest_framework.serializers import BaseSerializer
+
+    from . import serializers
+
+    built = 0
+    for _, cls in inspect.getmembers(serializers, inspect.isclass):
+        if issubclass(cls, BaseSerializer) and cls.__module__ == serializers.__name__:
+            cls().fields
+            built += 1
+    return built
+
+
+def load_tables():
+    from .access import access_index
+    from .lookups import departments, group_ids
+    from .shards import shard_map
+
+    group_ids.load()
+    departments.load()
+    access_index.load()
+    shard_map.load()
+    return 4
+
+
+def open_connections():
+    for connection in connections.all():
+        connection.ensure_connection()
+    return len(connections.all())
+
+
+STEPS = [
+    ('urls', resolve_urls),
+    ('serializers', build_serializers),
+    ('tables', load_tables),
+    ('connections', open_connections),
+]
+
+
+def warm_up(pre_fork=False):
+    """
+    Run every step; returns ``[(step, count, seconds), ...]``.  With
+    ``pre_fork`` the database connections are closed at the end.
+    """
+    timings = []
+    for name, step in STEPS:
+        if pre_fork and step is open_connections:
+            continue
+        start = time.perf_counter()
+        count = step()
+        timings.append((name, count, time.perf_counter() - start))
+    if pre_fork:
+        connections.close_all()
+    return timings
@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'grey_labs.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.WARMUP['ENABLED']:
+    from api.warmup import warm_up
+
+    warm_up(pre_fork=settings.WARMUP['PRE_FORK'])
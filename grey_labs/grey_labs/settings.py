@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,7 +46,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.tracing.TracingMiddleware',
+    'api.memory.MemoryProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.idempotency.IdempotencyMiddleware',
+    # Ahead of admission control, so requests waiting for a coalesced
+    # response don't hold a slot
+    'api.coalescing.RequestCoalescingMiddleware',
+    'api.admission.AdmissionControlMiddleware',
+    'api.statements.StatementBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -81,6 +91,25 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Kept open between requests, so the connections opened by the
+        # warm-up (api/warmup.py) serve the first ones
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# Shared by every worker: the access index, shard map and in-memory tables
+# reload when a generation counter here changes, and the record cache keeps
+# renderings here. The file cache serves workers on one host; use Redis or
+# Memcached when they span hosts. Never a per-process cache (check api.W001).
+# The file cache lives in GREY_LABS_CACHE_DIR, by default in the temp
+# directory, outside the source tree.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('GREY_LABS_CACHE_DIR', Path(tempfile.gettempdir()) / 'grey_labs-cache'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
 
@@ -157,3 +186,188 @@ SIMPLE_JWT = {
 }
 
 
+
+# Patient records older than this are moved to the archive table by
+# `manage.py archive_records`, in batches of PATIENT_RECORD_ARCHIVE_BATCH_SIZE.
+PATIENT_RECORD_RETENTION_DAYS = 365 * 2
+PATIENT_RECORD_ARCHIVE_BATCH_SIZE = 500
+
+# CompressedTextField values shorter than this many bytes are stored uncompressed.
+COMPRESSED_TEXT_MIN_LENGTH = 128
+
+# Rows per bulk_create (and per transaction) for patient record imports.
+PATIENT_RECORD_IMPORT_BATCH_SIZE = 2000
+
+# How often (seconds) a worker checks the shared cache for access index
+# changes made by other workers. Between checks an authorization decision is
+# a dict lookup; a check reads the cache (a file read and unpickle with the
+# file cache). So a grant or revoke made by another worker can take this long
+# to apply here; a worker's own writes apply at once. 0 checks every time.
+ACCESS_INDEX_CHECK_INTERVAL = 1
+
+# The same for the group ids and departments kept in memory (api/lookups.py).
+LOOKUP_CHECK_INTERVAL = 1
+
+# Concurrent identical GETs to these routes share one response. The value is
+# the authorization scope the response depends on (see api.coalescing.SCOPES).
+REQUEST_COALESCING = {
+    'ROUTES': {
+        'department-doctors': 'department',
+        'department-patients': 'doctor',
+        'patient-record-list-create': 'department',
+    },
+    'WAIT_TIMEOUT': 5.0,
+}
+
+# Per route class concurrency limits. ROUTES maps a URL name, or
+# 'url-name:METHOD', to a class; everything else is DEFAULT_CLASS. Requests
+# beyond CONCURRENCY wait up to TIMEOUT seconds in a queue of QUEUE, and
+# get a 503 with Retry-After when the queue is full or the wait runs out.
+# This keeps classes from starving each other; it does not prioritize short
+# requests, within a class or across classes.
+ADMISSION_CONTROL = {
+    'CLASSES': {
+        'bulk': {'CONCURRENCY': 2, 'QUEUE': 4, 'TIMEOUT': 10.0},
+        'list': {'CONCURRENCY': 4, 'QUEUE': 16, 'TIMEOUT': 5.0},
+        'cheap': {'CONCURRENCY': 32, 'QUEUE': 64, 'TIMEOUT': 2.0},
+    },
+    'ROUTES': {
+        'department-patients:PUT': 'bulk',
+        'department-doctors:PUT': 'bulk',
+        'patient-record-import': 'bulk',
+        'patient-record-list-create:GET': 'list',
+        'patient-list-create:GET': 'list',
+        'department-patients:GET': 'list',
+        'department-doctors:GET': 'list',
+    },
+    'DEFAULT_CLASS': 'cheap',
+    'RETRY_AFTER': 1,
+}
+
+# Rendered patient record cache for patient_record_detail. Entries live in
+# the SHARED_ALIAS cache, which every worker must share (None turns caching
+# off), and in an in-process LRU of at most MAX_BYTES that is checked
+# against the shared cache on every hit.
+RECORD_CACHE = {
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'SHARED_ALIAS': 'default',
+    'SHARED_TIMEOUT': 300,
+}
+
+# Audit log of patient record access. Events are buffered and written by a
+# background thread every BATCH_SIZE events or FLUSH_INTERVAL seconds.
+# BACKEND is 'db' (RecordAccessEvent rows) or 'file' (JSON lines appended to
+# segments of SEGMENT_BYTES in DIRECTORY). Past MAX_BUFFER unwritten events,
+# new ones, and those of a failed write that no longer fit, are dropped and
+# counted.
+AUDIT_LOG = {
+    'BACKEND': 'db',
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'MAX_BUFFER': 100000,
+    'DIRECTORY': BASE_DIR / 'audit',
+    'SEGMENT_BYTES': 64 * 1024 * 1024,
+}
+
+# Optional sharding of PatientRecordNew and DoctorPatientRelationship by
+# department, see api/shards.py. Add the shards to DATABASES, list them in
+# ALIASES and place departments with `manage.py shards move`; departments
+# not placed stay on 'default'. CHECK_INTERVAL is how long a worker trusts
+# its copy of the shard map; ID_BLOCK_SIZE is how many record ids a worker
+# reserves at a time. A move waits MOVE_GRACE_SECONDS (at least
+# CHECK_INTERVAL) after switching the map, for requests still writing to
+# the old shard, before copying their writes and deleting the old rows;
+# keep it above the longest request.
+DATABASE_ROUTERS = ['api.shards.DepartmentShardRouter']
+DATABASE_SHARDS = {
+    'ALIASES': [],
+    'CHECK_INTERVAL': 0,
+    'ID_BLOCK_SIZE': 100,
+    'MOVE_GRACE_SECONDS': 30,
+}
+
+# Rows per raw DELETE (and per transaction) when purge_deleted removes
+# soft-deleted doctors and patients. A run claims each user it purges and
+# renews the claim every batch; a claim older than PURGE_CLAIM_SECONDS is
+# taken to belong to a run that died, and the next run resumes the purge.
+PURGE_BATCH_SIZE = 1000
+PURGE_CLAIM_SECONDS = 10 * 60
+
+# Request tracing, see api/tracing.py. Off by default; when off nothing is
+# instrumented. Requests in the SAMPLE_RATE head sample are traced with
+# spans and kept in a ring buffer of BUFFER_SIZE. Other requests are kept
+# without spans when they took longer than SLOW_REQUEST_SECONDS or (with
+# KEEP_ERRORS) ended in a 5xx. EXPORT_PATH, if set, gets every kept trace as
+# a JSON line. Kept traces are listed at /api/metrics/traces/.
+TRACING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.0,
+    'SLOW_REQUEST_SECONDS': 1.0,
+    'KEEP_ERRORS': True,
+    'BUFFER_SIZE': 500,
+    'EXPORT_PATH': None,
+}
+
+# Idempotency-Key handling for the POST routes (URL names) in ROUTES, see
+# api/idempotency.py. Responses are replayed to retries for TTL seconds; a
+# retry of a request still running waits up to WAIT_TIMEOUT seconds for it,
+# polling every POLL_INTERVAL seconds when it runs in another worker. A
+# request running longer than IN_PROGRESS_TIMEOUT is taken to have died.
+# Expired keys are removed by `manage.py clear_idempotency_keys`. Keys of
+# anonymous callers (register) are shared by all of them, so clients should
+# send random ones.
+IDEMPOTENCY = {
+    'ROUTES': ['register', 'patient-list-create', 'patient-record-list-create'],
+    'TTL': 24 * 60 * 60,
+    'WAIT_TIMEOUT': 10.0,
+    'IN_PROGRESS_TIMEOUT': 60.0,
+    'POLL_INTERVAL': 0.05,
+}
+
+# Memory profiling of requests with tracemalloc, see api/memory.py. Off by
+# default, as tracing allocations slows the whole worker. Peak allocation
+# per route and the TOP allocation sites (FRAMES deep) of the worst request
+# are listed at /api/metrics/memory/.
+MEMORY_PROFILING = {
+    'ENABLED': False,
+    'FRAMES': 1,
+    'TOP': 10,
+}
+
+# Warm-up of each worker before its first request, see api/warmup.py. With
+# ENABLED, wsgi.py and asgi.py resolve every route, build every serializer,
+# load the in-memory tables and open the database connections. Set PRE_FORK
+# when the application is loaded before the server forks (gunicorn
+# --preload), so connections are closed instead of shared by the workers.
+WARMUP = {
+    'ENABLED': False,
+    'PRE_FORK': False,
+}
+
+# Statement time budgets and the slow query log, see api/statements.py. A
+# statement run for a route in ROUTES ('url-name' or 'url-name:METHOD') is
+# stopped after that many seconds, for other routes after DEFAULT_SECONDS
+# (None for no limit), and the request gets a 503 with Retry-After.
+# INTERRUPTERS says how a statement is stopped on each database vendor.
+# Statements slower than SLOW_QUERY_SECONDS are logged with their plan once
+# per normalized SQL, up to MAX_SLOW_QUERIES, and listed at
+# /api/metrics/slow-queries/.
+STATEMENT_BUDGETS = {
+    'ENABLED': True,
+    'DEFAULT_SECONDS': 10.0,
+    'ROUTES': {
+        'patient-record-import': 60.0,
+        'patient-record-list-create:GET': 5.0,
+        'patient-list-create:GET': 5.0,
+        'department-patients:GET': 5.0,
+        'department-doctors:GET': 5.0,
+    },
+    'RETRY_AFTER': 1,
+    'SLOW_QUERY_SECONDS': 0.5,
+    'MAX_SLOW_QUERIES': 500,
+    'INTERRUPTERS': {
+        'sqlite': 'api.statements.sqlite_interrupt',
+        'postgresql': 'api.statements.postgresql_timeout',
+        'mysql': 'api.statements.mysql_timeout',
+    },
+}
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'grey_labs.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.WARMUP['ENABLED']:
+    from api.warmup import warm_up
+
+    warm_up(pre_fork=settings.WARMUP['PRE_FORK'])